@@ -5,12 +5,20 @@ except:
     import __builtin__
     builtins = __builtin__
 import atexit
+import binascii
+import collections
 import datetime
+import logging
 import struct
 from time import sleep,time
+try:
+    from time import perf_counter
+except ImportError:
+    perf_counter = time
 import sys
 import threading
 import getopt
+import multiprocessing
 import serial
 import serial.tools.list_ports
 import subprocess
@@ -20,14 +28,43 @@ if os.name == 'nt':
     import windows_utils
     from ctypes.wintypes import BOOL
 import signal
+try:
+    from queue import Queue, Full, Empty
+except ImportError:
+    from Queue import Queue, Full, Empty
+import select
+import socket
+try:
+    import termios
+    SerialErrors = (serial.SerialException, termios.error)
+except ImportError:
+    SerialErrors = (serial.SerialException,)
 builtins.USBIP_VERSION = None # 273 for the unsigned patched driver and 262 for the old signed driver
-from USBIP import BaseStucture, USBDevice, InterfaceDescriptor, DeviceConfigurations, EndPoint, USBContainer, USBRequest
+from shared_state import SharedState, EDGES as SHARED_EDGES
+import injection
+import logs
+import profiler
+import realtime
+import gctune
+from USBIP import BaseStucture, USBDevice, InterfaceDescriptor, DeviceConfigurations, EndPoint, USBContainer, USBRequest, ReplyBuffer, RET_SUBMIT_SIZE
 
 COMMAND_TIMEOUT = 2
 TIMEOUT = 5
-outState = 0
-newXYZ = False
-newButtons = False
+COMPATIBLE_REFRESH_POLLS = 6
+RECONNECT_MIN_DELAY = 0.05
+RECONNECT_MAX_DELAY = 2
+RECONNECT_PROBE_TIME = 0.25
+SHARED_WAIT = 0.5 # seconds sharedStateLoop blocks before it looks at `running` again
+SERIAL_QUEUE_SIZE = 16
+BUTTON_QUEUE_SIZE = 64 # button states kept for hosts that have not reported them yet
+PREDICT_HISTORY = 3 # frames the predictor's velocity is fitted to
+PREDICT_GAP = 0.1 # seconds without a frame after which the predictor starts over
+PREDICT_INTERVAL = 0.001 # seconds between estimates, a full-speed USB frame
+IDLE_PERIOD = 100 # ms between motion frames while the ball rests, with -f auto
+IDLE_AFTER = 1.0 # seconds without motion before -f auto slows the SpaceBall down
+FRAME_RATE_WINDOW = 1.0 # seconds over which metrics['frameRate'] is counted
+STALE_PERIODS = 3 # data periods without a frame after which metrics['frameRate'] is 0
+BEEP = None # queued for the current model's beep command
 outAxisMap = (0,1,2)
 polarityXYZ = (1,-1,-1)
 polarityRXYZ = (1,-1,-1)
@@ -43,28 +80,121 @@ description = "USB-SERIAL CH340"
 lock = threading.Lock()
 xyz = [0,0,0]
 rxyz = [0,0,0]
+reportAxes = [0,0,0,0,0,0] # trimmed xyz+rxyz in report order, see publishMotion
 buttons = 0
+motionCount = 0
+buttonsCount = 0
+buttonQueue = [0] * BUTTON_QUEUE_SIZE # buttons after each publishButtons, by buttonsCount % BUTTON_QUEUE_SIZE
+sharedWriter = None
+serialCommands = None # commands for the SpaceBall from USB/IP processing, see queueSerialCommand
+ingestProcess = False
+injectAddress = None
+injectStamp = 0.0 # send time of the newest injected message applied, for latency measurements
 trimValue = 500
 forceVendorID = None
 forceProductID = None
 compatible = False
 usbip = None if os.name == 'nt' else "usbip"
-event = threading.Event()
+consumers = () # Events of the report threads, one per USB/IP host, see addConsumer
+statsInterval = None
+metrics = { 'serialDrops': 0, 'reconnects': 0, 'reinitializations': 0,
+            'lastRecoveryTime': 0.0, 'maxRecoveryTime': 0.0, 'totalDowntime': 0.0, 'serialCommandDrops': 0,
+            'buttonEdgeDrops': 0, 'frameRate': 0.0, 'dataPeriod': 0, 'periodChanges': 0 }
+verbosity = {} # log level by subsystem, see logs.parseVerbosity
+profileControl = None
+profileOutput = None
+maxHosts = 1
+usbipAddress = None # see injection.parseAddress; None for the default of USBContainer.run
+predictHorizon = 0.0 # -e, in seconds
+predictor = None # MotionPredictor when predictHorizon is set, see build_report_fast
+dataPeriod = 20 # ms between motion frames, for models with a periodCommand
+adaptivePeriod = False # -f auto, see DataRate
+cpuAffinity = {} # -A, CPUs by thread role, see realtime.parseAffinity
+realtimePolicy = None # -R, 'fifo' or 'rr'
+realtimePriority = 0
+lowLatency = False # --low-latency
+gcMode = None # -g, see gctune.settle
+serialLog = logs.get('serial')
+hidLog = logs.get('hid')
+emulateLog = logs.get('emulate')
+injectLog = logs.get('inject')
+statsLog = logs.get('stats')
+mainLog = logs.get('main')
 
 
 
+# A serial device model: how to wake, identify and configure it, and a decoder per packet
+# type. processData looks the first byte of a frame up in a 256-entry table built from
+# `decoders`, so a frame costs one index and one call whatever the model. The models are
+# registered in MODELS, after their classes.
 class SerialSpaceMouse(object):
+    decoders = {} # first byte of a frame -> name of the method that decodes it
+    wakeup = b'\r'
+    probe = None # (command, reply prefix, text the reply must contain or None), see detectModel
+    stopbits = 1
+    buttonCount = 12
+
     def __init__(self,axisMap=(0,1,2),polarityXYZ=(1,1-1),polarityRXYZ=(1,1,-1),haveEscape=True,name="unknown"):
         self.axisMap = axisMap
         self.polarityXYZ = polarityXYZ
         self.polarityRXYZ = polarityRXYZ
         self.haveEscape = haveEscape
         self.name = name
-        
+        self.dispatch = [None] * 256
+        for first, method in self.decoders.items():
+            self.dispatch[ord(first)] = getattr(self, method)
+
     @staticmethod
     def get16(data,offset):
         return (data[offset+1]&0xFF) | ((data[offset]&0xFF)<<8)
 
+    @classmethod
+    def recognizes(cls, line):
+        return cls.probe is not None and line.startswith(cls.probe[1]) and (cls.probe[2] is None or cls.probe[2] in line)
+
+    def init(self):
+        conn.stopbits = self.stopbits
+        conn.write(self.wakeup)
+        confirmWrites(self.initCommands())
+
+    def initCommands(self):
+        return ()
+
+    def periodCommand(self, ms):
+        # The command that sets the time between motion frames, or None when it is fixed.
+        return None
+
+    def isDataPacket(self,data):
+        return len(data) > 0 and self.dispatch[data[0]] is not None
+
+    def processData(self,data):
+        decode = self.dispatch[data[0]]
+        if decode is not None:
+            decode(data)
+
+    def setMotion(self, x, y, z, rx, ry, rz):
+        # raw axes in device order
+        lock.acquire()
+        axisMap = self.axisMap
+        polarity = self.polarityXYZ
+        xyz[axisMap[0]] = polarity[0]*x
+        xyz[axisMap[1]] = polarity[1]*y
+        xyz[axisMap[2]] = polarity[2]*z
+        polarity = self.polarityRXYZ
+        rxyz[axisMap[0]] = polarity[0]*rx
+        rxyz[axisMap[1]] = polarity[1]*ry
+        rxyz[axisMap[2]] = polarity[2]*rz
+        publishMotion()
+        lock.release()
+        dataRate.frame(x or y or z or rx or ry or rz)
+
+    def setButtons(self, b):
+        global buttons
+        lock.acquire()
+        buttons = b
+        publishButtons()
+        lock.release()
+
         
 def trim(x):
     if trimValue == 0:
@@ -77,53 +207,223 @@ def trim(x):
         if x > trimValue:
             return trimValue
     return x        
+
+def publishMotion():
+    # Call with lock held after changing xyz/rxyz. The report values are trimmed here, once
+    # per serial frame, so that building a report on every poll allocates nothing.
+    global motionCount
+    motionCount += 1
+    reportAxes[0] = trim(xyz[outAxisMap[0]])
+    reportAxes[1] = trim(xyz[outAxisMap[1]])
+    reportAxes[2] = trim(xyz[outAxisMap[2]])
+    reportAxes[3] = trim(rxyz[outAxisMap[0]])
+    reportAxes[4] = trim(rxyz[outAxisMap[1]])
+    reportAxes[5] = trim(rxyz[outAxisMap[2]])
+    if predictor is not None:
+        predictor.add(perf_counter(), xyz, rxyz)
+    if sharedWriter is not None:
+        publishShared()
+    for e in consumers:
+        e.set()
+
+class MotionPredictor(object):
+    # Estimates the report axes between serial frames, which arrive only every ~20 ms at 9600
+    # baud: each axis goes on from its newest value with the slope of a least-squares line
+    # through the last `history` frames, for at most `horizon` seconds after the newest frame.
+    # Once a frame shows the ball at rest, or no frame came for PREDICT_GAP (models that only
+    # send changes), the estimate is the newest frame itself.
+    def __init__(self, horizon, history=PREDICT_HISTORY):
+        self.horizon = horizon
+        self.history = history
+        self.times = [0.0] * history
+        self.values = [[0] * 6 for i in range(history)] # signed axes in report order
+        self.count = 0
+        self.newest = self.values[0]
+        self.velocity = [0.0] * 6 # per second
+        self.estimate = [0] * 6 # trimmed like reportAxes
+
+    def add(self, t, xyz, rxyz):
+        # Call with lock held after a frame.
+        if self.count and t - self.times[(self.count - 1) % self.history] > PREDICT_GAP:
+            self.count = 0 # the ball was at rest; older frames say nothing about this motion
+        i = self.count % self.history
+        self.count += 1
+        self.times[i] = t
+        v = self.newest = self.values[i]
+        v[0], v[1], v[2] = xyz[outAxisMap[0]], xyz[outAxisMap[1]], xyz[outAxisMap[2]]
+        v[3], v[4], v[5] = rxyz[outAxisMap[0]], rxyz[outAxisMap[1]], rxyz[outAxisMap[2]]
+        n = min(self.count, self.history)
+        if n < 2 or not any(v):
+            self.velocity[:] = [0.0] * 6 # the ball was let go: no overshoot past the rest position
+            return
+        times = self.times[:n]
+        mean = sum(times) / n
+        spread = sum((t - mean) ** 2 for t in times)
+        for axis in range(6):
+            if spread > 0:
+                self.velocity[axis] = sum((times[k] - mean) * self.values[k][axis] for k in range(n)) / spread
+            else:
+                self.velocity[axis] = 0.0
+
+    def predict(self, now):
+        # Call with lock held; returns the estimate list, which the next call overwrites.
+        if not self.count:
+            return reportAxes
+        dt = now - self.times[(self.count - 1) % self.history]
+        if dt >= PREDICT_GAP:
+            dt = 0 # the ball stopped where the newest frame says
+        elif dt > self.horizon:
+            dt = self.horizon
+        newest = self.newest
+        velocity = self.velocity
+        for axis in range(6):
+            self.estimate[axis] = trim(max(-0x8000, min(0x7FFF, int(round(newest[axis] + velocity[axis] * dt)))))
+        return self.estimate
+
+    def next_change(self, now):
+        # Seconds until the estimate changes: a poll while it moves, then once more when it
+        # falls back to the newest frame. None once it is the newest frame.
+        if not self.count or not any(self.velocity):
+            return None
+        dt = now - self.times[(self.count - 1) % self.history]
+        if dt < self.horizon:
+            return PREDICT_INTERVAL
+        if dt < PREDICT_GAP:
+            return PREDICT_GAP - dt
+        return None
+
+def publishButtons():
+    # Call with lock held after changing buttons. Every state is queued, so a press and
+    # release between two polls still reach each host as two reports (see next_buttons).
+    global buttonsCount
+    buttonsCount += 1
+    buttonQueue[buttonsCount % BUTTON_QUEUE_SIZE] = buttons
+    if sharedWriter is not None:
+        publishShared()
+    for e in consumers:
+        e.set()
+
+def addConsumer(e):
+    # Every host's report thread is woken by each update. The tuple is replaced rather than
+    # changed, so publishMotion can go through it while a host connects or leaves.
+    global consumers
+    lock.acquire()
+    consumers = consumers + (e,)
+    lock.release()
+
+def removeConsumer(e):
+    global consumers
+    lock.acquire()
+    consumers = tuple(c for c in consumers if c is not e)
+    lock.release()
+
+def publishShared():
+    # In the ingest process: hand the state to the USB/IP process through shared memory.
+    sharedWriter.write(perf_counter(), motionCount, buttonsCount, xyz, rxyz, buttons)
     
-def haveResponse(r, startsWith=False):
-    t0 = time()
-    while time() < t0+COMMAND_TIMEOUT:
-        conn.timeout = COMMAND_TIMEOUT
-        line = conn.read_until(b'\r', len(r)+1)
-        conn.timeout = TIMEOUT
-        if ( startsWith and line.startsWith(r) ) or line == r + b'\r':
-            return True
-    return False
-            
-def confirmWrite(out, confirmation=None, startsWith=False):
-    if confirmation is None:
-        confirmation = out
+# Init commands are (out, confirmation, startsWith). The whole batch goes out in one
+# write, in the given order, and acknowledgements are matched in any order; a confirmation
+# of None means the device echoes the command and False means no acknowledgement is expected.
+class CommandBatch(object):
+    def __init__(self, commands):
+        self.exact = {}
+        self.prefixes = []
+        self.pending = []
+        self.commands = []
+        self.confirmed = set()
+        for out, confirmation, startsWith in commands:
+            self.commands.append(out)
+            if confirmation is False:
+                continue
+            if confirmation is None:
+                confirmation = out
+            self.pending.append(out)
+            if startsWith:
+                self.prefixes.append((confirmation, out))
+            else:
+                self.exact[confirmation] = out
+
+    def confirm(self, line):
+        out = self.exact.pop(line, None)
+        if out is None:
+            for i in range(len(self.prefixes)):
+                if line.startswith(self.prefixes[i][0]):
+                    out = self.prefixes.pop(i)[1]
+                    break
+        if out is not None:
+            self.pending.remove(out)
+            self.confirmed.add(out)
+        return out
+
+    def retry(self):
+        # What to write again: everything after the last confirmed command that precedes the
+        # first unconfirmed one, so that commands without acknowledgement which were lost along
+        # with a handshake go out again, still after it.
+        first = self.commands.index(self.pending[0])
+        start = 0
+        for i in range(first):
+            if self.commands[i] in self.confirmed:
+                start = i + 1
+        return self.commands[start:]
+
+def confirmWrites(commands):
+    batch = CommandBatch(commands)
+    out = batch.commands # a handshake such as X003's hv must still precede what follows it
     for i in range(3):
-        conn.reset_input_buffer()
-        conn.write(out+b'\r')
-        if haveResponse(confirmation, startsWith=startsWith):
-            print("Confirmed command "+out.decode())
+        conn.write(b''.join(c + b'\r' for c in out))
+        partial = b''
+        t1 = time() + COMMAND_TIMEOUT
+        while batch.pending and time() < t1:
+            conn.timeout = max(0.01, t1 - time())
+            partial += conn.read(max(1, conn.in_waiting))
+            lines = partial.split(b'\r')
+            partial = lines.pop()
+            for line in lines:
+                confirmed = batch.confirm(line)
+                if confirmed is not None:
+                    serialLog.debug("Confirmed command %s", confirmed.decode())
+        conn.timeout = TIMEOUT
+        if not batch.pending:
             return
-    raise serial.SerialException("Cannot confirm "+out.decode())
-    
+        out = batch.retry()
+    raise serial.SerialException("Cannot confirm "+", ".join(c.decode() for c in batch.pending))
+
+def openPort():
+    # Also on every reconnect, so --low-latency holds for the whole session.
+    c = None
+    if port is not None:
+        serialLog.info("Opening %s", port)
+        c = serial.Serial(port=port,baudrate=9600,timeout=TIMEOUT)
+    else:
+        for p in serial.tools.list_ports.comports():
+            if p.description.lower().startswith(description.lower()):
+                serialLog.info("Opening %s", str(p))
+                c = serial.Serial(port=p.device,baudrate=9600,timeout=TIMEOUT)
+                serialLog.info("Opened")
+                break
+    if c is not None and lowLatency:
+        realtime.setLowLatency(c)
+    return c
+
 def persistentOpen():
-    global conn,running
+    global conn,running,currentMouse
     conn = None
-    print("Trying to open serial connection")
+    serialLog.info("Trying to open serial connection")
     while running and conn is None:
         try:
-            if port is not None:
-                print("Opening "+port)
-                conn = serial.Serial(port=port,baudrate=9600,timeout=TIMEOUT)
-            else:
-                for p in serial.tools.list_ports.comports():
-                    if p.description.lower().startswith(description.lower()):
-                        print("Opening "+str(p))
-                        conn = serial.Serial(port=p.device,baudrate=9600,timeout=TIMEOUT)
-                        print("Opened")
-                        break
+            conn = openPort()
             if conn is not None:
                 sleep(1)
                 conn.reset_input_buffer()
-                print("Initializing serial connection to "+currentMouse.name)
+                if autoDetect:
+                    currentMouse = detectModel()
+                serialLog.info("Initializing serial connection to %s", currentMouse.name)
                 currentMouse.init()
+                dataRate.reset()
                 return
             sleep(0.5)
-        except serial.SerialException as e:
-            print("Error "+str(e))
+        except SerialErrors as e:
+            serialLog.warning("Error %s", str(e))
             if conn is not None:
                 try:
                     conn.close()
@@ -132,92 +432,348 @@ def persistentOpen():
             conn = None
             sleep(0.5)
 
+def clearState():
+    global xyz,rxyz,buttons
+    lock.acquire()
+    xyz = [0,0,0]
+    rxyz = [0,0,0]
+    publishMotion()
+    if buttons:
+        buttons = 0
+        publishButtons()
+    lock.release()
+
+def stillConfigured():
+    # A device that kept its configuration across the drop is still streaming packets
+    t1 = time() + RECONNECT_PROBE_TIME
+    conn.timeout = RECONNECT_PROBE_TIME
+    line = b''
+    try:
+        while time() < t1:
+            c = conn.read()
+            if c == b'\r':
+                if currentMouse.isDataPacket(line):
+                    return True
+                line = b''
+            elif len(c) == 1 and len(line) < 256:
+                line += c
+    finally:
+        conn.timeout = TIMEOUT
+    return False
+
+def reconnect(reason):
+    global conn
+    t0 = time()
+    serialLog.warning("Reconnecting after %s", reason)
+    metrics['serialDrops'] += 1
+    clearState()
+    if conn is not None:
+        try:
+            conn.close()
+        except:
+            pass
+        conn = None
+    delay = 0
+    while running:
+        if delay:
+            sleep(delay)
+        delay = min(RECONNECT_MAX_DELAY, max(RECONNECT_MIN_DELAY, delay * 2))
+        try:
+            conn = openPort()
+            if conn is None:
+                continue
+            if stillConfigured():
+                serialLog.info("Device still configured, skipping initialization")
+            else:
+                serialLog.info("Initializing serial connection to %s", currentMouse.name)
+                currentMouse.init()
+                dataRate.reset() # init set dataPeriod again
+                metrics['reinitializations'] += 1
+        except SerialErrors as e:
+            serialLog.warning("Error %s", str(e))
+            if conn is not None:
+                try:
+                    conn.close()
+                except:
+                    pass
+            conn = None
+            continue
+        recovery = time() - t0
+        metrics['reconnects'] += 1
+        metrics['lastRecoveryTime'] = recovery
+        metrics['maxRecoveryTime'] = max(metrics['maxRecoveryTime'], recovery)
+        metrics['totalDowntime'] += recovery
+        serialLog.info("Reconnected in %.3f s", recovery)
+        return
+
 def persistentRead():
     global conn,running
     while running:
         try:
             if conn == None:
-                raise serial.SerialException
+                raise serial.SerialException("no connection")
             d = conn.read()
             if len(d) == 1:
                 return d
-        except serial.SerialException as e:
-            print("Reconnecting after "+str(e))
-            try:
-                conn.close()
-            except:
-                pass
-            conn = None
-            sleep(0.5)
-            persistentOpen()
+        except SerialErrors as e:
+            reconnect(str(e))
         except Exception as e:
-            print(str(e))
+            serialLog.warning("%s", str(e))
     return None
+
+def statsLoop():
+    while running:
+        sleep(statsInterval)
+        dataRate.count(perf_counter())
+        statsLog.info("%s", ", ".join(k + "=" + (("%.3f" % v) if isinstance(v, float) else str(v)) for k,v in sorted(metrics.items())))
     
+def queueSerialCommand(command):
+    # Called from URB processing, so it never waits for the serial port: a command that
+    # does not fit in the queue is dropped, as a late beep is worse than none.
+    if serialCommands is None:
+        return
+    try:
+        serialCommands.put_nowait(command)
+    except Full:
+        metrics['serialCommandDrops'] += 1
+
+def serialWriteLoop():
+    while running:
+        try:
+            command = serialCommands.get(timeout=0.5)
+        except Empty:
+            continue
+        if command is BEEP: # the model is only known where the serial port is, see -M auto
+            command = currentMouse.beepCommand
+        c = conn
+        try:
+            if c is None:
+                raise serial.SerialException("no connection")
+            c.write(command + b'\r')
+        except SerialErrors:
+            metrics['serialCommandDrops'] += 1
+
+class DataRate(object):
+    # Counts the motion frames that arrive (metrics['frameRate']) and, with -f auto, sets the
+    # SpaceBall's data period: dataPeriod while the ball moves and IDLE_PERIOD once it rested
+    # for IDLE_AFTER, which saves serial bandwidth and decoding. The first frame of the next
+    # motion can then arrive up to IDLE_PERIOD late.
+    def __init__(self):
+        self.windowStart = perf_counter()
+        self.frames = 0
+        self.period = dataPeriod
+        self.lastMotion = 0.0
+        self.lastFrame = 0.0
+
+    def reset(self):
+        # Call after the SpaceBall was initialized, which sets dataPeriod.
+        self.period = dataPeriod
+        self.lastMotion = self.windowStart = perf_counter()
+        self.frames = 0
+        metrics['dataPeriod'] = dataPeriod if currentMouse.periodCommand(dataPeriod) is not None else 0
+
+    def frame(self, moving):
+        now = perf_counter()
+        self.frames += 1
+        self.lastFrame = now
+        if now - self.windowStart >= FRAME_RATE_WINDOW:
+            self.count(now)
+        if not adaptivePeriod:
+            return
+        if moving:
+            self.lastMotion = now
+            if self.period != dataPeriod:
+                self.setPeriod(dataPeriod)
+        elif self.period == dataPeriod and now - self.lastMotion >= IDLE_AFTER:
+            self.setPeriod(IDLE_PERIOD)
+
+    def count(self, now):
+        # Also called by statsLoop, so that the rate drops to 0 once the frames stop coming
+        # instead of showing the last one measured.
+        if now - self.lastFrame > STALE_PERIODS * self.period / 1000.0:
+            metrics['frameRate'] = 0.0
+        elif now - self.windowStart >= FRAME_RATE_WINDOW:
+            metrics['frameRate'] = self.frames / (now - self.windowStart)
+        else:
+            return
+        self.windowStart = now
+        self.frames = 0
+
+    def setPeriod(self, ms):
+        command = currentMouse.periodCommand(ms)
+        if command is None:
+            return
+        serialLog.debug("Data period %d ms", ms)
+        self.period = ms
+        queueSerialCommand(command)
+        metrics['dataPeriod'] = ms
+        metrics['periodChanges'] += 1
+
+dataRate = DataRate()
+
+SPACEBALL_MOTION = struct.Struct(">3x6h") # 'D', timer, then the six axes
+MAGELLAN_MOTION = struct.Struct(">6H")
+MAGELLAN_HEX = bytes(bytearray(b'0123456789abcdef'[c & 0xF] for c in range(256))) # nibble character -> hex digit
+
 class FLXOrX003(SerialSpaceMouse):
+    decoders = { b'D': 'decodeMotion' }
+
     def __init__(self,keyCommand=b'.',name="unknown"):
         super(FLXOrX003, self).__init__(axisMap=(0,2,1), polarityXYZ=(1,-1,-1), polarityRXYZ=(1,-1,-1),haveEscape=True,name=name)
         self.keyCommand = keyCommand
+        self.beepCommand = b'BcCcC' # short beep pattern, as libsball sends it
 
-    def init(self):
-        conn.write(b'\r')
+    def decodeMotion(self, data):
+        if len(data) == 15:
+            self.setMotion(*SPACEBALL_MOTION.unpack_from(data))
 
-    def processData(self,data):
-        global buttons,xyz,rxyz,newXYZ,newButtons,lock,event
-        if len(data) == 15 and data[0] == ord(b'D'):
-            lock.acquire()
-            xyz[self.axisMap[0]] = self.polarityXYZ[0]*FLX.get16(data, 3)
-            xyz[self.axisMap[1]] = self.polarityXYZ[1]*FLX.get16(data, 5)
-            xyz[self.axisMap[2]] = self.polarityXYZ[2]*FLX.get16(data, 7)
-            rxyz[self.axisMap[0]] = self.polarityRXYZ[0]*FLX.get16(data, 9)
-            rxyz[self.axisMap[1]] = self.polarityRXYZ[1]*FLX.get16(data, 11)
-            rxyz[self.axisMap[2]] = self.polarityRXYZ[2]*FLX.get16(data, 13)
-            newXYZ = True
-            event.set()
-            lock.release()
-        elif self.keyCommand == b'.' and len(data) == 3 and data[0] == ord(b'.'):
-            b = (data[2]&0xFF) | (data[1]&0xFF)<<8
-            b = ((b&0b111111) | ((b&~0b1111111)>>1)) & 0b111111111111;
-            lock.acquire()
-            buttons = ((b >> 9) | (b << 3)) & 0b111111111111
-            newButtons = True
-            event.set()
-            lock.release()        
-        elif self.keyCommand != b'.' and len(data) == 3 and data[0] == ord(self.keyCommand):
-            b = data[1]&0xFF
-            lock.acquire()
-            buttons = b
-            newButtons = True
-            event.set()
-            lock.release()        
-        
 class FLX(FLXOrX003):
+    decoders = { b'D': 'decodeMotion', b'.': 'decodeButtons' }
+    probe = (b'A271006', b'a271006', None)
+
     def __init__(self):
         super(FLX, self).__init__(keyCommand=b'.',name="SpaceBall 4000/5000FLX")
-        
-    def init(self):
-        super(FLX, self).init()
-        confirmWrite(b"P20")
-        confirmWrite(b"Y"+sensitivity)
-        confirmWrite(b"A271006", b"a271006E")
-        confirmWrite(b"M")
-        
+
+    def periodCommand(self, ms):
+        return b"P" + str(int(ms)).encode()
+
+    def initCommands(self):
+        return ((self.periodCommand(dataPeriod), None, False),
+                (b"Y"+sensitivity, None, False),
+                (b"A271006", b"a271006E", False),
+                (b"M", None, False))
+
+    def decodeButtons(self, data):
+        if len(data) == 3:
+            b = (data[2]&0xFF) | (data[1]&0xFF)<<8
+            b = ((b&0b111111) | ((b&~0b1111111)>>1)) & 0b111111111111
+            self.setButtons(((b >> 9) | (b << 3)) & 0b111111111111)
+
 class X003(FLXOrX003):
+    decoders = { b'D': 'decodeMotion', b'K': 'decodeButtons' }
+    probe = (b'hv', b'Hv', None)
+    buttonCount = 8
+
     def __init__(self):
         super(X003, self).__init__(keyCommand=b'K',name="SpaceBall x003")
-        
-    def init(self):
-        super(X003, self).init()
-        confirmWrite(b"hv", b"Hv", startsWith=True)
-        conn.write(b'FB' + (b'@' if sensitivity==b'S' else b'p') + '\r')
-        conn.write(b'MSS\r')
-        conn.write(b'CB\x01\r')
+
+    def initCommands(self):
+        return ((b"hv", b"Hv", True),
+                (b'FB' + (b'@' if sensitivity==b'S' else b'p'), False, False),
+                (b'MSS', False, False),
+                (b'CB\x01', False, False))
+
+    def decodeButtons(self, data):
+        if len(data) == 3:
+            self.setButtons(data[1]&0xFF)
+
+class Spaceball2003(FLXOrX003):
+    # The 2003 has buttons 1-7, the pick button and the rezero button, packed as libsball
+    # describes: 1-4 in the second byte, 5-7, pick and rezero in the first.
+    decoders = { b'D': 'decodeMotion', b'K': 'decodeButtons' }
+    probe = (b'hv', b'Hv', b'2003')
+    buttonCount = 9
+
+    def __init__(self):
+        super(Spaceball2003, self).__init__(keyCommand=b'K',name="Spaceball 2003")
+
+    def initCommands(self):
+        s = b'@' if sensitivity==b'S' else b'p'
+        return ((b'CB', False, False),
+                (b'NT', False, False),
+                (b'FT' + s, False, False),
+                (b'FR' + s, False, False),
+                (b'P@r@r', False, False),
+                (b'MSSV', False, False),
+                (b'Z', False, False))
+
+    def decodeButtons(self, data):
+        if len(data) == 3:
+            first = data[1]
+            self.setButtons((data[2] & 0x0F) | ((first & 0x07) << 4) | ((first & 0x10) << 3) |
+                            (0x100 if first & 0x28 else 0))
+
+class Magellan(SerialSpaceMouse):
+    # Magellan/SpaceMouse Classic: printable packets in which every character carries a
+    # nibble in its low four bits; axes are 16 bits offset by 0x8000. 8N2, no escapes.
+    decoders = { b'd': 'decodeMotion', b'k': 'decodeButtons' }
+    wakeup = b'\r\r'
+    probe = (b'vQ', b'v', None)
+    stopbits = 2
+    buttonCount = 9
+
+    def __init__(self):
+        super(Magellan, self).__init__(axisMap=(0,2,1), polarityXYZ=(1,-1,-1), polarityRXYZ=(1,-1,-1),haveEscape=False,name="Magellan/SpaceMouse Classic")
+        self.beepCommand = b'b9'
+
+    def initCommands(self):
+        return ((b'm0', False, False),
+                (b'pAA', False, False),
+                (b'q00', False, False),
+                (b'nH', False, False),
+                (b'vQ', b'v', True),
+                (b'm3', False, False))
+
+    def decodeMotion(self, data):
+        if len(data) == 25:
+            x, y, z, rx, ry, rz = MAGELLAN_MOTION.unpack(binascii.unhexlify(data[1:25].translate(MAGELLAN_HEX)))
+            self.setMotion(x - 0x8000, y - 0x8000, z - 0x8000, rx - 0x8000, ry - 0x8000, rz - 0x8000)
+
+    def decodeButtons(self, data):
+        if len(data) == 4:
+            self.setButtons((data[1] & 0xF) | (data[2] & 0xF) << 4 | (data[3] & 0xF) << 8)
+
+# -M names, in the order detectModel tries them: the 2003 before the x003, whose probe
+# matches any Hv reply.
+MODELS = ((('flx', '4000', '5000'), FLX),
+          (('2003',), Spaceball2003),
+          (('x003', '3003'), X003),
+          (('magellan', 'spacemouse'), Magellan))
+
+def findModel(name):
+    name = name.lower()
+    for names, model in MODELS:
+        for n in names:
+            if n in name:
+                return model
+    return None
+
+def detectModel():
+    # Sends every model's probe at once and takes the first model whose reply comes back.
+    probes = []
+    for names, model in MODELS:
+        if model.probe[0] not in probes:
+            probes.append(model.probe[0])
+    conn.write(b'\r' + b''.join(p + b'\r' for p in probes))
+    lines = []
+    partial = b''
+    t1 = time() + COMMAND_TIMEOUT
+    while time() < t1:
+        conn.timeout = max(0.01, t1 - time())
+        partial += conn.read(max(1, conn.in_waiting))
+        more = partial.split(b'\r')
+        partial = more.pop()
+        lines += more
+        for names, model in MODELS:
+            if any(model.recognizes(line) for line in lines):
+                conn.timeout = TIMEOUT
+                mouse = model()
+                serialLog.info("Detected %s", mouse.name)
+                return mouse
+    conn.timeout = TIMEOUT
+    raise serial.SerialException("No known model answered the probes")
+
+def tuneThread(role):
+    # -A and -R for the calling thread and the threads it starts later.
+    if cpuAffinity or realtimePolicy is not None:
+        realtime.tune(role, cpuAffinity, realtimePolicy, realtimePriority)
 
 def serialLoop():
     global conn,running
     overflow = False
     buffer = bytearray()
     escape = False
+    tuneThread('serial')
     persistentOpen()
     while running:
         c = persistentRead()
@@ -225,6 +781,8 @@ def serialLoop():
             break
         if c == b'\r':
             if len(buffer):
+                if serialLog.isEnabledFor(logging.DEBUG):
+                    serialLog.debug("Frame %r", bytes(buffer))
                 currentMouse.processData(buffer)
                 buffer = bytearray()
             continue         
@@ -244,35 +802,27 @@ def serialLoop():
             
 def emulateLoop():
     def emit(x,y,z,rx,ry,rz,buttonsToPress,t):
-        global xyz,rxyz,newXYZ,lock,event,newButtons,buttons
+        global xyz,rxyz,lock,buttons
         lock.acquire()
         xyz = (x,y,z)
         rxyz = (rx,ry,rz)
-        newXYZ = True
+        publishMotion()
         lock.release()
-        print(xyz,rxyz)
+        emulateLog.info("%s %s", xyz, rxyz)
         
         if buttonsToPress:
             lock.acquire()
             buttons = buttonsToPress
-            newButtons = True
-            event.set()
+            publishButtons()
             lock.release()
             sleep(0.5)
             
-        t1 = time() + t
-        while time()<t1:
-            lock.acquire()
-            newXYZ = True
-            event.set()
-            lock.release()
-            sleep(0.1)
+        sleep(t)
             
         if buttonsToPress:
             lock.acquire()
             buttons = 0
-            newButtons = True
-            event.set()
+            publishButtons()
             lock.release()
             sleep(0.5)
     
@@ -286,8 +836,114 @@ def emulateLoop():
         emit(0,0,100,0,0,0, 1<12, 3)
         emit(0,0,-100,0,0,0, 0, 3)
 
+def ingestMain(sharedName, config, changed=None):
+    # Entry point of the serial ingest process (-I): decode the serial stream here and
+    # publish the result through shared memory, away from the USB/IP process's GIL.
+    global sharedWriter,port,description,sensitivity,currentMouse,autoDetect,statsInterval,serialCommands,verbosity,predictor
+    global dataPeriod,adaptivePeriod,cpuAffinity,realtimePolicy,realtimePriority,lowLatency,gcMode
+    (port, description, sensitivity, model, autoDetect, statsInterval, serialCommands, verbosity, dataPeriod, adaptivePeriod,
+     cpuAffinity, realtimePolicy, realtimePriority, lowLatency, gcMode) = config
+    predictor = None # a forked copy; the USB/IP process predicts
+    logs.setup(verbosity=verbosity)
+    profile = profiler.SamplingProfiler()
+    profiler.onSignal(lambda command: profiler.control(profile, command), profiler.FORWARDED) # from the USB/IP process
+    currentMouse = globals()[model]()
+    sharedWriter = SharedState(name=sharedName, create=False, changed=changed)
+    if statsInterval:
+        t = threading.Thread(target=statsLoop, name='stats')
+        t.daemon = True
+        t.start()
+    if serialCommands is not None:
+        t = threading.Thread(target=serialWriteLoop, name='serial write')
+        t.daemon = True
+        t.start()
+    gctune.instrument(metrics)
+    gctune.settle(gcMode)
+    serialLoop()
+
+def sharedStateLoop(state):
+    # In the USB/IP process: mirror what the ingest process publishes into the usual state.
+    global xyz,rxyz,buttons
+    seen = 0
+    lastMotion = 0
+    lastButtons = 0
+    tuneThread('serial')
+    while running:
+        if state.version() == seen:
+            state.wait(SHARED_WAIT)
+            continue
+        seen, values = state.read()
+        lock.acquire()
+        if values[1] != lastMotion:
+            lastMotion = values[1]
+            xyz = list(values[3:6])
+            rxyz = list(values[6:9])
+            publishMotion()
+        if values[2] != lastButtons:
+            if values[2] - lastButtons > 1: # replay the button frames in between
+                history = state.buttonHistory()
+                for count in range(max(lastButtons + 1, values[2] - SHARED_EDGES + 1), values[2]):
+                    buttons = history[count % SHARED_EDGES]
+                    publishButtons()
+            lastButtons = values[2]
+            buttons = values[9]
+            publishButtons()
+        lock.release()
+
+def injectLoop(address):
+    # Data source for -i: state pushed by other programs as injection.MESSAGE datagrams.
+    # Everything queued since the last pass is drained and only the newest motion is
+    # published, so a fast sender costs one report, not one per message; every change of
+    # the buttons is published, so that no click is lost.
+    global xyz,rxyz,buttons,injectStamp
+    tuneThread('serial')
+    sock = injection.openReceiver(address)
+    sock.setblocking(False)
+    message = bytearray(injection.MESSAGE.size + 1)
+    unpack = injection.MESSAGE.unpack_from
+    size = injection.MESSAGE.size
+    metrics.update({ 'injected': 0, 'coalesced': 0, 'injectErrors': 0 })
+    injectLog.info("Listening for injected reports on %s", address)
+    while running:
+        select.select([sock], [], [], 0.5)
+        motion = None
+        pressed = []
+        received = 0
+        while True:
+            try:
+                n = sock.recv_into(message)
+            except socket.error:
+                break # nothing left (or a Windows UDP "port unreachable" for an earlier reply)
+            if n != size or message[0] != injection.VERSION:
+                metrics['injectErrors'] += 1
+                continue
+            values = unpack(message)
+            received += 1
+            if values[1] & injection.MOTION:
+                motion = values
+            if values[1] & injection.BUTTONS:
+                pressed.append(values[10] & injection.BUTTON_MASK) # more would not fit the report
+        if not received:
+            continue
+        metrics['injected'] += received
+        metrics['coalesced'] += received - 1
+        lock.acquire()
+        if motion is not None:
+            injectStamp = motion[3]
+            # 32-bit on the wire, 16-bit in trim(), which would wrap 40000 to a negative value
+            xyz = [max(injection.AXIS_MIN, min(injection.AXIS_MAX, v)) for v in motion[4:7]]
+            rxyz = [max(injection.AXIS_MIN, min(injection.AXIS_MAX, v)) for v in motion[7:10]]
+            publishMotion()
+        for b in pressed:
+            if b != buttons:
+                buttons = b
+                publishButtons()
+        lock.release()
+    injection.closeReceiver(sock, address)
+
         
 currentMouse = FLX()
+autoDetect = False # -M auto: currentMouse is replaced by detectModel when the port opens
 
 #if os.name == 'nt' and builtins.USBIP_VERSION == 262:
 #    windows_utils.disableClose()
@@ -296,95 +952,111 @@ currentMouse = FLX()
 
 # HID Configuration
 
-if trimValue >= 32768 or trimValue == 0:
-    logicalMin = -32768
-    logicalMax = 32767
-else:
-    logicalMin = -trimValue
-    logicalMax = trimValue
+LED_OUTPUT_REPORT = [
+                  0x05, 0x08,           #  Usage Page (LEDs)
+                  0x09, 0x4B,           #  Usage (Generic Indicator)
+                  0x15, 0x00,           #   Logical Minimum (0)
+                  0x25, 0x01,           #    Logical Maximum (1)
+                  0x85, 0x04,           #  Report ID
+                  0x75, 0x01,           #    Report Size (1)
+                  0x95, 0x01,           #    Report Count (1)
+                  0x91, 0x02,           #    Output (variable,absolute)
+                  0x75, 0x07,           #    Report Size (7)
+                  0x91, 0x03,           #    Output (constant) padding
+]
+
+def makeDescriptor():
+    if trimValue >= 32768 or trimValue == 0:
+        logicalMin = -32768
+        logicalMax = 32767
+    else:
+        logicalMin = -trimValue
+        logicalMax = trimValue
     
-minLow = logicalMin & 0xFF
-minHigh = (logicalMin & 0xFF00) >> 8
-maxLow = logicalMax & 0xFF
-maxHigh = (logicalMax & 0xFF00) >> 8
-
-if compatible:
-    descriptor = [
-              0x05, 0x01,           #  Usage Page (Generic Desktop)  
-              0x09, 0x04 if joystick else 0x08,           #  0x08: Usage (Multi-Axis)  
-              0xa1, 0x01,           #  Collection (Application)  
-              0xa1, 0x00,           # Collection (Physical)
-              0x85, 0x01,           #  Report ID 
-              0x16, minLow, minHigh,        #logical minimum (-500)
-              0x26, maxLow, maxHigh,        #logical maximum (500)
-              0x36, 0x00, 0x80,              # Physical Minimum (-32768)
-              0x46, 0xff, 0x7f,              #Physical Maximum (32767)
-              0x09, 0x30,           #    Usage (X)  
-              0x09, 0x31,           #    Usage (Y)  
-              0x09, 0x32,           #    Usage (Z)  
-              0x75, 0x10,           #    Report Size (16)  
-              0x95, 0x03,           #    Report Count (3)  
-              0x81, 0x02,           #    Input (variable,absolute)  
-              0xC0,                 #  End Collection  
-              0xa1, 0x00,            # Collection (Physical)
-              0x85, 0x02,         #  Report ID 
-              0x16, minLow, minHigh,        #logical minimum (-500)
-              0x26, maxLow, maxHigh,        #logical maximum (500)
-              0x36,0x00,0x80,              # Physical Minimum (-32768)
-              0x46,0xff,0x7f,              #Physical Maximum (32767)
-              0x09, 0x33,           #    Usage (RX)  
-              0x09, 0x34,           #    Usage (RY)  
-              0x09, 0x35,           #    Usage (RZ)  
-              0x75, 0x10,           #    Report Size (16)  
-              0x95, 0x03,           #    Report Count (3)  
-              0x81, 0x02,           #    Input (variable,absolute)  
-              0xC0,                           #  End Collection     
+    minLow = logicalMin & 0xFF
+    minHigh = (logicalMin & 0xFF00) >> 8
+    maxLow = logicalMax & 0xFF
+    maxHigh = (logicalMax & 0xFF00) >> 8
+
+    if compatible:
+        return [
+                  0x05, 0x01,           #  Usage Page (Generic Desktop)  
+                  0x09, 0x04 if joystick else 0x08,           #  0x08: Usage (Multi-Axis)  
+                  0xa1, 0x01,           #  Collection (Application)  
+                  0xa1, 0x00,           # Collection (Physical)
+                  0x85, 0x01,           #  Report ID 
+                  0x16, minLow, minHigh,        #logical minimum (-500)
+                  0x26, maxLow, maxHigh,        #logical maximum (500)
+                  0x36, 0x00, 0x80,              # Physical Minimum (-32768)
+                  0x46, 0xff, 0x7f,              #Physical Maximum (32767)
+                  0x09, 0x30,           #    Usage (X)  
+                  0x09, 0x31,           #    Usage (Y)  
+                  0x09, 0x32,           #    Usage (Z)  
+                  0x75, 0x10,           #    Report Size (16)  
+                  0x95, 0x03,           #    Report Count (3)  
+                  0x81, 0x02,           #    Input (variable,absolute)  
+                  0xC0,                 #  End Collection  
+                  0xa1, 0x00,            # Collection (Physical)
+                  0x85, 0x02,         #  Report ID 
+                  0x16, minLow, minHigh,        #logical minimum (-500)
+                  0x26, maxLow, maxHigh,        #logical maximum (500)
+                  0x36,0x00,0x80,              # Physical Minimum (-32768)
+                  0x46,0xff,0x7f,              #Physical Maximum (32767)
+                  0x09, 0x33,           #    Usage (RX)  
+                  0x09, 0x34,           #    Usage (RY)  
+                  0x09, 0x35,           #    Usage (RZ)  
+                  0x75, 0x10,           #    Report Size (16)  
+                  0x95, 0x03,           #    Report Count (3)  
+                  0x81, 0x02,           #    Input (variable,absolute)  
+                  0xC0,                           #  End Collection     
               
-              0xa1, 0x00,            # Collection (Physical)
-              0x85, 0x03,         #  Report ID 
-              0x15, 0x00,           #   Logical Minimum (0)  
-              0x25, 0x01,           #    Logical Maximum (1) 
-              0x75, 0x01,           #    Report Size (1)  
-              0x95, 32,           #    Report Count (24) 
-              0x05, 0x09,           #    Usage Page (Button)  
-              0x19, 1,           #    Usage Minimum (Button #1)  
-              0x29, 32,           #    Usage Maximum (Button #24)  
-              0x81, 0x02,           #    Input (variable,absolute)  
-              0xC0,
-              0xC0,]
-else:
-    descriptor = [
-              0x05, 0x01,           #  Usage Page (Generic Desktop)  
-              0x09, 0x04 if joystick else 0x08,           #  0x08: Usage (Multi-Axis)  
-              0xa1, 0x01,           #  Collection (Application)  
-              0xa1, 0x00,           # Collection (Physical)
-              0x85, 0x01,           #  Report ID 
-              0x16, minLow, minHigh,        #logical minimum (-500)
-              0x26, maxLow, maxHigh,        #logical maximum (500)
-              0x36, 0x00, 0x80,              # Physical Minimum (-32768)
-              0x46, 0xff, 0x7f,              #Physical Maximum (32767)
-              0x09, 0x30,           #    Usage (X)  
-              0x09, 0x31,           #    Usage (Y)  
-              0x09, 0x32,           #    Usage (Z)  
-              0x09, 0x33,           #    Usage (RX)  
-              0x09, 0x34,           #    Usage (RY)  
-              0x09, 0x35,           #    Usage (RZ)  
-              0x75, 0x10,           #    Report Size (16)  
-              0x95, 0x06,           #    Report Count (6)  
-              0x81, 0x02,           #    Input (variable,absolute)  
-              0xC0,          
-              0xa1, 0x00,           # Collection (Physical)
-              0x85, 0x03,           #  Report ID 
-              0x15, 0x00,           #   Logical Minimum (0)  
-              0x25, 0x01,           #    Logical Maximum (1) 
-              0x75, 0x01,           #    Report Size (1)  
-              0x95, 32,           #    Report Count (24) 
-              0x05, 0x09,           #    Usage Page (Button)  
-              0x19, 1,           #    Usage Minimum (Button #1)  
-              0x29, 32,           #    Usage Maximum (Button #24)  
-              0x81, 0x02,           #    Input (variable,absolute)  
-              0xC0,
-              0xC0,]
+                  0xa1, 0x00,            # Collection (Physical)
+                  0x85, 0x03,         #  Report ID 
+                  0x15, 0x00,           #   Logical Minimum (0)  
+                  0x25, 0x01,           #    Logical Maximum (1) 
+                  0x75, 0x01,           #    Report Size (1)  
+                  0x95, 32,           #    Report Count (24) 
+                  0x05, 0x09,           #    Usage Page (Button)  
+                  0x19, 1,           #    Usage Minimum (Button #1)  
+                  0x29, 32,           #    Usage Maximum (Button #24)  
+                  0x81, 0x02,           #    Input (variable,absolute)  
+                  0xC0,
+                  ] + LED_OUTPUT_REPORT + [
+                  0xC0,]
+    else:
+        return [
+                  0x05, 0x01,           #  Usage Page (Generic Desktop)  
+                  0x09, 0x04 if joystick else 0x08,           #  0x08: Usage (Multi-Axis)  
+                  0xa1, 0x01,           #  Collection (Application)  
+                  0xa1, 0x00,           # Collection (Physical)
+                  0x85, 0x01,           #  Report ID 
+                  0x16, minLow, minHigh,        #logical minimum (-500)
+                  0x26, maxLow, maxHigh,        #logical maximum (500)
+                  0x36, 0x00, 0x80,              # Physical Minimum (-32768)
+                  0x46, 0xff, 0x7f,              #Physical Maximum (32767)
+                  0x09, 0x30,           #    Usage (X)  
+                  0x09, 0x31,           #    Usage (Y)  
+                  0x09, 0x32,           #    Usage (Z)  
+                  0x09, 0x33,           #    Usage (RX)  
+                  0x09, 0x34,           #    Usage (RY)  
+                  0x09, 0x35,           #    Usage (RZ)  
+                  0x75, 0x10,           #    Report Size (16)  
+                  0x95, 0x06,           #    Report Count (6)  
+                  0x81, 0x02,           #    Input (variable,absolute)  
+                  0xC0,          
+                  0xa1, 0x00,           # Collection (Physical)
+                  0x85, 0x03,           #  Report ID 
+                  0x15, 0x00,           #   Logical Minimum (0)  
+                  0x25, 0x01,           #    Logical Maximum (1) 
+                  0x75, 0x01,           #    Report Size (1)  
+                  0x95, 32,           #    Report Count (24) 
+                  0x05, 0x09,           #    Usage Page (Button)  
+                  0x19, 1,           #    Usage Minimum (Button #1)  
+                  0x29, 32,           #    Usage Maximum (Button #24)  
+                  0x81, 0x02,           #    Input (variable,absolute)  
+                  0xC0,
+                  ] + LED_OUTPUT_REPORT + [
+                  0xC0,]
 
 class HIDClass(BaseStucture):
     _fields_ = [
@@ -399,148 +1071,372 @@ class HIDClass(BaseStucture):
     ]
 
 
-hid_class = HIDClass(bcdHID=0x0101,  
-                     bCountryCode=0x0,
-                     bNumDescriptors=0x1,
-                     bDescriptorType2=0x22,  # Report
-                     bDescriptionLengthLow=len(descriptor)&0xFF,
-                     bDescriptionLengthHigh=len(descriptor)>>8,
-                     )  
+def makeConfiguration(descriptor):
+    hid_class = HIDClass(bcdHID=0x0101,  
+                         bCountryCode=0x0,
+                         bNumDescriptors=0x1,
+                         bDescriptorType2=0x22,  # Report
+                         bDescriptionLengthLow=len(descriptor)&0xFF,
+                         bDescriptionLengthHigh=len(descriptor)>>8,
+                         )  
+
 
+    interface_d = InterfaceDescriptor(bAlternateSetting=0,
+                                      bNumEndpoints=1,
+                                      bInterfaceClass=3,  # class HID
+                                      bInterfaceSubClass=1,
+                                      bInterfaceProtocol=2,
+                                      iInterface=0)
 
-interface_d = InterfaceDescriptor(bAlternateSetting=0,
-                                  bNumEndpoints=1,
-                                  bInterfaceClass=3,  # class HID
-                                  bInterfaceSubClass=1,
-                                  bInterfaceProtocol=2,
-                                  iInterface=0)
+    end_point = EndPoint(bEndpointAddress=0x81,
+                         bmAttributes=0x3,
+                         wMaxPacketSize=8000,  # Little endian
+                         bInterval=0xFF)  # interval to report
 
-end_point = EndPoint(bEndpointAddress=0x81,
-                     bmAttributes=0x3,
-                     wMaxPacketSize=8000,  # Little endian
-                     bInterval=0xFF)  # interval to report
 
+    configuration = DeviceConfigurations(bConfigurationValue=0x1,
+                                         iConfiguration=0x0,  # No string
+                                         bmAttributes=0x80,  # valid self powered
+                                         bMaxPower=50)  # 100 mah current
 
-configuration = DeviceConfigurations(wTotalLength=0x2200,
-                                     bNumInterfaces=0x1,
-                                     bConfigurationValue=0x1,
-                                     iConfiguration=0x0,  # No string
-                                     bmAttributes=0x80,  # valid self powered
-                                     bMaxPower=50)  # 100 mah current
+    interface_d.descriptions = [hid_class]
+    interface_d.endpoints = [end_point]
+    configuration.interfaces = [interface_d]  # lengths and counts are filled in by generate_raw_configuration
+    return configuration
 
-interface_d.descriptions = [hid_class]  # Supports only one description
-interface_d.endpoints = [end_point]  # Supports only one endpoint
-configuration.interfaces = [interface_d]   # Supports only one interface
 
+AXES_REPORT = struct.Struct("<BHHHHHH")
+HALF_AXES_REPORT = struct.Struct("<BHHH")
+BUTTONS_REPORT = struct.Struct("<BBBBB")
 
 class USBHID(USBDevice):
-    vendorID = forceVendorID if forceVendorID is not None else (0x1EAF if joystick  else 0x46D)
-    productID = forceProductID if forceProductID is not None else 0xc62b
     bcdDevice = 0x200
     bcdUSB = 0x200
     bNumConfigurations = 0x1
-    bNumInterfaces = 0x1
     bConfigurationValue = 0x1
-    configurations = []
     bDeviceClass = 0x0
     bDeviceSubClass = 0x0
     bDeviceProtocol = 0x01
-    configurations = [configuration]  # Supports only one configuration
 
     def __init__(self):
+        self.vendorID = forceVendorID if forceVendorID is not None else (0x1EAF if joystick  else 0x46D)
+        self.productID = forceProductID if forceProductID is not None else 0xc62b
+        self.manufacturer = "3Dconnexion"
+        self.product = "SpaceBall joystick" if joystick else "SpaceMouse Pro"
+        self.serial = "SB0001"
+        self.descriptor = makeDescriptor()
+        self.report_descriptor = bytes(bytearray(self.descriptor))
+        self.configurations = [makeConfiguration(self.descriptor)]  # Supports only one configuration
         USBDevice.__init__(self)
         self.start_time = datetime.datetime.now()
         self.lastSend = -1
         self.seq = 0
+        self.reply = ReplyBuffer(AXES_REPORT.size)
+        self.sentAxes = [None] * 6
+        self.reset_reports()
+        self.reportAge = {1: 0, 2: 0, 3: 0}
+        self.sentTime = {1: 0.0, 2: 0.0, 3: 0.0}
+        self.idle = {1: 0.0, 2: 0.0, 3: 0.0} # seconds, derived from idle_rates
+        self.set_idle(0, 0) # report on change only, until the host asks otherwise
+        self.led = 0
+        self.protocol = 1 # report protocol
+        self.parked = collections.deque()
+        self.urb_lock = threading.Lock()
+        self.completer = None
+        self.event = threading.Event() # set on every update, see addConsumer
+        self.closed = False
         if compatible:
-            self.handle_data = self.handle_data_compatible
+            self.build_report = self.build_report_compatible
+            self.reportIDs = (1, 2, 3)
         else:
-            self.handle_data = self.handle_data_fast
+            self.build_report = self.build_report_fast
+            self.reportIDs = (1, 3)
 
     def generate_hid_report(self):
-        return bytes(bytearray(descriptor))
+        return self.report_descriptor
 
-    def handle_data_compatible(self, usb_req):
-        global newXYZ, newButtons, outState, event, lock
-        
-        event.wait(0.5)
-        
+    def current_report(self, reportID):
         lock.acquire()
-        if outState == 0:
-            if newXYZ or newButtons:
-                return_val = struct.pack("<BHHH", 1, trim(xyz[outAxisMap[0]]),trim(xyz[outAxisMap[1]]),trim(xyz[outAxisMap[2]]))           
-                newXYZ = False
-                outState += 1
-            else:
-                return_val = b''
-        elif outState == 1:
-            return_val = struct.pack("<BHHH", 2, trim(rxyz[outAxisMap[0]]),trim(rxyz[outAxisMap[1]]),trim(rxyz[outAxisMap[2]]))
-            outState += 1
-        else: 
-            newButtons = False
-            return_val = struct.pack("BBBBB", 3, buttons&0xFF, buttons>>8, 0, 0)
-            outState = 0
-
-        if newXYZ or newButtons or outState:
-            event.set()
+        if reportID == 3:
+            report = BUTTONS_REPORT.pack(3, buttons&0xFF, buttons>>8, 0, 0)
+        elif reportID == 1 and not compatible:
+            report = AXES_REPORT.pack(1, *reportAxes)
+        elif reportID in (1, 2) and compatible:
+            report = HALF_AXES_REPORT.pack(reportID, *reportAxes[3*reportID-3:3*reportID])
         else:
-            event.clear()
-
+            report = None
         lock.release()
-        self.send_usb_req(usb_req, return_val, status=(0 if return_val else 1))
+        return report
 
-    def handle_data_fast(self, usb_req):
-        global newXYZ, newButtons, outState, event, lock
-        
-        event.wait(0.5)
+    def reset_reports(self):
+        # Forget what the host has seen, so that the next poll reports the current state.
+        self.sentAxes[:] = [None] * 6
+        self.sentButtons = None
+        self.heldButtons = None
+        self.buttonsSeen = buttonsCount
+        self.lastReports = {1: None, 2: None, 3: None}
+        self.estimated = False # the host was last sent an estimate, not the newest frame
 
-        lock.acquire()
-        if outState == 0:
-            if newXYZ or newButtons or True:
-                return_val = struct.pack("<BHHHHHH", 1, trim(xyz[outAxisMap[0]]),trim(xyz[outAxisMap[1]]),trim(xyz[outAxisMap[2]]), trim(rxyz[outAxisMap[0]]),trim(rxyz[outAxisMap[1]]),trim(rxyz[outAxisMap[2]]))
-                newXYZ = False
-                outState += 1
-            else:
-                return_val = b''
-        elif outState == 1:
-            return_val = struct.pack("<BBBBB", 3, buttons&0xFF, buttons>>8, 0, 0)
-            newButtons = False
-            outState = 0
-
-        if newXYZ or newButtons or outState:
-            event.set()
+    def set_idle(self, reportID, rate):
+        # rate in 4 ms units for one report, or all of them for report ID 0; 0 means
+        # that a report only goes out when it changed
+        if reportID == 0:
+            self.idle_rates = {0: rate}
         else:
-            event.clear()
+            self.idle_rates[reportID] = rate
+        for r in (1, 2, 3):
+            self.idle[r] = 0.004 * self.idle_rates.get(r, self.idle_rates[0])
 
+    def handle_data(self, usb_req):
+        # An interrupt IN URB completes once a report is due: when it changed, or when the
+        # host's idle interval for it ran out. Until then the URB is parked and report_loop
+        # completes it, so the USB/IP reader never waits for the SpaceBall.
+        self.urb_lock.acquire()
+        if self.parked or not self.complete(usb_req):
+            self.parked.append(usb_req)
+            if self.completer is None:
+                addConsumer(self.event)
+                self.completer = threading.Thread(target=self.report_loop, name='report')
+                self.completer.daemon = True
+                self.completer.start()
+            if not self.event.is_set(): # the threading.Event calls allocate even when there is nothing to do
+                self.event.set()
+        self.urb_lock.release()
+
+    def complete(self, usb_req):
+        # Call with urb_lock held: the reply buffer is shared by both completing threads.
+        now = perf_counter()
+        lock.acquire()
+        length = self.build_report(now)
         lock.release()
-        self.send_usb_req(usb_req, return_val, status=(0 if return_val else 1))
+        if length:
+            if hidLog.isEnabledFor(logging.DEBUG):
+                hidLog.debug("Report %d completes URB %d", self.reply.data[RET_SUBMIT_SIZE], usb_req.seqnum)
+            self.send_usb_reply(usb_req, self.reply, length)
+        return length
+
+    def idle_timeout(self):
+        timeout = 0.5
+        if self.parked:
+            now = perf_counter()
+            if predictor is not None:
+                wait = predictor.next_change(now)
+                if wait is not None:
+                    timeout = wait
+                elif self.estimated:
+                    return 0 # the newest frame is still to be reported
+            for reportID in self.reportIDs:
+                if self.idle[reportID]:
+                    timeout = min(timeout, max(0, self.sentTime[reportID] + self.idle[reportID] - now))
+        return timeout
+
+    def report_loop(self):
+        while running and not self.closed:
+            self.event.wait(self.idle_timeout())
+            self.event.clear()
+            self.urb_lock.acquire()
+            try:
+                while self.parked and self.complete(self.parked[0]):
+                    self.parked.popleft()
+            except Exception as e: # the connection is gone
+                hidLog.warning("%s", str(e))
+                self.parked.clear()
+            self.urb_lock.release()
+        removeConsumer(self.event)
+
+    def cancel_urbs(self):
+        self.urb_lock.acquire()
+        while self.parked:
+            self.parked.popleft().release()
+        self.urb_lock.release()
+
+    def reset(self):
+        USBDevice.reset(self)
+        self.urb_lock.acquire()
+        self.reset_reports()
+        self.urb_lock.release()
+        self.set_idle(0, 0)
+        self.protocol = 1
+        self.led = 0
+
+    def close(self):
+        self.closed = True
+        self.cancel_urbs()
+        self.event.set() # ends report_loop
+
+    def handle_unlink(self, seqnum):
+        self.urb_lock.acquire()
+        found = False
+        for usb_req in self.parked:
+            if usb_req.seqnum == seqnum:
+                self.parked.remove(usb_req)
+                usb_req.release()
+                found = True
+                break
+        self.urb_lock.release()
+        return found
+
+    def next_buttons(self):
+        # Call with lock held: the oldest queued button state this host has not been sent,
+        # or None. A host more than BUTTON_QUEUE_SIZE states behind skips the oldest ones.
+        seen = self.buttonsSeen
+        if seen != buttonsCount:
+            if buttonsCount - seen > BUTTON_QUEUE_SIZE:
+                metrics['buttonEdgeDrops'] += buttonsCount - seen - BUTTON_QUEUE_SIZE
+                seen = buttonsCount - BUTTON_QUEUE_SIZE
+            while seen != buttonsCount:
+                seen += 1
+                b = buttonQueue[seen % BUTTON_QUEUE_SIZE]
+                if b != self.sentButtons:
+                    self.buttonsSeen = seen
+                    return b
+            self.buttonsSeen = seen
+        if self.sentButtons is None:
+            return buttons
+        return None
+
+    def build_report_compatible(self, now):
+        # Call with lock held. Only changed reports go out: buttons first, then whichever
+        # axis report has waited longest. While reports keep changing, one not sent for
+        # COMPATIBLE_REFRESH_POLLS reports is refreshed; when nothing changed, a report is
+        # repeated only when its idle interval ran out. Queued button states go out one by one.
+        if self.heldButtons is None:
+            self.heldButtons = self.next_buttons()
+        b = self.heldButtons if self.heldButtons is not None else self.sentButtons
+        axes = reportAxes if predictor is None else predictor.predict(now)
+        reports = ((3, (b&0xFF, b>>8)),
+                   (1, (axes[0], axes[1], axes[2])),
+                   (2, (axes[3], axes[4], axes[5])))
+        age = self.reportAge
+        last = self.lastReports
+        idle = self.idle
+        sent = self.sentTime
+        dirty = None
+        stale = reports[0]
+        for r in reports:
+            if r[1] != last[r[0]]:
+                if dirty is None or (dirty[0] != 3 and age[r[0]] > age[dirty[0]]):
+                    dirty = r
+            if age[r[0]] > age[stale[0]]:
+                stale = r
+        if dirty is None:
+            for r in reports:
+                if idle[r[0]] and now - sent[r[0]] >= idle[r[0]] and (dirty is None or sent[r[0]] < sent[dirty[0]]):
+                    dirty = r
+            if dirty is None:
+                self.estimated = axes != reportAxes
+                return 0
+        elif age[stale[0]] >= COMPATIBLE_REFRESH_POLLS:
+            dirty = stale
+        reportID, values = dirty
+        age[1] += 1
+        age[2] += 1
+        age[3] += 1
+        age[reportID] = 0
+        last[reportID] = values
+        sent[reportID] = now
+
+        if reportID == 3:
+            self.sentButtons = b
+            self.heldButtons = None
+            BUTTONS_REPORT.pack_into(self.reply.data, RET_SUBMIT_SIZE, 3, values[0], values[1], 0, 0)
+            return BUTTONS_REPORT.size
+        self.estimated = True # until a poll finds both halves up to date
+        HALF_AXES_REPORT.pack_into(self.reply.data, RET_SUBMIT_SIZE, reportID, values[0], values[1], values[2])
+        return HALF_AXES_REPORT.size
+
+    def build_report_fast(self, now):
+        # Call with lock held. Queued button states go first, one per report, and the axes
+        # once the queue is empty: a burst of clicks delays motion by a few polls rather than
+        # losing states. Either is repeated when its idle interval ran out. Allocates nothing
+        # while the buttons do not change and -e is off.
+        idle = self.idle
+        sent = self.sentTime
+        b = self.next_buttons()
+        if b is None:
+            values = reportAxes if predictor is None else predictor.predict(now)
+            if values != self.sentAxes or (idle[1] and now - sent[1] >= idle[1]):
+                AXES_REPORT.pack_into(self.reply.data, RET_SUBMIT_SIZE, 1, values[0], values[1], values[2],
+                                      values[3], values[4], values[5])
+                sentAxes = self.sentAxes # not [:] = ..., which builds a slice object
+                sentAxes[0], sentAxes[1], sentAxes[2], sentAxes[3], sentAxes[4], sentAxes[5] = values
+                sent[1] = now
+                self.estimated = values != reportAxes
+                return AXES_REPORT.size
+            if not (idle[3] and now - sent[3] >= idle[3]):
+                self.estimated = values != reportAxes
+                return 0
+            b = self.sentButtons
+        BUTTONS_REPORT.pack_into(self.reply.data, RET_SUBMIT_SIZE, 3, b&0xFF, b>>8, 0, 0)
+        self.sentButtons = b
+        sent[3] = now
+        return BUTTONS_REPORT.size
 
     def handle_unknown_control(self, control_req, usb_req):
+        # The report descriptor and HID class requests; anything else is stalled.
         global sentReport
+        request = control_req.bRequest
+        reportID = control_req.wValue & 0xFF
         if control_req.bmRequestType == 0x81:
-            if control_req.bRequest == 0x6:  # Get Descriptor
-                if control_req.wValue == 0x22:  # send initial report
-                    print('Identifying emulated USB device to host')
-                    self.send_usb_req(usb_req, self.generate_hid_report())
-                    sentReport = True
-
-        if control_req.bmRequestType == 0x21:  # Host Request
-            if control_req.bRequest == 0x0a:  # set idle
-                pass
-                # Idle
-
-usb_Dev = USBHID()
-usb_container = USBContainer()
-usb_container.add_usb_device(usb_Dev)  # Supports only one device!
-          
-        
-opts, args = getopt.getopt(sys.argv[1:], "M:Ctonu:m:P:V:chljp:d:", ["model=", "compatibility-mode", "test", "no-admin", "old-driver", "new-driver", "no-launch", "usbip-directory=", "max", 
-                    "product", "vendor", "cubic-mode", "list-ports","help","joystick","port=","description="])
-i = 0
-while i < len(opts):
-    opt,arg = opts[i]
-    if opt in ('-h', '--help'):
-        print("""python 3d.py [options]\n
+            if request == 0x6 and control_req.wValue >> 8 == 0x22:  # Get Descriptor (report)
+                hidLog.info("Identifying emulated USB device to host")
+                self.send_control_reply(control_req, usb_req, self.generate_hid_report())
+                sentReport = True
+                self.urb_lock.acquire()
+                self.reset_reports() # the host starts over: its next poll gets the current state
+                self.urb_lock.release()
+                if all(e is self.event for e in consumers): # a collection here would stall the hosts that stream
+                    gctune.settle(gcMode) # enumeration is done, streaming is about to start
+                return True
+
+        elif control_req.bmRequestType == 0xA1:  # Device Request
+            if request == 0x01 and control_req.wValue >> 8 == 1:  # get input report
+                report = self.current_report(reportID)
+                if report is not None:
+                    self.send_control_reply(control_req, usb_req, report)
+                    return True
+            elif request == 0x02:  # get idle
+                self.send_control_reply(control_req, usb_req, struct.pack('B', self.idle_rates.get(reportID, self.idle_rates[0])))
+                return True
+            elif request == 0x03:  # get protocol
+                self.send_control_reply(control_req, usb_req, struct.pack('B', self.protocol))
+                return True
+
+        elif control_req.bmRequestType == 0x21:  # Host Request
+            if request == 0x0a:  # set idle
+                self.set_idle(reportID, control_req.wValue >> 8)
+                if not self.event.is_set():
+                    self.event.set() # report_loop picks up the new interval
+            elif request == 0x09:  # set report
+                self.handle_output_report(usb_req.data)
+            elif request == 0x0b:  # set protocol
+                self.protocol = control_req.wValue & 0xFF
+            else:
+                return False
+            self.send_usb_out_reply(usb_req)
+            return True
+        return False
+
+    def handle_output_report(self, data):
+        # Report 4 is the LED of the emulated SpaceMouse. A SpaceBall has no LED, so it
+        # beeps when the LED is switched on.
+        if len(data) >= 2 and data[0] == 4:
+            led = data[1] & 1
+            if led and not self.led:
+                queueSerialCommand(BEEP)
+            self.led = led
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    opts, args = getopt.getopt(sys.argv[1:], "M:Ctonu:m:P:V:chljp:d:s:Ii:v:r:H:a:e:f:A:R:g:", ["model=", "compatibility-mode", "test", "no-admin", "old-driver", "new-driver", "no-launch", "usbip-directory=", "max", 
+                        "product", "vendor", "cubic-mode", "list-ports","help","joystick","port=","description=","stats=","ingest-process","inject=","verbose=",
+                        "profile-control=","profile-output=","hosts=","address=","predict=","period=",
+                        "affinity=","realtime=","low-latency","gc="])
+    i = 0
+    while i < len(opts):
+        opt,arg = opts[i]
+        if opt in ('-h', '--help'):
+            print("""python 3d.py [options]\n
 -h --help                this information
 -j --joystick            HID joystick mode 
 -l --list-ports          list serial ports
@@ -549,149 +1445,270 @@ while i < len(opts):
 -o --old-driver          old but signed driver
 -C --compatibility-mode  slower compatibility mode
 -t --test                send test data
--Mmodel -model=model     set model: flx (4000flx or 5000fx), x003 (2003 or 3003)
+-Mmodel -model=model     set model: flx (4000flx or 5000fx), x003 (3003), 2003, magellan (SpaceMouse Classic),
+                         or auto to ask the device
 -mMAX --max=MAX          set maximum value for all axes
 -VVID --vendor=VID       force vendor ID (hex)
 -PPID --product=PID      force product ID (hex)
 -pCOMx | --port=COMx     COM port of SpaceBall flx
--ddesc | --description=desc  description of COM port device starts with desc""")
-        sys.exit(0)
-    elif opt in ('-j', '--joystick'):
-        joystick = True
-        outAxisMap = (0,2,1)
-    elif opt in ('-p', '--port'):
-        port = arg
-        description = None
-    elif opt in ('-l', '--list-ports'):
-        for p in serial.tools.list_ports.comports():
-            print(p.device+": "+p.description)
-        sys.exit(0)
-    elif opt in ('-d', '--description'):
-        port = None
-        description = arg
-    elif opt in ('-c', '--cubic-mode'):
-        sensitivity = b'C'
-    elif opt in ('-V', '--vendor'):
-        forceVendorID = int(arg, 16)
-    elif opt in ('-P', '--product'):
-        forceProductID = int(arg, 16)        
-    elif opt in ('-m', '--max'):
-        trimValue = int(arg)
-    elif opt in ('-u', '--usbip-exe'):
-        if arg[-1] == '/' or arg[-1] == ':':
-            usbip = arg + "usbip"
-        elif arg[-1] == '':
-            usbip = "usbip"
-        else:
-            usbip = arg + "/" + "usbip"
+-ddesc | --description=desc  description of COM port device starts with desc
+-sSEC | --stats=SEC      print serial link statistics every SEC seconds
+-I --ingest-process      read and decode the serial port in a separate process
+-iADDR | --inject=ADDR   take reports from other programs instead of a SpaceBall (see injection.py);
+                         ADDR is a UDP PORT or HOST:PORT, or a Unix socket path
+-vLIST | --verbose=LIST  log levels by subsystem, e.g. usbip,serial=info,all=warning; a subsystem
+                         without a level logs everything. Subsystems: """ + ", ".join(logs.SUBSYSTEMS) + """
+-rADDR | --profile-control=ADDR  start and stop the sampling profiler with datagrams to ADDR (see profiler.py);
+                         on Linux, SIGUSR1 also starts and stops it
+--profile-output=FILE    profile file name, strftime pattern with %(pid)d (default profile-%(pid)d-%Y%m%d-%H%M%S.txt)
+-HN | --hosts=N          let up to N USB/IP hosts import the SpaceBall at once (not with the Windows vbus driver)
+-aADDR | --address=ADDR  where USB/IP hosts connect: PORT, HOST:PORT or a Unix socket path (default
+                         127.0.0.1:3240; use 0.0.0.0:3240 for hosts on other machines)
+-eMS | --predict=MS      between serial frames, report the axes extrapolated from their recent velocity,
+                         for up to MS milliseconds after a frame (see predict_bench.py)
+-fMS | --period=MS       time between motion frames of a 4000/5000FLX (default 20); auto or auto:MS switches
+                         to 100 ms after a second at rest and back to MS on the first motion
+-ACPUS | --affinity=CPUS pin the serial and USB/IP threads to CPUS, e.g. 2, 0-3 or serial=1,usbip=2 (Linux)
+-RPRIO | --realtime=PRIO run the serial and USB/IP threads with SCHED_FIFO priority PRIO, or rr:PRIO for
+                         SCHED_RR (Linux, needs root or an RLIMIT_RTPRIO of at least PRIO)
+--low-latency            set the low-latency flag of the serial port (Linux)
+-gMODE | --gc=MODE       keep garbage collection pauses out of streaming: freeze collects at startup and
+                         after enumeration and leaves only new objects to later collections; off also
+                         stops automatic collection in between, but for a background thread that collects
+                         when many objects piled up. -s shows the pauses""")
+            sys.exit(0)
+        elif opt in ('-j', '--joystick'):
+            joystick = True
+            outAxisMap = (0,2,1)
+        elif opt in ('-p', '--port'):
+            port = arg
+            description = None
+        elif opt in ('-l', '--list-ports'):
+            for p in serial.tools.list_ports.comports():
+                print(p.device+": "+p.description)
+            sys.exit(0)
+        elif opt in ('-d', '--description'):
+            port = None
+            description = arg
+        elif opt in ('-c', '--cubic-mode'):
+            sensitivity = b'C'
+        elif opt in ('-V', '--vendor'):
+            forceVendorID = int(arg, 16)
+        elif opt in ('-P', '--product'):
+            forceProductID = int(arg, 16)        
+        elif opt in ('-m', '--max'):
+            trimValue = int(arg)
+        elif opt in ('-u', '--usbip-exe'):
+            if arg[-1] == '/' or arg[-1] == ':':
+                usbip = arg + "usbip"
+            elif arg[-1] == '':
+                usbip = "usbip"
+            else:
+                usbip = arg + "/" + "usbip"
+            if os.name == 'nt':
+                usbip += ".exe"
+        elif opt in ('--no-admin',):
+            noAdmin = True
+        elif opt in ('--no-launch',):
+            noLaunch = True
+        elif opt in ('-n', '--new-driver'):
+            builtins.USBIP_VERSION = 273
+        elif opt in ('-o', '--old-driver'):
+            builtins.USBIP_VERSION = 262
+        elif opt in ('-I', '--ingest-process'):
+            ingestProcess = True
+        elif opt in ('-i', '--inject'):
+            injection.parseAddress(arg) # a bad address fails here, not in the inject thread
+            injectAddress = arg
+        elif opt in ('-s', '--stats'):
+            statsInterval = float(arg)
+        elif opt in ('-v', '--verbose'):
+            verbosity.update(logs.parseVerbosity(arg))
+        elif opt in ('-r', '--profile-control'):
+            profileControl = arg
+        elif opt in ('--profile-output',):
+            profileOutput = arg
+        elif opt in ('-H', '--hosts'):
+            maxHosts = int(arg)
+        elif opt in ('-a', '--address'):
+            usbipAddress = arg
+        elif opt in ('-e', '--predict'):
+            predictHorizon = float(arg) / 1000
+        elif opt in ('-A', '--affinity'):
+            cpuAffinity = realtime.parseAffinity(arg)
+        elif opt in ('-R', '--realtime'):
+            realtimePolicy, realtimePriority = realtime.parsePriority(arg)
+        elif opt in ('--low-latency',):
+            lowLatency = True
+        elif opt in ('-g', '--gc'):
+            gcMode = gctune.parseMode(arg)
+        elif opt in ('-f', '--period'):
+            mode, sep, ms = arg.partition(':')
+            adaptivePeriod = mode == 'auto'
+            if not adaptivePeriod:
+                ms = mode
+            if ms:
+                dataPeriod = int(ms)
+        elif opt in ('-t', '--test'):
+            test = True
+        elif opt in ('-C', '--compatibility-mode'):
+            compatible = True
+        elif opt in ('-M', '--model'):
+            if arg.lower() == 'auto':
+                autoDetect = True
+            elif findModel(arg) is None:
+                raise Exception("unrecognized model")
+            else:
+                currentMouse = findModel(arg)()
+        i += 1
+
+    logs.setup(verbosity=verbosity)
+    gctune.instrument(metrics)
+    if adaptivePeriod and not autoDetect and currentMouse.periodCommand(dataPeriod) is None:
+        mainLog.warning("The %s has a fixed data period, -f has no effect", currentMouse.name)
+    if predictHorizon:
+        predictor = MotionPredictor(predictHorizon)
+
+    if not builtins.USBIP_VERSION:
         if os.name == 'nt':
-            usbip += ".exe"
-    elif opt in ('--no-admin',):
-        noAdmin = True
-    elif opt in ('--no-launch',):
-        noLaunch = True
-    elif opt in ('-n', '--new-driver'):
-        builtins.USBIP_VERSION = 273
-    elif opt in ('-o', '--old-driver'):
-        builtins.USBIP_VERSION = 262
-    elif opt in ('-t', '--test'):
-        test = True
-    elif opt in ('-C', '--compatibility-mode'):
-        compatible = True
-    elif opt in ('-M', '--model'):
-        arg = arg.lower()
-        if 'flx' in arg or '4000' in arg:
-            currentMouse = FLX()
-        elif '003' in arg:
-            currentMouse = X003()
+            builtins.USBIP_VERSION = windows_utils.getVBUSVersion()
         else:
-            raise Exception("unrecognized model")
-    i += 1
+            builtins.USBIP_VERSION = 262
 
-if not builtins.USBIP_VERSION:
-    if os.name == 'nt':
-        builtins.USBIP_VERSION = windows_utils.getVBUSVersion()
-    else:
-        builtins.USBIP_VERSION = 262
+    usb_Dev = USBHID()
+    usb_container = USBContainer()
+    usb_container.add_usb_device(usb_Dev)  # Supports only one device!
+    usb_container.device_factory = USBHID # one per host when there are several
+    usb_container.max_hosts = maxHosts
 
-def is_admin():
-    try:
-        return ctypes.windll.shell32.IsUserAnAdmin()
-    except:
-        return False
+    def is_admin():
+        try:
+            return ctypes.windll.shell32.IsUserAnAdmin()
+        except:
+            return False
 
-print("Assuming version",builtins.USBIP_VERSION)
-if os.name == 'nt' and builtins.USBIP_VERSION == 262 and not noAdmin:
-    import platform
-    if platform.architecture()[0] != '64bit' and platform.machine().endswith('64'):
-        print("With the signed driver on Windows x64, please use a 64-bit Python interpreter.")
-        exit(1)
-    if not is_admin():
-        def u(z):
-            if sys.version_info[0] >= 3:
-                return z
-            else:
-                return unicode(z)
-        print("Relaunching as administrator.")
-        print("If you don't want to do that, you'll need the new unsigned driver.")
-        args = u(__file__)
-        if len(sys.argv) >= 2:
-            args += " " + " ".join((u('"' + arg + '"') for arg in sys.argv[1:]))
-        ctypes.windll.shell32.ShellExecuteW(None, u("runas"), u(sys.executable), args, None, 1)
-        sys.exit(0)
+    mainLog.info("Assuming version %d", builtins.USBIP_VERSION)
+    if os.name == 'nt' and builtins.USBIP_VERSION == 262 and not noAdmin:
+        import platform
+        if platform.architecture()[0] != '64bit' and platform.machine().endswith('64'):
+            mainLog.error("With the signed driver on Windows x64, please use a 64-bit Python interpreter.")
+            exit(1)
+        if not is_admin():
+            def u(z):
+                if sys.version_info[0] >= 3:
+                    return z
+                else:
+                    return unicode(z)
+            mainLog.info("Relaunching as administrator.")
+            mainLog.info("If you don't want to do that, you'll need the new unsigned driver.")
+            args = u(__file__)
+            if len(sys.argv) >= 2:
+                args += " " + " ".join((u('"' + arg + '"') for arg in sys.argv[1:]))
+            ctypes.windll.shell32.ShellExecuteW(None, u("runas"), u(sys.executable), args, None, 1)
+            sys.exit(0)
         
 
         
         
-t1 = threading.Thread(target=emulateLoop if test else serialLoop)
-t1.daemon = True
-t1.start()
-
-sentReport = False
-stopped = False
-
-def windowsExit():
-    global stopped,running,sentReport
-    if not stopped:
-        stopped = True
-        print("Exiting...")
-        windows_utils.SetConsoleCtrlHandler(None, BOOL(True))
-        if not sentReport:
-            print("Waiting for report descriptor to be sent first")
-            t = time()
-            while time() < t + 15 and not sentReport:
-                sleep(1)
-            if sentReport:
-                print("Ready to uninstall")
-            sleep(1)
+    if injectAddress:
+        ingest = None
+        t1 = threading.Thread(target=injectLoop, args=(injectAddress,), name='inject')
+        if injection.parseAddress(injectAddress)[0] != socket.AF_INET:
+            atexit.register(injection.removeSocket, injectAddress) # the thread is not joined on ctrl-c
+    elif ingestProcess and not test:
+        sharedState = SharedState()
+        atexit.register(sharedState.close) # unlinks the segment
+        serialCommands = multiprocessing.Queue(SERIAL_QUEUE_SIZE)
+        ingest = multiprocessing.Process(target=ingestMain, args=(sharedState.name,
+                                         (port, description, sensitivity, type(currentMouse).__name__, autoDetect, statsInterval,
+                                          serialCommands, verbosity, dataPeriod, adaptivePeriod, cpuAffinity, realtimePolicy,
+                                          realtimePriority, lowLatency, gcMode), sharedState.changed))
+        ingest.daemon = True
+        ingest.start()
+        t1 = threading.Thread(target=sharedStateLoop, args=(sharedState,), name='shared state')
+    else:
+        ingest = None
+        t1 = threading.Thread(target=emulateLoop if test else serialLoop, name='emulate' if test else 'serial')
+        if not test:
+            serialCommands = Queue(SERIAL_QUEUE_SIZE)
+            t3 = threading.Thread(target=serialWriteLoop, name='serial write')
+            t3.daemon = True
+            t3.start()
+    t1.daemon = True
+    t1.start()
+
+    if statsInterval and ingest is None: # the ingest process reports its own serial statistics
+        t2 = threading.Thread(target=statsLoop, name='stats')
+        t2.daemon = True
+        t2.start()
+
+    profile = profiler.SamplingProfiler(output=profileOutput)
+    def profileCommand(command):
+        profiler.control(profile, command)
+        if ingest is not None:
+            profiler.forward(ingest.pid, profile) # the serial side runs there
+    profiler.onSignal(profileCommand)
+    if profileControl:
+        profiler.listen(profileControl, profileCommand)
+
+    sentReport = False
+    stopped = False
+
+    def windowsExit():
+        global stopped,running,sentReport
+        if not stopped:
+            stopped = True
+            mainLog.info("Exiting...")
+            windows_utils.SetConsoleCtrlHandler(None, BOOL(True))
             if not sentReport:
-                print("Report still not sent. There may be some difficulties in disconnecting.")
+                mainLog.info("Waiting for report descriptor to be sent first")
+                t = time()
+                while time() < t + 15 and not sentReport:
+                    sleep(1)
+                if sentReport:
+                    mainLog.info("Ready to uninstall")
+                sleep(1)
+                if not sentReport:
+                    mainLog.warning("Report still not sent. There may be some difficulties in disconnecting.")
             
-        running = False
-        usb_container.running = False
-        usb_container.detach()
-        print("Bye!")       
-        windows_utils.ExitProcess(0)
-        return False
-    return True
+            running = False
+            if ingest is not None:
+                ingest.terminate()
+            usb_container.running = False
+            usb_container.detach()
+            mainLog.info("Bye!")
+            logs.stop() # ExitProcess skips atexit
+            windows_utils.ExitProcess(0)
+            return False
+        return True
     
-if os.name=='nt':
-    breakHandler = windows_utils.CtrlHandlerRoutine(lambda x: windowsExit())
-    windows_utils.SetConsoleCtrlHandler(breakHandler, BOOL(True))
-    signal.signal(signal.SIGBREAK, lambda x,y: windowsExit)
-    signal.signal(signal.SIGINT, lambda x,y: windowsExit)
-    atexit.register(lambda: windowsExit())
-
-if usbip and not noLaunch:
-    print("Starting "+usbip)
     if os.name=='nt':
-        subprocess.Popen([usbip, "-a", "localhost", "1-1"],creationflags=0x00000200)
-    else:
-        subprocess.Popen([usbip, "-a", "localhost", "1-1"])
-    print("Press ctrl-c to exit")
+        breakHandler = windows_utils.CtrlHandlerRoutine(lambda x: windowsExit())
+        windows_utils.SetConsoleCtrlHandler(breakHandler, BOOL(True))
+        signal.signal(signal.SIGBREAK, lambda x,y: windowsExit)
+        signal.signal(signal.SIGINT, lambda x,y: windowsExit)
+        atexit.register(lambda: windowsExit())
+
+    listen = { 'forceIP': usbip is not None }
+    if usbipAddress is not None:
+        family, addr = injection.parseAddress(usbipAddress)
+        if family == socket.AF_INET:
+            listen = { 'ip': addr[0], 'port': addr[1], 'forceIP': True }
+        else:
+            listen = { 'path': addr }
 
-usb_container.run(forceIP=usbip is not None)
+    if usbip and not noLaunch and 'path' not in listen:
+        mainLog.info("Starting %s", usbip)
+        if os.name=='nt':
+            subprocess.Popen([usbip, "-a", "localhost", "1-1"],creationflags=0x00000200)
+        else:
+            subprocess.Popen([usbip, "-a", "localhost", "1-1"])
+        mainLog.info("Press ctrl-c to exit")
+
+    gctune.settle(gcMode)
+    tuneThread('usbip') # inherited by the connection and report threads started from here
+    usb_container.run(**listen)
 
-if os.name=='nt':
-    windowsExit()
+    if os.name=='nt':
+        windowsExit()
     
\ No newline at end of file
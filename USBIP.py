@@ -1,7 +1,11 @@
 from __future__ import print_function
+import collections
+import errno
 import socket
+import stat
 import sys
 import struct
+import threading
 import types
 from time import sleep
 try:
@@ -14,15 +18,32 @@ import time
 if os.name == 'nt':
     import msvcrt
     import windows_utils
+import logs
+
+log = logs.get('usbip')
     
 #USBIP_VERSION = builtins.USBIP_VERSION # 273 for the unsigned patched driver and 262 for the old signed driver
 
 class CommunicationChannel(object):
-    def __init__(self, filename=None, ip=None, port=None, endianForWriting='>'):
+    # One of: the vbus device file on Windows, a TCP (ip, port) or Unix-domain socket (path)
+    # to listen on, or a connected socket (conn) from accept or USBContainer.connect.
+    def __init__(self, filename=None, ip=None, port=None, endianForWriting='>', conn=None, path=None):
         self.endianForWriting = endianForWriting
+        self.lock = threading.Lock() # URBs may be completed from several threads
+        self.path = path
         if filename:
             self.file = open(filename, "w+b")
             self.socket = None
+        elif conn is not None:
+            self.file = None
+            self.socket = None
+            self.conn = conn
+        elif path is not None:
+            self.file = None
+            remove_socket(path)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(path)
+            self.socket.listen(5)
         else:
             self.file = None
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -36,33 +57,74 @@ class CommunicationChannel(object):
             return did
         else:
             did = self.conn.recv(n)
+            while did and len(did) < n: # TCP may deliver a large URB in pieces
+                more = self.conn.recv(n - len(did))
+                if not more:
+                    break
+                did += more
             return did
             
+    def read_into(self, view):
+        # Fills the writable memoryview completely; returns the number of bytes read, which
+        # is only short when the connection ends.
+        n = len(view)
+        got = 0
+        while got < n:
+            if self.file:
+                k = self.file.readinto(view[got:])
+            else:
+                k = self.conn.recv_into(view[got:])
+            if not k:
+                break
+            got += k
+        return got
+
     def write(self,data):
-        if self.file:
-            self.file.write(data)
-            self.file.flush()
-        else:
-            self.conn.sendall(data)
-            
-    def acceptConnection(self):
-        if self.socket:
-            self.conn, addr = self.socket.accept()
-            print("Connected",addr)
-            
-    def closeConnection(self):
-        if self.socket:
-            self.conn.close()
+        self.lock.acquire()
+        try:
+            if self.file:
+                self.file.write(data)
+                self.file.flush()
+            else:
+                self.conn.sendall(data)
+        finally:
+            self.lock.release()
             
+    def accept(self):
+        # Waits for the next connection and returns a channel of its own for it, so that
+        # several connections can be served at once.
+        conn, addr = self.socket.accept()
+        if conn.family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.info("Connected %s", addr or "over a Unix socket")
+        return CommunicationChannel(conn=conn, endianForWriting=self.endianForWriting)
+
     def close(self):
         if self.file:
             self.file.close()
+        elif self.socket is not None:
+            self.socket.close() # the listening one
+            if self.path is not None:
+                remove_socket(self.path)
         else:
             self.conn.close()
 
+def remove_socket(path):
+    # A socket left at path by an earlier run, or ours on shutdown, goes; anything else there
+    # is somebody's file and stays.
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, "Not a socket, leaving it alone", path)
+    os.unlink(path)
+
 def rev(u):
     return (((u>>8) | (u<<8)) &0xFFFF)
 
+UNPACK_LAYOUTS = {} # class -> BaseStucture.unpack_layout()
+
 class BaseStucture(object):
     def __init__(self, **kwargs):
         self.init_from_dict(**kwargs)
@@ -106,16 +168,21 @@ class BaseStucture(object):
         return struct.pack(self.format(endian=endian), *values)
 
     def unpack(self, buf):
-        values = struct.unpack(self.format(), buf)
-        i=0
-        keys_vals = {}
-        for val in values:
-            if '<' in self._fields_[i][1][0]:
-                val = struct.unpack('<' +self._fields_[i][1][1], struct.pack('>' + self._fields_[i][1][1], val))[0]
-            keys_vals[self._fields_[i][0]]=val
-            i+=1
+        layout = UNPACK_LAYOUTS.get(self.__class__)
+        if layout is None:
+            layout = UNPACK_LAYOUTS[self.__class__] = self.unpack_layout()
+        values = list(layout[1].unpack(buf))
+        for i, big, little in layout[2]:
+            values[i] = little.unpack(big.pack(values[i]))[0]
 
-        self.init_from_dict(**keys_vals)
+        self.init_from_dict(**dict(zip(layout[0], values)))
+
+    def unpack_layout(self):
+        # field names, the struct for the whole buffer, and a (index, '>', '<') pair of structs
+        # for every field that is swapped to little endian after unpacking
+        swaps = [(i, struct.Struct('>' + field[1][1]), struct.Struct('<' + field[1][1]))
+                 for i, field in enumerate(self._fields_) if '<' in field[1][0]]
+        return [field[0] for field in self._fields_], struct.Struct(self.format()), swaps
 
 
 def int_to_hex_string(val):
@@ -129,11 +196,16 @@ def int_to_hex_string(val):
 
 class USBIPHeader(BaseStucture):
     _fields_ = [
-        ('version', 'H', builtins.USBIP_VERSION),
+        ('version', 'H'),
         ('command', 'H'),
         ('status', 'I')
     ]
 
+    def __init__(self, **kwargs):
+        # the version is only known once the application has picked a driver
+        kwargs.setdefault('version', getattr(builtins, 'USBIP_VERSION', None))
+        BaseStucture.__init__(self, **kwargs)
+
 class USBInterface(BaseStucture):
     _fields_ = [
         ('bInterfaceClass', 'B'),
@@ -160,10 +232,16 @@ class OPREPDevList(BaseStucture):
         ('bDeviceProtocol', 'B'),
         ('bConfigurationValue', 'B'),
         ('bNumConfigurations', 'B'),
-        ('bNumInterfaces', 'B'),
-        ('interfaces', USBInterface())
+        ('bNumInterfaces', 'B')
     ]
 
+    def pack(self,endian='>'):
+        # followed by one USBInterface per interface of the device
+        packed_data = BaseStucture.pack(self,endian=endian)
+        for interface in getattr(self, 'interfaces', ()):
+            packed_data += interface.pack()
+        return packed_data
+
 
 
 class OPREPImport(BaseStucture):
@@ -242,8 +320,8 @@ class StandardDeviceRequest(BaseStucture):
     _fields_ = [
         ('bmRequestType', 'B'),
         ('bRequest', 'B'),
-        ('wValue', 'H'),
-        ('wIndex', 'H'),
+        ('wValue', '<H'),
+        ('wIndex', '<H'),
         ('wLength', '<H')
     ]
 
@@ -303,12 +381,75 @@ class EndPoint(BaseStucture):
         ('bInterval', 'B', 0x0A)
     ]
 
-class USBRequest():
+RET_SUBMIT_HEADER = { '>': struct.Struct('>IIIIIIIIIIQ'), '<': struct.Struct('<IIIIIIIIIIQ') }
+RET_SUBMIT_SIZE = RET_SUBMIT_HEADER['>'].size
+# offset, length, actual_length, status of each isochronous packet, after the transfer data
+ISO_PACKET_DESCRIPTOR = { '>': struct.Struct('>IIIi'), '<': struct.Struct('<IIIi') }
+ISO_PACKET_SIZE = ISO_PACKET_DESCRIPTOR['>'].size
+
+def iso_packets(buffer, start, end, endian='>'):
+    # (offset, length) of each isochronous packet descriptor in buffer[start:end], in the
+    # byte order of the channel: the Windows vbus driver has them little-endian
+    descriptor = ISO_PACKET_DESCRIPTOR[endian]
+    return [descriptor.unpack_from(buffer, i)[:2] for i in range(start, end, ISO_PACKET_SIZE)]
+EPIPE = -32 # URB status of a stalled endpoint
+ECONNRESET = -104 # RET_UNLINK status when the URB was still pending and has been dropped
+ST_OK = 0 # OP_REP_IMPORT status
+ST_DEV_BUSY = 2
+ST_NODEV = 4
+# CMD_SUBMIT (or CMD_UNLINK) header with its setup packet split into bmRequestType, bRequest,
+# wValue, wIndex and wLength; the last three are little-endian on the wire.
+CMD_SUBMIT = struct.Struct('>IIIIIIIIIIBBHHH')
+REQUEST_POOL_SIZE = 64
+
+class ReplyBuffer(object):
+    # Preallocated USBIPRETSubmit reply: the header is packed in front of up to `size` bytes
+    # of data written at data[RET_SUBMIT_SIZE:], and views[n] sends header plus n bytes of it.
+    def __init__(self, size):
+        self.data = bytearray(RET_SUBMIT_SIZE + size)
+        whole = memoryview(self.data)
+        self.views = [whole[:RET_SUBMIT_SIZE + n] for n in range(size + 1)]
+
+class USBRequest(object):
+    # One URB. data is the OUT payload; iso_packets lists (offset, length) of each isochronous
+    # packet. For control transfers the setup packet fields make it a StandardDeviceRequest too.
+    # USBContainer reuses requests: one from its pool goes back there once its reply is sent.
+    __slots__ = ('command', 'seqnum', 'devid', 'direction', 'ep', 'flags', 'transfer_buffer_length', 'start_frame',
+                 'numberOfPackets', 'interval', 'bmRequestType', 'bRequest', 'wValue', 'wIndex', 'wLength',
+                 'data', 'iso_packets', 'pool')
+
     def __init__(self, **kwargs):
+        self.command = 1
+        self.seqnum = self.devid = self.direction = self.ep = self.flags = 0
+        self.transfer_buffer_length = self.start_frame = self.numberOfPackets = self.interval = 0
+        self.bmRequestType = self.bRequest = self.wValue = self.wIndex = self.wLength = 0
+        self.data = b''
+        self.iso_packets = None
+        self.pool = None
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def unpack_from(self, buffer):
+        (self.command, self.seqnum, self.devid, self.direction, self.ep, self.flags, self.transfer_buffer_length,
+         self.start_frame, self.numberOfPackets, self.interval, self.bmRequestType, self.bRequest, wValue, wIndex,
+         wLength) = CMD_SUBMIT.unpack_from(buffer)
+        self.wValue = (wValue >> 8) | ((wValue & 0xFF) << 8)
+        self.wIndex = (wIndex >> 8) | ((wIndex & 0xFF) << 8)
+        self.wLength = (wLength >> 8) | ((wLength & 0xFF) << 8)
+        self.data = b''
+        self.iso_packets = None
+
+    def release(self):
+        pool = self.pool
+        if pool is not None:
+            self.pool = None
+            pool.append(self)
+
 class USBDevice(object):
+    manufacturer = None
+    product = None
+    serial = None
+
     '''interfaces = [USBInterface(bInterfaceClass=0x3, bInterfaceSubClass=0x0, bInterfaceProtocol=0x0)]
     speed=2
     speed = 2
@@ -324,8 +465,22 @@ class USBDevice(object):
 
     def __init__(self):
         self.generate_raw_configuration()
+        self.generate_string_descriptors()
+        self.generate_device_descriptor()
         self.attached = False
         self.detaching = False
+        self.endpoint_handlers = {}
+        self.data_handler = getattr(self, 'handle_data', None) # looked up once, not per URB
+        self.configuration_value = 0
+        self.alternate_settings = {}
+        self.halted = set()
+        self.remote_wakeup = False
+
+    def register_endpoint(self, address, handler):
+        # URBs for endpoint `address` (0x81 for EP1 IN, 0x02 for EP2 OUT, ...) go to
+        # handler(usb_req), which must complete each one with one of the send_* methods.
+        # Unregistered endpoints fall back to handle_data.
+        self.endpoint_handlers[address] = handler
         
     def attach(self):
         if self.attached or not self.channel.file:
@@ -344,7 +499,7 @@ class USBDevice(object):
             int0_protocol = self.configurations[0].interfaces[0].bInterfaceProtocol)
         self.port = windows_utils.vbusAttach(msvcrt.get_osfhandle(self.channel.file.fileno()), plugin)
         self.attached = True
-        print("Attached to vbus port "+str(self.port))
+        log.info("Attached to vbus port %d", self.port)
         
     def detach(self):
         if not self.attached:
@@ -355,15 +510,15 @@ class USBDevice(object):
             if os.name=='nt':
                 self.detaching = True
                 if builtins.USBIP_VERSION == 262:
-                    print("Uninstalling")
+                    log.info("Uninstalling")
                     if windows_utils.uninstallUSB(self.vendorID, self.productID, "on USB/IP Enumerator"):
-                        print("Success uninstalling device")
+                        log.info("Success uninstalling device")
                         sleep(2)
                     else:
-                        print("Failure uninstalling device")
-                        print("In a minute you will probably get a BSOD unless you reboot or delete the device manually.")
+                        log.error("Failure uninstalling device")
+                        log.error("In a minute you will probably get a BSOD unless you reboot or delete the device manually.")
                         sleep(60)
-                print("Detaching device")
+                log.info("Detaching device")
                 windows_utils.vbusDetach(msvcrt.get_osfhandle(self.channel.file.fileno()), self.port)
                 sleep(1)
                 self.channel.close()
@@ -371,66 +526,238 @@ class USBDevice(object):
         self.attached = False
 
     def generate_raw_configuration(self):
-        str = self.configurations[0].pack()
-        str += self.configurations[0].interfaces[0].pack()
-        str += self.configurations[0].interfaces[0].descriptions[0].pack()
-        str += self.configurations[0].interfaces[0].endpoints[0].pack()
-        self.all_configurations = str
+        # Counts and wTotalLength are filled in from the interfaces, class descriptors
+        # and endpoints attached to each configuration.
+        self.raw_configurations = []
+        for configuration in self.configurations:
+            body = b''
+            for interface in configuration.interfaces:
+                interface.bNumEndpoints = len(interface.endpoints)
+                body += interface.pack()
+                for description in getattr(interface, 'descriptions', ()):
+                    body += description.pack()
+                for endpoint in interface.endpoints:
+                    body += endpoint.pack()
+            configuration.bNumInterfaces = len(set(interface.bInterfaceNumber for interface in configuration.interfaces))
+            configuration.wTotalLength = rev(configuration.size() + len(body))
+            self.raw_configurations.append(configuration.pack() + body)
+        self.bNumInterfaces = self.configurations[0].bNumInterfaces
+        self.all_configurations = self.raw_configurations[0]
+
+    def generate_string_descriptors(self):
+        # String 0 lists the supported languages (US English); the others are numbered in
+        # the order manufacturer, product, serial, skipping the ones that are not set.
+        self.string_descriptors = { 0: b'\x04\x03\x09\x04' }
+        self.string_indexes = {}
+        for name in ('manufacturer', 'product', 'serial'):
+            text = getattr(self, name)
+            if text:
+                encoded = text.encode('utf-16-le')
+                index = len(self.string_descriptors)
+                self.string_descriptors[index] = struct.pack('BB', 2 + len(encoded), 3) + encoded
+                self.string_indexes[name] = index
+
+    def generate_device_descriptor(self):
+        self.device_descriptor = DeviceDescriptor(bDeviceClass=self.bDeviceClass,
+                                                  bDeviceSubClass=self.bDeviceSubClass,
+                                                  bDeviceProtocol=self.bDeviceProtocol,
+                                                  bMaxPacketSize0=0x40,
+                                                  idVendor=rev(self.vendorID),
+                                                  idProduct=rev(self.productID),
+                                                  bcdDevice=rev(self.bcdDevice),
+                                                  iManufacturer=self.string_indexes.get('manufacturer', 0),
+                                                  iProduct=self.string_indexes.get('product', 0),
+                                                  iSerialNumber=self.string_indexes.get('serial', 0),
+                                                  bNumConfigurations=len(self.configurations)).pack()
+
+    def interface_list(self):
+        return [USBInterface(bInterfaceClass=interface.bInterfaceClass,
+                             bInterfaceSubClass=interface.bInterfaceSubClass,
+                             bInterfaceProtocol=interface.bInterfaceProtocol)
+                for interface in self.configurations[0].interfaces if interface.bAlternateSetting == 0]
 
     def send_usb_req(self, usb_req, usb_res, status=0):
-        self.channel.write(USBIPRETSubmit(command=0x3,
-                                                   seqnum=usb_req.seqnum,
-                                                   ep=0,
-                                                   status=status,
-                                                   actual_length=len(usb_res),
-                                                   start_frame=0x0,
-                                                   number_of_packets=0x0,
-                                                   interval=0x0,
-                                                   data=usb_res).pack(endian=self.channel.endianForWriting))
+        self.channel.write(RET_SUBMIT_HEADER[self.channel.endianForWriting].pack(0x3, usb_req.seqnum, 0, 0, 0, status,
+                                                                                 len(usb_res), 0, 0, 0, 0) + usb_res)
+        usb_req.release()
+
+    def send_usb_reply(self, usb_req, reply, length, status=0):
+        # Sends `length` bytes already written into the ReplyBuffer without copying them.
+        RET_SUBMIT_HEADER[self.channel.endianForWriting].pack_into(reply.data, 0, 0x3, usb_req.seqnum, 0, 0, 0, status,
+                                                                   length, 0, 0, 0, 0)
+        self.channel.write(reply.views[length])
+        usb_req.release()
+
+    def send_usb_out_reply(self, usb_req, length=None, status=0):
+        # Completes an OUT transfer; by default all of its data counts as accepted.
+        self.channel.write(RET_SUBMIT_HEADER[self.channel.endianForWriting].pack(0x3, usb_req.seqnum, 0, 0, 0, status,
+            len(usb_req.data) if length is None else length, 0, 0, 0, 0))
+        usb_req.release()
+
+    def send_iso_reply(self, usb_req, packets=None, status=0):
+        # Completes an isochronous transfer. For IN, packets holds the data of each packet of
+        # the request (cut to the packet's length); it goes out back to back, followed by the
+        # packet descriptors. For OUT, pass None: every packet is accepted in full.
+        endian = self.channel.endianForWriting
+        descriptor = ISO_PACKET_DESCRIPTOR[endian]
+        data = []
+        descriptors = []
+        total = 0
+        for i, (offset, length) in enumerate(usb_req.iso_packets):
+            if packets is None:
+                actual = length
+            else:
+                packet = packets[i][:length] if i < len(packets) else b''
+                data.append(packet)
+                actual = len(packet)
+            total += actual
+            descriptors.append(descriptor.pack(offset, length, actual, 0))
+        header = RET_SUBMIT_HEADER[endian].pack(0x3, usb_req.seqnum, 0, 0, 0, status, total, usb_req.start_frame,
+                                                len(usb_req.iso_packets), 0, 0)
+        self.channel.write(header + b''.join(data) + b''.join(descriptors))
+        usb_req.release()
+
+    def send_control_reply(self, control_req, usb_req, data):
+        self.send_usb_req(usb_req, data[:control_req.wLength])
+
+    def send_stall(self, usb_req):
+        self.send_usb_req(usb_req, b'', status=EPIPE & 0xFFFFFFFF)
 
     def handle_get_descriptor(self, control_req, usb_req):
-        handled = False
-        if control_req.wValue == 0x1: # Device
-            handled = True
-            self.send_usb_req(usb_req, DeviceDescriptor(bDeviceClass=self.bDeviceClass,
-                                                        bDeviceSubClass=self.bDeviceSubClass,
-                                                        bDeviceProtocol=self.bDeviceProtocol,
-                                                        bMaxPacketSize0=0x40,
-                                                        idVendor=rev(self.vendorID),
-                                                        idProduct=rev(self.productID),
-                                                        bcdDevice=rev(self.bcdDevice),
-                                                        iManufacturer=0,
-                                                        iProduct=0,
-                                                        iSerialNumber=0,
-                                                        bNumConfigurations=1).pack())
-        elif control_req.wValue == 0x2: # configuration
-            handled = True
-            self.send_usb_req(usb_req, self.all_configurations[:control_req.wLength])
-        elif control_req.wValue == 0x3: # string
-            print("String request not supported")
-
-        return handled
+        kind = control_req.wValue >> 8
+        index = control_req.wValue & 0xFF
+        data = None
+        if control_req.bmRequestType == 0x80:
+            if kind == 0x1: # device
+                data = self.device_descriptor
+            elif kind == 0x2: # configuration
+                if index < len(self.raw_configurations):
+                    data = self.raw_configurations[index]
+            elif kind == 0x3: # string
+                data = self.string_descriptors.get(index)
+            # a full-speed device stalls device qualifier (0x6) and BOS (0xF) requests
+        elif control_req.bmRequestType == 0x81: # class descriptor of an interface, e.g. HID
+            for interface in self.configurations[0].interfaces:
+                if interface.bInterfaceNumber == control_req.wIndex:
+                    for description in getattr(interface, 'descriptions', ()):
+                        if description.bDescriptorType == kind:
+                            data = description.pack()
+        if data is None:
+            return False
+        self.send_control_reply(control_req, usb_req, data)
+        return True
+
+    def handle_standard_request(self, control_req, usb_req):
+        # Chapter 9 requests; returns False for the ones that should stall.
+        request = control_req.bRequest
+        recipient = control_req.bmRequestType & 0x1F
+        if control_req.bmRequestType & 0x80:
+            if request == 0x6: # GET_DESCRIPTOR
+                return self.handle_get_descriptor(control_req, usb_req)
+            elif request == 0x0: # GET_STATUS
+                if recipient == 0:
+                    status = (1 if self.configurations[0].bmAttributes & 0x40 else 0) | (2 if self.remote_wakeup else 0)
+                elif recipient == 2:
+                    status = 1 if control_req.wIndex in self.halted else 0
+                else:
+                    status = 0
+                data = struct.pack('<H', status)
+            elif request == 0x8: # GET_CONFIGURATION
+                data = struct.pack('B', self.configuration_value)
+            elif request == 0xA: # GET_INTERFACE
+                data = struct.pack('B', self.alternate_settings.get(control_req.wIndex, 0))
+            elif request == 0xC: # SYNCH_FRAME
+                data = b'\0\0'
+            else:
+                return False
+            self.send_control_reply(control_req, usb_req, data)
+            return True
+        if request in (0x1, 0x3): # CLEAR_FEATURE, SET_FEATURE
+            if recipient == 0 and control_req.wValue == 1: # DEVICE_REMOTE_WAKEUP
+                self.remote_wakeup = request == 0x3
+            elif recipient == 2 and control_req.wValue == 0: # ENDPOINT_HALT
+                if request == 0x3:
+                    self.halted.add(control_req.wIndex)
+                else:
+                    self.halted.discard(control_req.wIndex)
+            else:
+                return False
+        elif request == 0x5: # SET_ADDRESS
+            pass
+        elif request == 0x9: # SET_CONFIGURATION
+            self.configuration_value = control_req.wValue & 0xFF
+        elif request == 0xB: # SET_INTERFACE
+            self.alternate_settings[control_req.wIndex] = control_req.wValue
+        else:
+            return False
+        self.send_usb_out_reply(usb_req)
+        return True
+
+    def handle_unknown_control(self, control_req, usb_req):
+        # Class and vendor requests; devices override this and return True when they replied.
+        return False
+
+    def handle_unlink(self, seqnum):
+        # Devices that hold on to URBs drop the one with this seqnum and return True; if it
+        # already completed they return False.
+        return False
+
+    def cancel_urbs(self):
+        # The connection ended: drop any URBs still held.
+        pass
+
+    def reset(self):
+        # The host went away: back to the state of a device that was just plugged in.
+        self.cancel_urbs()
+        self.configuration_value = 0
+        self.alternate_settings = {}
+        self.halted = set()
+        self.remote_wakeup = False
+
+    def close(self):
+        # The device served a host of its own (see USBContainer.serve_hosts) and is not
+        # used again once that host is gone.
+        self.cancel_urbs()
 
     def handle_usb_control(self, usb_req):
-        control_req = StandardDeviceRequest()
-        control_req.unpack(int_to_hex_string(usb_req.setup))
+        # The request carries the decoded setup packet, so it is passed as control_req as well.
         handled = False
-        if control_req.bmRequestType == 0x80: # Host Request
-            if control_req.bRequest == 0x6: # Get Descriptor
-                handled = self.handle_get_descriptor(control_req, usb_req)
-
+        if usb_req.bmRequestType & 0x60 == 0: # standard request
+            handled = self.handle_standard_request(usb_req, usb_req)
         if not handled:
-            self.handle_unknown_control(control_req, usb_req)
+            handled = self.handle_unknown_control(usb_req, usb_req)
+        if not handled:
+            self.send_stall(usb_req)
 
     def handle_usb_request(self, usb_req):
         if usb_req.ep == 0:
             self.handle_usb_control(usb_req)
+            return
+        handler = self.endpoint_handlers.get(usb_req.ep | 0x80 if usb_req.direction else usb_req.ep)
+        if handler is not None:
+            handler(usb_req)
+        elif self.data_handler is not None:
+            self.data_handler(usb_req)
+        elif usb_req.iso_packets is not None:
+            self.send_iso_reply(usb_req, [], status=EPIPE & 0xFFFFFFFF)
         else:
-            self.handle_data(usb_req)
+            self.send_usb_req(usb_req, b'', status=EPIPE & 0xFFFFFFFF)
 
 class USBContainer(object):
     usb_devices = []
     running = True
+    max_hosts = 1 # more than one needs device_factory, see serve_hosts
+    device_factory = None
+    server = None # the listening container, for the container of one connection
+    imported = False
+
+    def __init__(self):
+        self.pool = collections.deque(maxlen=REQUEST_POOL_SIZE) # USBRequests to reuse, see parse_submit
+        self.payload = bytearray(4096)
+        self.payload_view = memoryview(self.payload)
+        self.hosts = []
+        self.hosts_lock = threading.Lock()
+        self.connections = 0
 
     def add_usb_device(self, usb_device):
         self.usb_devices.append(usb_device)
@@ -470,55 +797,173 @@ class USBContainer(object):
                             bNumConfigurations=usb_dev.bNumConfigurations,
                             bConfigurationValue=usb_dev.bConfigurationValue,
                             bNumInterfaces=usb_dev.bNumInterfaces,
-                            interfaces=USBInterface(bInterfaceClass=usb_dev.configurations[0].interfaces[0].bInterfaceClass,
-                                                    bInterfaceSubClass=usb_dev.configurations[0].interfaces[0].bInterfaceSubClass,
-                                                    bInterfaceProtocol=usb_dev.configurations[0].interfaces[0].bInterfaceProtocol))
+                            interfaces=usb_dev.interface_list())
+
+    def parse_submit(self, data):
+        # Only the USB/IP reader takes requests from the pool; devices put them back from
+        # any thread when they complete them (USBRequest.release).
+        pool = self.pool
+        usb_req = pool.pop() if pool else USBRequest()
+        usb_req.unpack_from(data)
+        usb_req.pool = pool
+        return usb_req
+
+    def read_submit_payload(self, usb_req):
+        # OUT data and then, for isochronous URBs, the packet descriptors follow the header.
+        # Non-isochronous URBs have number_of_packets 0, or 0xFFFFFFFF from newer kernels.
+        # Both are read into one reusable buffer; usb_req.data is a memoryview of it that
+        # is only valid until the next URB is read, so handlers copy what they keep.
+        length = usb_req.transfer_buffer_length if usb_req.direction == 0 else 0
+        packets = usb_req.numberOfPackets if 0 < usb_req.numberOfPackets < 0xFFFFFFFF else 0
+        size = length + packets * ISO_PACKET_SIZE
+        if not size:
+            return True
+        if size > len(self.payload):
+            self.payload = bytearray(max(size, 2 * len(self.payload)))
+            self.payload_view = memoryview(self.payload)
+        if self.channel.read_into(self.payload_view[:size]) < size:
+            return False
+        if length:
+            usb_req.data = self.payload_view[:length]
+        if packets:
+            usb_req.iso_packets = iso_packets(self.payload, length, size, self.channel.endianForWriting)
+        return True
 
     def detach(self):
         self.usb_devices[0].detach()
 
-    def run(self, ip='0.0.0.0', port=3240, forceIP=False):
-        self.ipMode = forceIP or not os.name == 'nt'
+    def serve(self):
+        # Requests from the connection on self.channel until it ends. Until the connection
+        # imports the device it may only list devices or import; from then on every message
+        # is a CMD_SUBMIT or CMD_UNLINK for that device.
+        submit_size = CMD_SUBMIT.size
+        header = bytearray(submit_size)
+        header_view = memoryview(header)
+        req = USBIPHeader()
+        while self.running:
+            if not self.imported:
+                data = self.channel.read(8)
+                if len(data) < 8:
+                    break
+                req.unpack(data)
+                log.debug("Header packet, command 0x%x", req.command)
+                if req.command == 0x8005:
+                    log.info("List of devices")
+                    self.channel.write(self.handle_device_list().pack())
+                elif req.command == 0x8003:
+                    busID = self.channel.read(32).rstrip(b'\0')
+                    status = self.server.claim(self, busID) if self.server is not None else ST_OK
+                    if status != ST_OK:
+                        log.warning("Refusing import of %s, status %d", busID, status)
+                        self.channel.write(USBIPHeader(command=3, status=status).pack())
+                        continue
+                    log.info("Attach device")
+                    self.channel.write(self.handle_attach().pack())
+                    self.imported = True
+                else:
+                    log.warning("Unexpected command 0x%x before import", req.command)
+                    break
+            else:
+                if self.channel.read_into(header_view) < submit_size:
+                    break
+                usb_req = self.parse_submit(header)
+                if usb_req.command == 0x2: # CMD_UNLINK; the seqnum to unlink is in the flags field
+                    found = self.usb_devices[0].handle_unlink(usb_req.flags)
+                    self.channel.write(RET_SUBMIT_HEADER[self.channel.endianForWriting].pack(0x4, usb_req.seqnum, 0, 0, 0,
+                        (ECONNRESET & 0xFFFFFFFF) if found else 0, 0, 0, 0, 0, 0))
+                    usb_req.release()
+                    continue
+                if not self.read_submit_payload(usb_req):
+                    break
+                self.usb_devices[0].handle_usb_request(usb_req)
+
+    def serve_hosts(self):
+        # Every connection is served by a container and a thread of its own, so listing
+        # devices or a second import are answered at once while a host is attached.
+        # With max_hosts 1 the connection that imports first gets usb_devices[0] until it
+        # disconnects; others are told the device is busy. With more, each host that
+        # imports gets a device of its own from device_factory and sees every update.
+        while self.running:
+            self.add_connection(self.channel.accept())
+
+    def add_connection(self, channel):
+        host = USBContainer()
+        host.ipMode = True
+        host.server = self
+        host.channel = channel
+        host.usb_devices = self.usb_devices # describes the device until it is imported
+        self.connections += 1
+        t = threading.Thread(target=self.serve_host, args=(host,), name='usbip host %d' % self.connections)
+        t.daemon = True
+        t.start()
+        return host
+
+    def connect(self):
+        # In-process loopback, no listening socket needed: one end of a socketpair is served
+        # like an accepted connection, the other is returned for a host in this process
+        # (USBIPClient(sock=...)).
+        mine, theirs = socket.socketpair()
+        self.add_connection(CommunicationChannel(conn=mine, endianForWriting='>'))
+        return theirs
+
+    def claim(self, host, busID):
+        # OP_REQ_IMPORT on one of our connections: gives it a device, or returns why not.
+        if busID != b'1-1':
+            return ST_NODEV
+        self.hosts_lock.acquire()
+        try:
+            if len(self.hosts) >= self.max_hosts:
+                return ST_DEV_BUSY
+            device = self.device_factory() if self.max_hosts > 1 else self.usb_devices[0]
+            device.channel = host.channel
+            device.attached = True
+            host.usb_devices = [device]
+            self.hosts.append(host)
+            return ST_OK
+        finally:
+            self.hosts_lock.release()
+
+    def serve_host(self, host):
+        try:
+            host.serve()
+        except socket.error as e:
+            log.warning("Host connection failed: %s", str(e))
+        finally:
+            host.channel.close()
+            if host.imported:
+                # The next host to import starts from a freshly plugged-in device.
+                device = host.usb_devices[0]
+                device.attached = False
+                if self.max_hosts > 1:
+                    device.close()
+                else:
+                    device.reset()
+                self.hosts_lock.acquire()
+                self.hosts.remove(host)
+                self.hosts_lock.release()
+                log.info("Host disconnected, %d still attached", len(self.hosts))
+
+    def run(self, ip='127.0.0.1', port=3240, forceIP=False, path=None):
+        # Listens on a Unix-domain socket when path is given, else on TCP ip:port; pass
+        # ip='0.0.0.0' for hosts on other machines.
+        self.ipMode = forceIP or path is not None or not os.name == 'nt'
         if not self.ipMode:
             self.channel = CommunicationChannel(filename=windows_utils.getVBUSNodeName(),endianForWriting='<') 
         else:
-            self.channel = CommunicationChannel(ip=ip, port=port,endianForWriting='>')
-        self.usb_devices[0].channel = self.channel
-        self.usb_devices[0].attach()
-        while self.running:
-            self.channel.acceptConnection()
-            req = USBIPHeader()
+            self.channel = CommunicationChannel(ip=ip, port=port, path=path, endianForWriting='>')
+        if self.ipMode:
+            try:
+                self.serve_hosts()
+            finally:
+                self.channel.close() # also on ctrl-c, so no socket file is left behind
+        else:
+            # the vbus driver has the device imported once it is plugged in
+            self.usb_devices[0].channel = self.channel
+            self.usb_devices[0].attach()
+            self.imported = True
             while self.running:
-                if not self.usb_devices[0].attached:
-                    data = self.channel.read(8)
-                    if not data:
-                        break
-                    req.unpack(data)
-                    print('Header Packet')
-                    print('command:', hex(req.command))
-                    if req.command == 0x8005:
-                        print('list of devices')
-                        self.channel.write(self.handle_device_list().pack())
-                    elif req.command == 0x8003:
-                        print('attach device')
-                        self.channel.read(32)  # receive bus id
-                        self.channel.write(self.handle_attach().pack())
-                        self.usb_devices[0].attached = True
-                else:
-                    cmd = USBIPCMDSubmit()
-                    data = self.channel.read(cmd.size())
-                    cmd.unpack(data)
-                    usb_req = USBRequest(seqnum=cmd.seqnum,
-                                         devid=cmd.devid,
-                                         direction=cmd.direction,
-                                         ep=cmd.ep,
-                                         flags=cmd.transfer_flags,
-                                         numberOfPackets=cmd.number_of_packets,
-                                         interval=cmd.interval,
-                                         setup=cmd.setup,
-                                         data=data)
-                    self.usb_devices[0].handle_usb_request(usb_req)
-            self.channel.closeConnection()
+                self.serve()
+                self.usb_devices[0].cancel_urbs()
         if self.usb_devices[0].detaching:
             while self.usb_devices[0].detaching:
                 sleep(0.5)
@@ -0,0 +1,861 @@
+from __future__ import print_function
+try:
+    import builtins
+except:
+    import __builtin__
+    builtins = __builtin__
+import gc
+import getopt
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import tracemalloc
+from time import perf_counter, sleep
+
+# Hardware-free benchmarks of the emulator hot paths, compared against bench_baseline.json:
+#     python bench.py              run and compare, exit status 1 on a regression
+#     python bench.py --save       store the current results as the new baseline
+#     python bench.py --noise      measure how much each baseline entry varies between runs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'bench_baseline.json')
+THRESHOLD = 0.3
+NOISE_RUNS = 8 # measurements of each benchmark when its noise is recorded
+RERUNS = 4 # extra measurements of a suspected regression, a second apart; the median counts
+
+sys.path.insert(0, HERE)
+builtins.USBIP_VERSION = 273
+import USBIP
+from USBIP import BaseStucture, USBDevice, USBContainer, USBIPCMDSubmit, USBIPRETSubmit, USBRequest, \
+    DeviceConfigurations, InterfaceDescriptor, EndPoint, rev
+from bench_harness import load3d
+import buttons_bench
+import gctune
+import injection
+import logs
+import profiler
+import spaceball_sim
+
+sb = load3d()
+
+BENCHMARKS = []
+CHECKS = []
+
+def benchmark(name, ops=1):
+    # The decorated setup function returns a callable that performs `ops` operations per call.
+    def register(setup):
+        BENCHMARKS.append((name, setup, ops))
+        return setup
+    return register
+
+def check(name):
+    # The decorated function returns (ok, description); a failed check fails the run.
+    def register(f):
+        CHECKS.append((name, f))
+        return f
+    return register
+
+class NullChannel(object):
+    endianForWriting = '>'
+
+    def write(self, data):
+        pass
+
+class BufferChannel(object):
+    # Stands in for a CommunicationChannel that has data to read.
+    def __init__(self, data, endianForWriting='>'):
+        self.data = data
+        self.endianForWriting = endianForWriting
+
+    def read_into(self, view):
+        n = min(len(view), len(self.data))
+        view[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+class StreamSerial(object):
+    # Stands in for the pyserial connection in serialLoop; ends the loop at end of stream.
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.timeout = sb.TIMEOUT
+
+    def read(self, n=1):
+        if self.pos >= len(self.data):
+            sb.running = False
+            return b''
+        d = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return d
+
+class ReplySerial(object):
+    # Stands in for the pyserial connection during init: records the commands written and
+    # answers them as spaceball_sim.py does for the model.
+    def __init__(self, model, drop=0):
+        self.commands = []
+        self.drop = drop # writes of commands lost on the line
+        self.replies = b''
+        self.timeout = sb.TIMEOUT
+        self.stopbits = 1
+        self.sim = spaceball_sim.SpaceBallSimulator.__new__(spaceball_sim.SpaceBallSimulator)
+        self.sim.model = model
+        self.sim.followPeriod = False
+        self.sim.stats = { 'commandsReceived': 0, 'beeps': 0 }
+        self.sim.write = self.reply
+
+    def reply(self, data):
+        self.replies += data
+
+    @property
+    def in_waiting(self):
+        return len(self.replies)
+
+    def write(self, data):
+        commands = [command for command in data.split(b'\r')[:-1] if command]
+        if commands and self.drop:
+            self.drop -= 1
+            return
+        for command in commands:
+            self.commands.append(command)
+            self.sim.respond(command)
+
+    def read(self, n=1):
+        data, self.replies = self.replies[:n], self.replies[n:]
+        return data
+
+def sample(cls):
+    values = {}
+    for field in cls._fields_:
+        if isinstance(field[1], BaseStucture):
+            values[field[0]] = sample(type(field[1]))
+        elif field[1].endswith('s'):
+            values[field[0]] = b'1-1'
+        elif field[0] == 'version':
+            values[field[0]] = builtins.USBIP_VERSION
+        else:
+            values[field[0]] = 1
+    obj = cls(**values)
+    if cls is USBIPRETSubmit:
+        obj.data = b'\0' * 13
+    return obj
+
+def structures():
+    classes = [c for c in vars(USBIP).values() if isinstance(c, type) and issubclass(c, BaseStucture) and c is not BaseStucture]
+    classes.append(sb.HIDClass)
+    return sorted(classes, key=lambda c: c.__name__)
+
+def registerStructures():
+    for cls in structures():
+        def packSetup(cls=cls):
+            return sample(cls).pack
+        benchmark('pack.' + cls.__name__)(packSetup)
+        if not any(isinstance(field[1], BaseStucture) for field in cls._fields_):
+            def unpackSetup(cls=cls):
+                obj = sample(cls)
+                packed = BaseStucture.pack(obj)
+                return lambda: obj.unpack(packed)
+            benchmark('unpack.' + cls.__name__)(unpackSetup)
+
+registerStructures()
+
+def submitHeader(ep=1, setup=(0, 0, 0, 0, 0), length=64, packets=0):
+    # setup is (bmRequestType, bRequest, wValue, wIndex, wLength), packed as on the wire
+    return USBIPCMDSubmit(command=1, seqnum=7, devid=0x10002, direction=1, ep=ep, transfer_flags=0,
+                          transfer_buffer_length=length, start_frame=0, number_of_packets=packets, interval=10,
+                          setup=struct.unpack('>Q', struct.pack('<BBHHH', *setup))[0]).pack()
+
+@benchmark('usbcontainer.parse_submit')
+def parseSubmit():
+    # a request comes from the pool and goes back when its reply is sent
+    container = USBContainer()
+    data = submitHeader()
+    return lambda: container.parse_submit(data).release()
+
+@benchmark('usbrequest.unpack_from.control')
+def unpackControl():
+    # the control path decodes a CMD_SUBMIT and its setup packet in one struct call, without
+    # going through StandardDeviceRequest.unpack
+    usb_req = USBRequest()
+    data = submitHeader(ep=0, setup=(0x80, 6, 0x0100, 0, 18), length=18)
+    return lambda: usb_req.unpack_from(data)
+
+@benchmark('usbdevice.send_usb_req')
+def sendUsbReq():
+    dev = sb.USBHID()
+    dev.channel = NullChannel()
+    req = USBRequest(seqnum=7, devid=0, direction=1, ep=1, flags=0, numberOfPackets=0, interval=10, data=b'')
+    report = b'\1' * 13
+    return lambda: dev.send_usb_req(req, report)
+
+FRAMES = 500
+
+@benchmark('serial.framing', ops=FRAMES)
+def serialFraming():
+    sim = spaceball_sim
+    stream = b''.join(sim.escape(sim.motionFrame(i, (i, -i, 13, 17, 0x5E5E, 0x1111))) + b'\r' for i in range(FRAMES))
+    mouse = sb.FLX()
+    mouse.processData = lambda data: None
+    sb.persistentOpen = lambda: None
+    def op():
+        sb.currentMouse = mouse
+        sb.conn = StreamSerial(stream)
+        sb.running = True
+        sb.serialLoop()
+        sb.running = True
+    return op
+
+mouseFLX = sb.FLX()
+mouseX003 = sb.X003()
+mouse2003 = sb.Spaceball2003()
+mouseMagellan = sb.Magellan()
+
+@benchmark('flx.processData.motion')
+def processMotion():
+    data = bytearray(spaceball_sim.motionFrame(1, (100, -200, 300, -400, 500, -600)))
+    return lambda: mouseFLX.processData(data)
+
+@benchmark('flx.processData.buttons')
+def processButtonsFLX():
+    data = bytearray(spaceball_sim.flxButtonFrame(0b100000000101))
+    return lambda: mouseFLX.processData(data)
+
+@benchmark('x003.processData.buttons')
+def processButtonsX003():
+    data = bytearray(spaceball_sim.x003ButtonFrame(0b101))
+    return lambda: mouseX003.processData(data)
+
+@benchmark('sb2003.processData.buttons')
+def processButtons2003():
+    data = bytearray(spaceball_sim.sb2003ButtonFrame(0b110000101))
+    return lambda: mouse2003.processData(data)
+
+@benchmark('magellan.processData.motion')
+def processMotionMagellan():
+    data = bytearray(spaceball_sim.magellanMotionFrame((100, -200, 300, -400, 500, -600)))
+    return lambda: mouseMagellan.processData(data)
+
+@benchmark('magellan.processData.buttons')
+def processButtonsMagellan():
+    data = bytearray(spaceball_sim.magellanButtonFrame(0b100000101))
+    return lambda: mouseMagellan.processData(data)
+
+@benchmark('trim', ops=4)
+def trim():
+    t = sb.trim
+    def op():
+        t(100)
+        t(-100)
+        t(30000)
+        t(-30000)
+    return op
+
+@benchmark('predictor.add')
+def predictorAdd():
+    predictor = sb.MotionPredictor(0.02)
+    frame = [0.0]
+    xyz = [100, -200, 300]
+    rxyz = [-40, 50, -60]
+    def op():
+        frame[0] += 0.02
+        predictor.add(frame[0], xyz, rxyz)
+    return op
+
+@benchmark('predictor.predict')
+def predictorPredict():
+    predictor = sb.MotionPredictor(0.02)
+    for i in range(4):
+        predictor.add(0.02 * i, [10 * i, -20 * i, 30 * i], [-4 * i, 5 * i, -6 * i])
+    return lambda: predictor.predict(0.07)
+
+def hidDevice(compatible):
+    # A device whose interrupt URBs always find a changed report, so none is parked.
+    sb.compatible = compatible
+    dev = sb.USBHID()
+    sb.compatible = False
+    dev.channel = NullChannel()
+    req = USBRequest(seqnum=7, devid=0, direction=1, ep=1, flags=0, numberOfPackets=0, interval=10, data=b'')
+    return dev, req
+
+def changingReports(compatible):
+    dev, req = hidDevice(compatible)
+    axes = sb.reportAxes
+    def op():
+        axes[0] = (axes[0] + 1) & 0xFF
+        dev.handle_data(req)
+    return op
+
+@benchmark('usbhid.handle_data_fast')
+def handleDataFast():
+    return changingReports(False)
+
+def urbPath(header):
+    # What USBContainer.run does for one URB once its header has been read
+    container = USBContainer()
+    dev, req = hidDevice(False)
+    container.usb_devices = [dev]
+    def op():
+        usb_req = container.parse_submit(header)
+        container.read_submit_payload(usb_req)
+        dev.handle_usb_request(usb_req)
+    return dev, op
+
+@benchmark('urb.interrupt_in')
+def urbInterruptIn():
+    dev, urb = urbPath(submitHeader())
+    axes = sb.reportAxes
+    def op():
+        axes[0] = (axes[0] + 1) & 0xFF
+        urb()
+    return op
+
+@benchmark('urb.control_get_descriptor')
+def urbGetDescriptor():
+    return urbPath(submitHeader(ep=0, setup=(0x80, 6, 0x0100, 0, 18), length=18))[1]
+
+def allocationsPerCall(prepare, op, n=2000):
+    # Largest number of bytes tracemalloc sees allocated during a single call of op in steady
+    # state, including memory that is freed again before the call returns.
+    for i in range(1000):
+        prepare()
+        op()
+    worst = 0
+    tracemalloc.start()
+    try:
+        for i in range(n + 10):
+            prepare()
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            op()
+            if i >= 10: # the first traced calls release objects created before tracing started
+                worst = max(worst, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return worst
+
+@check('usbhid.handle_data allocates nothing per report')
+def fastReportAllocations():
+    dev, req = hidDevice(False)
+    def prepare():
+        sb.lock.acquire()
+        sb.xyz[0] = 1000 if sb.xyz[0] == 100 else 100
+        sb.publishMotion()
+        sb.lock.release()
+    allocated = allocationsPerCall(prepare, lambda: dev.handle_data(req))
+    return allocated == 0 and not dev.parked, "%d bytes allocated per report" % allocated
+
+@check('button transitions between polls are all reported')
+def buttonEdges():
+    # Two clicks and a motion update land between two polls: both presses and releases must be
+    # reported in order, and in the default mode the axes once the queued buttons are all out.
+    results = []
+    for compatible in (False, True):
+        dev, req = hidDevice(compatible)
+        sb.lock.acquire()
+        dev.build_report(0.0)
+        for b in (1, 0, 2):
+            sb.buttons = b
+            sb.publishButtons()
+        sb.xyz[1] = 123 if sb.xyz[1] != 123 else 124
+        sb.publishMotion()
+        sb.buttons = 0
+        sb.publishButtons()
+        reports = []
+        while dev.build_report(1.0):
+            data = dev.reply.data
+            reports.append((data[48], data[49] if data[48] == 3 else None))
+        sb.lock.release()
+        states = [b for reportID, b in reports if reportID == 3]
+        axes = [i for i, r in enumerate(reports) if r[0] != 3]
+        results.append(states == [1, 0, 2, 0] and axes and (compatible or axes == [len(reports) - 1]))
+    return all(results), "default %s, compatible %s" % tuple("ok" if r else "lost or reordered" for r in results)
+
+@check('button transitions over the serial line are all reported')
+def ptyButtonEdges():
+    # The same through spaceball_sim.py on a pty and the serial pipeline, with bursts of button
+    # frames at the 9600 baud line rate and a host polling every 8 ms.
+    r = buttons_bench.run('flx', duration=1.0, poll=0.008)
+    return not r['lost'] and not r['extra'], "%d transitions, %d lost, %d extra" % (r['sent'], r['lost'], r['extra'])
+
+@check('the frame rate drops to 0 when the frames stop')
+def frameRateStale():
+    rate = sb.DataRate()
+    for i in range(50):
+        rate.frame(False)
+    rate.windowStart -= sb.FRAME_RATE_WINDOW # as if they had come over the whole window
+    rate.frame(False)
+    streaming = sb.metrics['frameRate']
+    rate.count(perf_counter() + sb.STALE_PERIODS * rate.period / 1000.0 / 2) # within the periods
+    late = sb.metrics['frameRate']
+    rate.count(perf_counter() + sb.STALE_PERIODS * rate.period / 1000.0 + 0.01)
+    stopped = sb.metrics['frameRate']
+    sb.metrics['frameRate'] = 0.0
+    return streaming > 0 and late == streaming and stopped == 0, \
+        "%.1f/s streaming, %.1f/s after a late frame, %.1f/s stopped" % (streaming, late, stopped)
+
+@check('predicted motion ends at the newest frame')
+def predictionEnds():
+    # A host polls every ms while frames come 20 ms apart: 300, 150, 0 is the ball let go, and
+    # 300, 150, 100 a model that sends only changes, with the ball held still. Once no frame came
+    # for PREDICT_GAP the host must have been sent the newest frame, and nothing is estimated.
+    failed = []
+    for compatible in (False, True):
+        for frames in ((300, 150, 0), (300, 150, 100)):
+            dev, req = hidDevice(compatible)
+            predictor = sb.MotionPredictor(0.02)
+            sb.lock.acquire()
+            try:
+                for step in range(int(1000 * sb.PREDICT_GAP) + 60):
+                    now = 0.001 * step
+                    if step % 20 == 0 and step // 20 < len(frames):
+                        sb.xyz[0] = frames[step // 20]
+                        sb.predictor = None # publishMotion would add the frame at perf_counter()
+                        sb.publishMotion()
+                        sb.predictor = predictor
+                        predictor.add(now, sb.xyz, sb.rxyz)
+                    dev.build_report(now)
+                host = list(dev.sentAxes) if not compatible else list(dev.lastReports[1] + dev.lastReports[2])
+                if host != sb.reportAxes or dev.estimated:
+                    failed.append("%s %s" % ("compatible" if compatible else "default", frames))
+            finally:
+                sb.predictor = None
+                sb.xyz[0] = 0
+                sb.publishMotion()
+                sb.lock.release()
+    return not failed, "wrong after " + ", ".join(failed) if failed else "both modes"
+
+@check('urb path allocates only header ints')
+def urbAllocations():
+    # Header fields above 256 (devid is busnum << 16 | devnum) are new int objects on any path.
+    header = submitHeader()
+    dev, urb = urbPath(header)
+    ints = sum(sys.getsizeof(v) for v in USBIP.CMD_SUBMIT.unpack(header) if v > 256)
+    decoded = USBContainer().parse_submit(submitHeader(ep=0, setup=(0x21, 0x0A, 0x1234, 0x5678, 0x9ABC)))
+    setupOk = (decoded.bmRequestType, decoded.bRequest, decoded.wValue, decoded.wIndex, decoded.wLength) == \
+              (0x21, 0x0A, 0x1234, 0x5678, 0x9ABC)
+    def prepare():
+        sb.reportAxes[0] = (sb.reportAxes[0] + 1) & 0xFF
+    allocated = allocationsPerCall(prepare, urb)
+    return allocated <= ints and setupOk, "%d bytes allocated per URB (%d in header ints), setup packet %s" % (
+        allocated, ints, "ok" if setupOk else "misdecoded")
+
+@check('serial decoders read the simulated frames')
+def serialDecoders():
+    # Every model decodes the frames spaceball_sim.py sends for it, in the order of MODELS.
+    sim = spaceball_sim
+    axes = (100, -200, 300, -400, 5, -6)
+    failed = []
+    for name, mouse, button in (('flx', mouseFLX, 1 << 11), ('x003', mouseX003, 1 << 7), ('2003', mouse2003, 1 << 8),
+                                ('magellan', mouseMagellan, 1 << 8)):
+        s = sim.SpaceBallSimulator.__new__(sim.SpaceBallSimulator)
+        s.model = name
+        mouse.processData(bytearray(s.motionFrame(1, axes)))
+        decoded = [0] * 6
+        for i in range(3):
+            decoded[i] = sb.xyz[mouse.axisMap[i]] * mouse.polarityXYZ[i]
+            decoded[3 + i] = sb.rxyz[mouse.axisMap[i]] * mouse.polarityRXYZ[i]
+        mouse.processData(bytearray(s.buttonFrame(button)))
+        if tuple(decoded) != axes or sb.buttons != button or sb.findModel(name) is not type(mouse):
+            failed.append(name)
+    sb.buttons = 0
+    return not failed, "failed: " + ", ".join(failed) if failed else "flx, x003, 2003, magellan"
+
+@check('injected axes and buttons beyond 16 bits are clamped')
+def injectedRange():
+    if hasattr(socket, 'AF_UNIX'):
+        address = '/tmp/bench_inject_%d.sock' % os.getpid()
+    else:
+        address = '127.0.0.1:%d' % (20000 + os.getpid() % 20000)
+    sb.running = True
+    t = threading.Thread(target=sb.injectLoop, args=(address,))
+    t.daemon = True
+    t.start()
+    sleep(0.2)
+    count = sb.motionCount
+    pressed = sb.buttonsCount
+    injector = injection.Injector(address)
+    injector.send((40000, -40000, 70000), (0x7FFF, -0x8000, -70000), buttons=0x12345)
+    t0 = perf_counter()
+    while (sb.motionCount == count or sb.buttonsCount == pressed) and perf_counter() < t0 + 2:
+        sleep(0.01)
+    injector.close()
+    sb.running = False
+    t.join()
+    sb.running = True
+    dev, req = hidDevice(False)
+    try:
+        dev.handle_data(req) # the buttons report of a host's first poll
+        reported = True
+    except struct.error:
+        reported = False
+    buttons = sb.buttons
+    sb.buttons = 0
+    sb.publishButtons()
+    expected = [sb.trim(v) for v in (0x7FFF, -0x8000, 0x7FFF, 0x7FFF, -0x8000, -0x8000)]
+    return sb.reportAxes == expected and buttons == 0x2345 and reported, \
+        "reported " + ", ".join(str(v) for v in sb.reportAxes) + ", buttons 0x%x" % buttons
+
+@check('isochronous descriptors are read in the byte order of the channel')
+def isoDescriptors():
+    # The Windows vbus channel (endianForWriting '<') has little-endian descriptors.
+    failed = []
+    packets = [(0, 192), (192, 64)]
+    for endian in ('>', '<'):
+        container = USBContainer()
+        descriptor = USBIP.ISO_PACKET_DESCRIPTOR[endian]
+        container.channel = BufferChannel(b''.join(descriptor.pack(offset, length, 0, 0) for offset, length in packets),
+                                          endian)
+        usb_req = container.parse_submit(submitHeader(ep=2, length=256, packets=len(packets)))
+        if not container.read_submit_payload(usb_req) or usb_req.iso_packets != packets:
+            failed.append(endian)
+        usb_req.release()
+    return not failed, "misread with " + ", ".join(failed) if failed else "big- and little-endian"
+
+@check('only sockets are removed from socket paths')
+def socketPaths():
+    if not hasattr(socket, 'AF_UNIX'):
+        return True, "no Unix sockets here"
+    path = os.path.join(tempfile.gettempdir(), 'bench-socket-%d' % os.getpid())
+    failed = []
+    with open(path, 'w') as f:
+        f.write('kept')
+    for name, listen in (('usbip', lambda: USBIP.CommunicationChannel(path=path)),
+                         ('inject', lambda: injection.openReceiver(path))):
+        try:
+            listen().close()
+            failed.append(name + " replaced a file")
+        except OSError:
+            pass
+    with open(path) as f:
+        if f.read() != 'kept':
+            failed.append("file lost")
+    os.remove(path)
+    def interrupted():
+        raise KeyboardInterrupt()
+    container = USBContainer()
+    container.serve_hosts = interrupted
+    try:
+        container.run(path=path)
+    except KeyboardInterrupt:
+        pass
+    if os.path.exists(path):
+        failed.append("usbip socket left")
+    injection.closeReceiver(injection.openReceiver(path), path)
+    if os.path.exists(path):
+        failed.append("inject socket left")
+    return not failed, ", ".join(failed) if failed else "files kept, sockets removed on shutdown"
+
+@check('log messages are rate limited per formatted message')
+def logRateLimit():
+    limit = logs.RateLimit(interval=5.0)
+    def shown(msg, args, created):
+        record = logging.LogRecord(logs.ROOT + '.usbip', logging.WARNING, __file__, 0, msg, args, None)
+        record.created = created
+        return limit.filter(record) and record.getMessage()
+    results = [shown("Host disconnected, %d still attached", (1,), 0.0),
+               shown("Host disconnected, %d still attached", (0,), 0.1),
+               shown("Error %s", ("timeout",), 0.2),
+               shown("Error %s", ("timeout",), 0.3),
+               shown("Error %s", ("timeout",), 6.0)]
+    expected = ["Host disconnected, 1 still attached", "Host disconnected, 0 still attached",
+                "Error timeout", False, "Error timeout (repeated 1 times)"]
+    return results == expected, "; ".join(str(r) for r in results)
+
+@check('the ingest process profiles when the USB/IP process does')
+def profileForwarding():
+    # This process stands in for both: its signals drive a second profiler the way ingestMain's do.
+    if not hasattr(signal, 'SIGUSR2'):
+        return True, "no SIGUSR1 and SIGUSR2 here"
+    previous = [(name, signal.getsignal(getattr(signal, name))) for name, command in profiler.FORWARDED]
+    output = os.path.join(tempfile.gettempdir(), 'bench-profile-%(pid)d.txt')
+    profile = profiler.SamplingProfiler(output=output)
+    ingest = profiler.SamplingProfiler(output=output)
+    profiler.onSignal(lambda command: profiler.control(ingest, command), profiler.FORWARDED)
+    states = []
+    try:
+        for command in (b'toggle', b'start', b'toggle', b'stop', b'toggle', b'toggle'):
+            profiler.control(profile, command)
+            profiler.forward(os.getpid(), profile)
+            deadline = perf_counter() + 1
+            while ingest.running != profile.running and perf_counter() < deadline:
+                sleep(0.01)
+            states.append((profile.running, ingest.running))
+    finally:
+        profile.stop()
+        ingest.stop()
+        for name, handler in previous:
+            signal.signal(getattr(signal, name), handler)
+        if os.path.exists(profile.outputName()):
+            os.remove(profile.outputName())
+    ok = all(here == there for here, there in states)
+    return ok, ", ".join("%s/%s" % ("on" if here else "off", "on" if there else "off") for here, there in states)
+
+@check('a host enumerating does not collect while another streams')
+def settleAlone():
+    # The report descriptor fetch settles the heap, on the USB/IP reader thread of that host.
+    settled = []
+    settle = gctune.settle
+    gctune.settle = settled.append
+    try:
+        for streaming in (False, True):
+            dev, req = hidDevice(False)
+            other, req = hidDevice(False)
+            if streaming:
+                sb.addConsumer(other.event)
+            container = USBContainer()
+            dev.handle_usb_request(container.parse_submit(submitHeader(ep=0, setup=(0x81, 6, 0x2200, 0, 256),
+                                                                       length=256)))
+            sb.removeConsumer(other.event)
+    finally:
+        gctune.settle = settle
+    return len(settled) == 1, "%d of 2 fetches settled, 1 expected" % len(settled)
+
+@check("garbage cycles are collected in gc 'off' mode")
+def collectedWhenOff():
+    # With a short interval and threshold, cycles that pile up must be collected by the 'gc' thread.
+    interval, threshold = gctune.OFF_INTERVAL, gctune.OFF_THRESHOLD
+    gctune.OFF_INTERVAL, gctune.OFF_THRESHOLD = 0.02, 20000
+    try:
+        gctune.settle('off')
+        for i in range(30000):
+            a = []
+            a.append(a)
+        deadline = perf_counter() + 1
+        while gc.get_count()[0] >= gctune.OFF_THRESHOLD and perf_counter() < deadline:
+            sleep(0.01)
+        left = gc.get_count()[0]
+    finally:
+        gctune.OFF_INTERVAL, gctune.OFF_THRESHOLD = interval, threshold
+        gc.enable()
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+    return left < 20000, "%d objects left uncollected" % left
+
+@check('init commands go out in their order')
+def initOrder():
+    # Acknowledgements are matched in any order, but a handshake (X003 hv, Magellan vQ before
+    # m3 starts the stream) must reach the device before the commands after it.
+    failed = []
+    conn = sb.conn
+    for names, model in sb.MODELS:
+        mouse = model()
+        sb.conn = ReplySerial(spaceball_sim.modelName(names[0]))
+        mouse.init()
+        if sb.conn.commands != [c[0] for c in mouse.initCommands()]:
+            failed.append(names[0])
+    sb.conn = conn
+    return not failed, "reordered: " + ", ".join(failed) if failed else ", ".join(names[0] for names, model in sb.MODELS)
+
+@check('init commands lost with the first write go out again')
+def initRetry():
+    # A device that misses the whole first batch must still get every command, in order.
+    failed = []
+    conn = sb.conn
+    timeout = sb.COMMAND_TIMEOUT
+    sb.COMMAND_TIMEOUT = 0.05
+    try:
+        for names, model in sb.MODELS:
+            mouse = model()
+            sb.conn = ReplySerial(spaceball_sim.modelName(names[0]), drop=1)
+            try:
+                mouse.init()
+            except sb.serial.SerialException:
+                pass
+            expected = [c[0] for c in mouse.initCommands()]
+            if any(c[1] is not False for c in mouse.initCommands()) and sb.conn.commands != expected:
+                failed.append(names[0])
+    finally:
+        sb.conn = conn
+        sb.COMMAND_TIMEOUT = timeout
+    return not failed, "incomplete: " + ", ".join(failed) if failed else "every model that waits for an acknowledgement"
+
+@check('composite configuration descriptor is consistent')
+def compositeConfiguration():
+    # two HID interfaces with two interrupt endpoints each, one of them with an alternate setting
+    dev = sb.USBHID()
+    configuration = DeviceConfigurations(bConfigurationValue=1)
+    configuration.interfaces = []
+    for number, alternate in ((0, 0), (1, 0), (1, 1)):
+        interface = InterfaceDescriptor(bInterfaceNumber=number, bAlternateSetting=alternate, bInterfaceProtocol=number)
+        interface.descriptions = [dev.configurations[0].interfaces[0].descriptions[0]]
+        interface.endpoints = [EndPoint(bEndpointAddress=0x81 + 2 * number), EndPoint(bEndpointAddress=0x82 + 2 * number)]
+        configuration.interfaces.append(interface)
+    dev.configurations = [configuration]
+    dev.generate_raw_configuration()
+    raw = dev.all_configurations
+    container = USBContainer()
+    container.usb_devices = [dev]
+    devlist = container.handle_device_list().pack()
+    single = USBContainer()
+    single.usb_devices = [sb.USBHID()]
+    ok = (rev(configuration.wTotalLength) == len(raw) == 9 + 3 * (9 + 9 + 2 * 7) and raw[4] == 2 and raw[13] == 2 and
+          len(devlist) == len(single.handle_device_list().pack()) + 4)
+    return ok, "wTotalLength %d for %d bytes, %d interfaces, devlist %d bytes" % (rev(configuration.wTotalLength), len(raw),
+                                                                                raw[4], len(devlist))
+
+@benchmark('usbhid.handle_data_compatible')
+def handleDataCompatible():
+    return changingReports(True)
+
+def calibrate(op, target):
+    n = 1
+    while True:
+        t0 = perf_counter()
+        for i in range(n):
+            op()
+        elapsed = perf_counter() - t0
+        if elapsed >= target / 10:
+            break
+        n *= 4
+    return max(1, int(n * target / elapsed))
+
+def timed(op, n):
+    t0 = perf_counter()
+    for i in range(n):
+        op()
+    return perf_counter() - t0
+
+def reference():
+    # Fixed pure-Python workload timed next to every benchmark; comparing ratios against it
+    # cancels out how fast this machine happens to be running right now.
+    x = 0
+    for i in range(200):
+        x += i & 7
+    return x
+
+def measure(op, ops, repeat=5, target=0.1):
+    # Short reference and benchmark rounds are interleaved so that both see the same machine
+    # speed; the best ratio of a pair is kept rather than the ratio of two unrelated bests.
+    n = calibrate(op, target / repeat)
+    m = calibrate(reference, target / repeat / 4)
+    best = ratio = None
+    for r in range(repeat * 3):
+        ref = timed(reference, m) * 1e6 / m
+        us = timed(op, n) * 1e6 / (n * ops)
+        ref = min(ref, timed(reference, m) * 1e6 / m)
+        best = us if best is None else min(best, us)
+        ratio = us / ref if ratio is None else min(ratio, us / ref)
+    return { 'us': best, 'ref': best / ratio }
+
+def change(result, base):
+    return (result['us'] / result['ref']) / (base['us'] / base['ref']) - 1
+
+def regressed(result, base, threshold):
+    # Slower than threshold allows beyond the noise recorded for this benchmark. Between runs a
+    # sub-microsecond decoder strays by 20% or more against the reference while a struct unpack
+    # stays within 5%, so no single floor fits both: one in microseconds leaves the cheapest
+    # paths ungated, one in percent fails the noisy ones on a slow second of the machine.
+    return change(result, base) > threshold + base.get('noise', 0.0)
+
+def measureNoise(baseline, names, repeat=5, target=0.1):
+    # Half the range of NOISE_RUNS changes against the baseline: how far one measurement of
+    # unchanged code strays from the middle of its runs.
+    changes = dict((name, []) for name in names)
+    for i in range(NOISE_RUNS):
+        for name, result in run(repeat=repeat, target=target, names=names).items():
+            changes[name].append(change(result, baseline[name]))
+    return dict((name, (max(c) - min(c)) / 2) for name, c in changes.items())
+
+def run(filter=None, repeat=5, target=0.1, names=None):
+    results = {}
+    for name, setup, ops in BENCHMARKS:
+        if (filter and filter not in name) or (names is not None and name not in names):
+            continue
+        results[name] = measure(setup(), ops, repeat=repeat, target=target)
+    return results
+
+def report(results, baseline, threshold):
+    regressions = []
+    print("%-40s %10s %12s %10s %8s" % ("benchmark", "us/op", "ops/s", "baseline", "change"))
+    for name in sorted(results):
+        us = results[name]['us']
+        base = baseline.get(name)
+        if base:
+            c = change(results[name], base)
+            flag = " REGRESSION" if regressed(results[name], base, threshold) else ""
+            print("%-40s %10.3f %12.0f %10.3f %+7.0f%%%s" % (name, us, 1e6 / us, base['us'], 100 * c, flag))
+            if flag:
+                regressions.append(name)
+        else:
+            print("%-40s %10.3f %12.0f %10s %8s" % (name, us, 1e6 / us, "-", "new"))
+    return regressions
+
+if __name__ == '__main__':
+    save = False
+    noise = False
+    filter = None
+    threshold = THRESHOLD
+    baselineFile = BASELINE
+    repeat = 5
+    target = 0.1
+    opts, args = getopt.getopt(sys.argv[1:], "hsnqf:t:b:", ["help", "save", "noise", "quick", "filter=", "threshold=", "baseline="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python bench.py [options]\n
+-h --help                this information
+-s --save                store the results as the new baseline, with their noise
+-n --noise               only record the noise of the baseline entries
+-q --quick               fewer and shorter repetitions
+-fTEXT --filter=TEXT     only run benchmarks whose name contains TEXT
+-tFRAC --threshold=FRAC  allowed slowdown against the baseline (default 0.3)
+-bFILE --baseline=FILE   baseline file (default bench_baseline.json)""")
+            sys.exit(0)
+        elif opt in ('-s', '--save'):
+            save = True
+        elif opt in ('-n', '--noise'):
+            noise = True
+        elif opt in ('-q', '--quick'):
+            repeat = 3
+            target = 0.03
+        elif opt in ('-f', '--filter'):
+            filter = arg
+        elif opt in ('-t', '--threshold'):
+            threshold = float(arg)
+        elif opt in ('-b', '--baseline'):
+            baselineFile = arg
+
+    baseline = {}
+    if os.path.exists(baselineFile):
+        with open(baselineFile) as f:
+            baseline = json.load(f)
+    results = run(filter=filter, repeat=repeat, target=target)
+    # a slow sample on a busy machine is re-measured before it counts as a regression, and the
+    # median of the measurements is kept
+    suspects = [name for name in results if name in baseline and regressed(results[name], baseline[name], threshold)]
+    if suspects and not (save or noise):
+        samples = dict((name, [results[name]]) for name in suspects)
+        for i in range(RERUNS):
+            sleep(1)
+            for name, result in run(repeat=repeat, target=target, names=suspects).items():
+                samples[name].append(result)
+        for name in suspects:
+            samples[name].sort(key=lambda result: change(result, baseline[name]))
+            results[name] = samples[name][len(samples[name]) // 2]
+    regressions = report(results, baseline, threshold)
+    failed = []
+    for name, f in CHECKS:
+        if filter and filter not in name:
+            continue
+        ok, description = f()
+        print("%-52s %s (%s)" % (name, "ok" if ok else "FAILED", description))
+        if not ok:
+            failed.append(name)
+    if save:
+        baseline.update(results)
+    if save or noise:
+        for name, n in measureNoise(baseline, [name for name in results if name in baseline], repeat, target).items():
+            baseline[name]['noise'] = n
+        with open(baselineFile, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print("Saved baseline to " + baselineFile)
+    elif regressions and not noise:
+        print("Regressed beyond %.0f%% and their noise: %s" % (100 * threshold, ", ".join(regressions)))
+    if failed:
+        print("Failed checks: " + ", ".join(failed))
+    if (regressions and not (save or noise)) or failed:
+        sys.exit(1)
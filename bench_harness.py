@@ -0,0 +1,101 @@
+from __future__ import print_function
+try:
+    import builtins
+except:
+    import __builtin__
+    builtins = __builtin__
+import importlib.util
+import multiprocessing
+import os
+import sys
+import threading
+from time import sleep
+import logs
+
+# What the hardware-free benchmarks share: a fresh copy of 3d.py, its log and print output out
+# of the way, its serial pipeline reading a SpaceBall (usually spaceball_sim.py on a pty), a
+# USB/IP server on a free port, and processes that keep the CPUs busy.
+#     sb = load3d()
+#     with Quiet():
+#         startSerial(sb, link, 'flx')
+#         ...
+#         sb.running = False
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Never closed: serial and report threads still winding down after a run may log.
+devnull = open(os.devnull, 'w')
+
+def load3d():
+    spec = importlib.util.spec_from_file_location('spaceball3d', os.path.join(HERE, '3d.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    builtins.USBIP_VERSION = 273
+    return module
+
+class Quiet(object):
+    # Within the with block the emulator's log records and prints go nowhere. setupLogs=False
+    # leaves logging to the caller, for runs that measure a particular log configuration.
+    def __init__(self, setupLogs=True):
+        self.setupLogs = setupLogs
+
+    def __enter__(self):
+        if self.setupLogs:
+            logs.setup(stream=devnull)
+        self.stdout = sys.stdout
+        sys.stdout = devnull
+        return self
+
+    def __exit__(self, *exc):
+        sys.stdout = self.stdout
+        logs.stop()
+        return False
+
+def startSerial(sb, port, model='flx', wait=True):
+    # Runs the serial pipeline of sb on port, with its write thread when sb.serialCommands is
+    # set, and returns the reading thread, by default once the first motion frame is in.
+    sb.port = port
+    sb.currentMouse = sb.findModel(model)()
+    serial = threading.Thread(target=sb.serialLoop, name='serial')
+    serial.daemon = True
+    serial.start()
+    if sb.serialCommands is not None:
+        writer = threading.Thread(target=sb.serialWriteLoop, name='serial write')
+        writer.daemon = True
+        writer.start()
+    while wait and not sb.motionCount:
+        sleep(0.01)
+    return serial
+
+def startServer(sb, hosts=None):
+    # A USB/IP server with one USBHID on a free port of 127.0.0.1: (container, port). With
+    # hosts, up to that many hosts get a device of their own, as with 3d.py -H.
+    container = sb.USBContainer()
+    container.usb_devices = [sb.USBHID()]
+    if hosts is not None:
+        container.device_factory = sb.USBHID
+        container.max_hosts = hosts
+    t = threading.Thread(target=container.run, kwargs={ 'ip': '127.0.0.1', 'port': 0, 'forceIP': True })
+    t.daemon = True
+    t.start()
+    while not hasattr(container, 'channel'):
+        sleep(0.01)
+    return container, container.channel.socket.getsockname()[1]
+
+def burn():
+    x = 0
+    while True:
+        x += 1
+
+def startBurners(n):
+    # n forked processes that each keep a CPU busy, as other load on the host would
+    ctx = multiprocessing.get_context('fork')
+    burners = [ctx.Process(target=burn) for i in range(n)]
+    for p in burners:
+        p.start()
+    return burners
+
+def stopBurners(burners):
+    for p in burners:
+        p.terminate()
+        p.join()
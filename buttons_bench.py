@@ -0,0 +1,132 @@
+from __future__ import print_function
+import getopt
+import os
+import sys
+import threading
+from time import perf_counter, sleep
+
+# Button transitions at the highest rate the serial line carries: spaceball_sim.py on a pty
+# follows every data frame with a burst of button frames, each toggling a button, paced like
+# the real line. The serial pipeline decodes them and a stand-in host thread keeps one
+# interrupt URB pending on the USBHID device, resubmitting it one poll interval after it
+# completed. Every button state the simulator sent must arrive as a report of its own, in
+# order; the motion reports in between are counted.
+#     python buttons_bench.py                 every model at 9600 baud
+#     python buttons_bench.py -M flx -B 115200 -b 8
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from bench_harness import load3d, Quiet, startSerial
+from jitter_bench import hostLoop, summarize
+import spaceball_sim
+
+class ReportChannel(object):
+    endianForWriting = '>'
+
+    def __init__(self):
+        self.buttons = [] # (perf_counter, buttons) of every buttons report
+        self.motion = 0
+        self.done = threading.Event()
+
+    def write(self, data):
+        if data[48] == 3:
+            self.buttons.append((perf_counter(), data[49] | (data[50] << 8)))
+        elif data[48] == 1:
+            self.motion += 1
+        self.done.set()
+
+def compare(sent, received):
+    # Matches the reported states to the sent ones in order: (latencies, lost, extra).
+    # A state equal to the one before it is no transition and is not reported.
+    expected = []
+    last = 0
+    for t, b in sent:
+        if b != last:
+            expected.append((t, b))
+            last = b
+    latencies = []
+    lost = extra = 0
+    i = 0
+    for t, b in received:
+        j = i
+        while j < len(expected) and expected[j][1] != b:
+            j += 1
+        if j == len(expected):
+            extra += 1 # not sent, or out of order
+            continue
+        lost += j - i
+        latencies.append(t - expected[j][0])
+        i = j + 1
+    return latencies, lost + len(expected) - i, extra
+
+def run(model, baud=9600, burst=4, rate=50, duration=3.0, poll=0.001, drain=0.3):
+    sb = load3d()
+    link = '/tmp/buttons_bench_%d' % os.getpid()
+    sim = spaceball_sim.SpaceBallSimulator(model=model, rate=rate, link=link, baud=baud, seed=1,
+                                           buttonInterval=0)
+    with Quiet():
+        try:
+            sim.start()
+            startSerial(sb, link, model)
+            channel = ReportChannel()
+            dev = sb.USBHID()
+            dev.channel = channel
+            req = sb.USBRequest(seqnum=1)
+            host = threading.Thread(target=hostLoop, args=(dev, req, channel, duration + drain, poll))
+            host.start()
+            sim.burst = burst
+            sleep(duration)
+            sim.burst = 0
+            host.join()
+            sb.running = False
+            # the first report is the state when the host started polling, all buttons up
+            latencies, lost, extra = compare(sim.buttonLog, channel.buttons[1:])
+            r = summarize(latencies) if latencies else { 'p50': 0.0, 'p99': 0.0, 'max': 0.0 }
+            r.update({ 'sent': len(sim.buttonLog), 'received': len(channel.buttons) - 1, 'lost': lost, 'extra': extra,
+                       'motion': channel.motion, 'drops': sb.metrics['buttonEdgeDrops'] })
+            return r
+        finally:
+            sim.stop()
+
+if __name__ == '__main__':
+    models = spaceball_sim.MODELS
+    baud = 9600
+    burst = 4
+    rate = 50
+    duration = 3.0
+    poll = 0.001
+    opts, args = getopt.getopt(sys.argv[1:], "hM:B:b:r:t:P:", ["help", "model=", "baud=", "burst=", "rate=", "time=",
+                                                              "poll="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python buttons_bench.py [options]\n
+-h --help                this information
+-Mmodels --model=models  models to measure, comma separated (default all)
+-BBAUD --baud=BAUD       serial line speed (default 9600); 0 writes as fast as the pty takes it
+-bN --burst=N            button frames after every data frame (default 4)
+-rHZ --rate=HZ           data frames per second (default 50)
+-tSEC --time=SEC         measure each model for SEC seconds (default 3)
+-PSEC --poll=SEC         host poll interval (default 0.001)""")
+            sys.exit(0)
+        elif opt in ('-M', '--model'):
+            models = [spaceball_sim.modelName(m) for m in arg.split(',')]
+        elif opt in ('-B', '--baud'):
+            baud = int(arg) or None
+        elif opt in ('-b', '--burst'):
+            burst = int(arg)
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt in ('-t', '--time'):
+            duration = float(arg)
+        elif opt in ('-P', '--poll'):
+            poll = float(arg)
+    print("%-9s %8s %8s %6s %6s %8s %8s %8s %8s" % ("model", "edges/s", "reports", "lost", "extra", "motion",
+                                                    "p50", "p99", "max"))
+    print("%-9s %8s %8s %6s %6s %8s %8s %8s %8s" % ("", "sent", "buttons", "", "", "reports", "ms", "ms", "ms"))
+    failed = False
+    for model in models:
+        r = run(model, baud=baud, burst=burst, rate=rate, duration=duration, poll=poll)
+        print("%-9s %8.0f %8d %6d %6d %8d %8.2f %8.2f %8.2f" % (model, r['sent'] / duration, r['received'], r['lost'],
+              r['extra'], r['motion'], 1000 * r['p50'], 1000 * r['p99'], 1000 * r['max']))
+        failed = failed or r['lost'] or r['extra']
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,122 @@
+from __future__ import print_function
+import getopt
+import os
+import socket
+import struct
+import sys
+from time import perf_counter
+
+# Time from OP_REQ_IMPORT to the first HID report of the emulated SpaceMouse, with the
+# stand-in host in usbip_client.py replaying the control requests a host sends while it
+# enumerates the device. A request the device does not answer costs the host's control
+# timeout, as it would with a real host driver.
+#     python enumeration_bench.py             Linux-like enumeration
+#     python enumeration_bench.py -w          with the extra requests Windows sends
+# Then a second host lists devices and tries to import while the first is attached, and the
+# first host drops its connection and attaches again.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from bench_harness import load3d, Quiet, startServer
+from usbip_client import USBIPClient
+
+class Timeout(Exception):
+    pass
+
+def step(client, steps, name, f):
+    t0 = perf_counter()
+    try:
+        result = f()
+        outcome = "stall" if result[0] else "ok"
+    except socket.timeout:
+        result = None
+        outcome = "timeout"
+    except EOFError:
+        result = None
+        outcome = "closed"
+    steps.append((name, perf_counter() - t0, outcome))
+    return result if outcome == "ok" else None
+
+def enumerate(client, windows=False):
+    steps = []
+    control = lambda *args: lambda: client.control(*args)
+    device = step(client, steps, "device descriptor (64)", control(0x80, 6, 0x0100, 0, 64))
+    step(client, steps, "device descriptor", control(0x80, 6, 0x0100, 0, 18))
+    if windows:
+        step(client, steps, "device qualifier", control(0x80, 6, 0x0600, 0, 10))
+    header = step(client, steps, "configuration (9)", control(0x80, 6, 0x0200, 0, 9))
+    total = struct.unpack('<H', header[1][2:4])[0] if header else 34
+    step(client, steps, "configuration", control(0x80, 6, 0x0200, 0, total))
+    step(client, steps, "string languages", control(0x80, 6, 0x0300, 0, 255))
+    if device:
+        for name, offset in (("product", 15), ("manufacturer", 14), ("serial", 16)):
+            index = bytearray(device[1])[offset]
+            if index:
+                step(client, steps, "string " + name, control(0x80, 6, 0x0300 | index, 0x0409, 255))
+    if windows:
+        step(client, steps, "device status", control(0x80, 0, 0, 0, 2))
+        step(client, steps, "MS OS string", control(0x80, 6, 0x03EE, 0, 18))
+    step(client, steps, "set configuration", control(0x00, 9, 1, 0, 0))
+    step(client, steps, "HID set idle", control(0x21, 0x0A, 0, 0, 0))
+    step(client, steps, "HID report descriptor", control(0x81, 6, 0x2200, 0, 512))
+    step(client, steps, "first interrupt report", lambda: client.transfer(1, 1, 64))
+    return steps
+
+def management(client, port, timeout, windows=False):
+    steps = []
+    other = USBIPClient(port=port, timeout=timeout)
+    step(other, steps, "devlist while attached", lambda: (0, other.devlist()))
+    t0 = perf_counter()
+    try:
+        other.attach()
+        outcome = "imported"
+    except Exception:
+        outcome = "busy"
+    steps.append(("second import", perf_counter() - t0, outcome))
+    other.close()
+    client.close()
+    t0 = perf_counter()
+    while True: # the server may not have seen the drop yet
+        again = USBIPClient(port=port, timeout=timeout)
+        try:
+            again.attach()
+            break
+        except Exception:
+            again.close()
+    enumerate(again, windows=windows)
+    steps.append(("drop and reattach to report", perf_counter() - t0, "ok"))
+    again.close()
+    return steps
+
+def run(windows=False, timeout=5.0):
+    sb = load3d()
+    with Quiet(): # USBContainer.run and USBHID log every step
+        container, port = startServer(sb)
+        client = USBIPClient(port=port, timeout=timeout)
+        t0 = perf_counter()
+        client.attach()
+        steps = enumerate(client, windows=windows)
+        total = perf_counter() - t0
+        steps += management(client, port, timeout, windows=windows)
+        container.running = False
+    return steps, total
+
+if __name__ == '__main__':
+    windows = False
+    timeout = 5.0
+    opts, args = getopt.getopt(sys.argv[1:], "hwT:", ["help", "windows", "timeout="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python enumeration_bench.py [options]\n
+-h --help                this information
+-w --windows             also send the requests Windows adds during enumeration
+-TSEC --timeout=SEC      host control request timeout (default 5, as on Linux)""")
+            sys.exit(0)
+        elif opt in ('-w', '--windows'):
+            windows = True
+        elif opt in ('-T', '--timeout'):
+            timeout = float(arg)
+    steps, total = run(windows=windows, timeout=timeout)
+    for name, seconds, outcome in steps:
+        print("%-28s %10.3f ms  %s" % (name, 1000 * seconds, outcome))
+    print("%-28s %10.3f ms" % ("import to first report", 1000 * total))
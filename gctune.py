@@ -0,0 +1,106 @@
+from __future__ import print_function
+import gc
+import threading
+from time import sleep
+import logs
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+# Cyclic garbage collection away from the reporting path. Streaming allocates short-lived
+# objects all the time, so a collection can start in any thread, in the middle of a URB
+# completion, and a full one scans the whole heap: modules, classes, pyserial, logging. With a
+# mode set, settle() runs one collection at a moment that does not matter (startup, right
+# after a host fetched the report descriptor while no other host streams) and moves every
+# survivor to the permanent generation (gc.freeze), so later collections only see what was
+# allocated while streaming.
+#     'freeze'  young collections go on, less often (YOUNG_THRESHOLD)
+#     'off'     no automatic collection; cycles made while streaming wait for the next settle(),
+#               or for the 'gc' thread, which collects once OFF_THRESHOLD objects have piled up
+# instrument() times every collection into the metrics the -s statistics print.
+#     gctune.instrument(metrics)
+#     gctune.settle('freeze')
+
+MODES = ('freeze', 'off')
+YOUNG_THRESHOLD = 10000 # container allocations between young collections in 'freeze' mode (700 by default)
+OFF_THRESHOLD = 100000 # live container objects since the last collection that make the 'gc' thread collect
+OFF_INTERVAL = 5.0 # seconds between its checks
+
+log = logs.get('main')
+monitor = None
+collector = None
+
+def parseMode(spec):
+    mode = spec.lower()
+    if mode not in MODES:
+        raise ValueError("unknown GC mode " + spec + ", expected one of " + ", ".join(MODES))
+    return mode
+
+class PauseMonitor(object):
+    # Counts collections and their pauses: metrics['gcCollections'], ['gcFullCollections'],
+    # ['gcPauseTime'] and ['gcMaxPause'] in seconds. Allocates nothing per collection.
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = 0.0
+        self.reset()
+
+    def reset(self):
+        self.metrics.update({ 'gcCollections': 0, 'gcFullCollections': 0, 'gcPauseTime': 0.0, 'gcMaxPause': 0.0 })
+
+    def callback(self, phase, info):
+        if phase == 'start':
+            self.start = perf_counter()
+            return
+        pause = perf_counter() - self.start
+        m = self.metrics
+        m['gcCollections'] += 1
+        if info['generation'] == 2:
+            m['gcFullCollections'] += 1
+        m['gcPauseTime'] += pause
+        if pause > m['gcMaxPause']:
+            m['gcMaxPause'] = pause
+
+def instrument(metrics):
+    # Once per process; a forked child keeps the callback and counts into its own copy of metrics.
+    global monitor
+    if not hasattr(gc, 'callbacks'):
+        log.warning("GC pauses cannot be measured with this Python")
+        return None
+    if monitor is None:
+        monitor = PauseMonitor(metrics)
+        gc.callbacks.append(monitor.callback)
+    else:
+        monitor.metrics = metrics
+        monitor.reset()
+    return monitor
+
+def settle(mode):
+    if mode is None:
+        return
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    else:
+        log.warning("gc.freeze needs Python 3.7, full collections still scan the whole heap")
+    if mode == 'off':
+        gc.disable()
+        startCollector()
+    else:
+        threshold = gc.get_threshold()
+        gc.set_threshold(max(threshold[0], YOUNG_THRESHOLD), threshold[1], threshold[2])
+
+def collectLoop():
+    # Objects freed again take their count back, so gc.get_count()[0] only grows with what
+    # stays alive, cycles among it; a long stream without enumeration would never free those.
+    while True:
+        sleep(OFF_INTERVAL)
+        if not gc.isenabled() and gc.get_count()[0] >= OFF_THRESHOLD:
+            gc.collect()
+
+def startCollector():
+    global collector
+    if collector is None or not collector.is_alive(): # a forked ingest process starts its own
+        collector = threading.Thread(target=collectLoop, name='gc')
+        collector.daemon = True
+        collector.start()
@@ -0,0 +1,124 @@
+from __future__ import print_function
+import getopt
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+from time import perf_counter, sleep
+
+# Latency of one SpaceBall fanned out to several USB/IP hosts (3d.py -H). Every host is a
+# process of its own running the stand-in host of usbip_client.py: it imports the device and
+# keeps one interrupt URB pending. Motion is published at a fixed rate with a sequence number
+# in the X and Y axes, so each host's reports can be matched to the moment they were published.
+#     python hosts_bench.py                   1, 2, 4 and 8 hosts
+#     python hosts_bench.py -n 1,16 -r 1000
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from bench_harness import load3d, Quiet, startServer
+from jitter_bench import summarize
+from usbip_client import USBIPClient
+
+AXES = struct.Struct('<Bhh')
+WRAP = 500 # sequence numbers go into two axes of at most trimValue each
+
+def host(port, start, stop, results):
+    # Runs in a process of its own; reports (sequence number, arrival time) of new axis reports.
+    client = USBIPClient(port=port)
+    client.attach()
+    seen = []
+    last = None
+    start.wait()
+    while not stop.is_set():
+        status, data, packets = client.transfer(1, 1, 64)
+        if data[:1] == b'\x01':
+            t = perf_counter()
+            reportID, x, y = AXES.unpack_from(data)
+            seq = y * WRAP + x
+            if seq != last:
+                seen.append((seq, t))
+                last = seq
+    client.close()
+    results.put(seen)
+
+def publisher(sb, published, stop, rate):
+    seq = 0
+    next = perf_counter()
+    while not stop.is_set():
+        seq += 1
+        sb.lock.acquire()
+        sb.xyz[0] = seq % WRAP
+        sb.xyz[1] = (seq // WRAP) % WRAP
+        published[seq % (WRAP * WRAP)] = perf_counter()
+        sb.publishMotion()
+        sb.lock.release()
+        next += 1.0 / rate
+        delay = next - perf_counter()
+        if delay > 0:
+            sleep(delay)
+
+def run(hosts, rate=500, duration=3.0, warmup=0.5):
+    sb = load3d()
+    with Quiet():
+        ctx = multiprocessing.get_context('fork')
+        container, port = startServer(sb, hosts)
+        start = ctx.Event()
+        stop = ctx.Event()
+        results = ctx.Queue()
+        processes = [ctx.Process(target=host, args=(port, start, stop, results)) for i in range(hosts)]
+        for p in processes:
+            p.start()
+        while len(container.hosts) < hosts:
+            sleep(0.01)
+        published = {}
+        done = threading.Event()
+        t = threading.Thread(target=publisher, args=(sb, published, done, rate))
+        t.start()
+        start.set()
+        sleep(warmup)
+        t0 = perf_counter()
+        sleep(duration)
+        stop.set()
+        seen = [results.get() for p in processes]
+        done.set()
+        t.join()
+        for p in processes:
+            p.join()
+        container.running = False
+    latencies = []
+    reports = 0
+    for s in seen:
+        for seq, arrived in s:
+            if seq in published and t0 <= published[seq] < t0 + duration:
+                latencies.append(arrived - published[seq])
+                reports += 1
+    r = summarize(latencies)
+    r['per host'] = reports / float(hosts) / duration
+    return r
+
+if __name__ == '__main__':
+    counts = (1, 2, 4, 8)
+    rate = 500
+    duration = 3.0
+    opts, args = getopt.getopt(sys.argv[1:], "hn:r:t:", ["help", "hosts=", "rate=", "time="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python hosts_bench.py [options]\n
+-h --help                this information
+-nLIST --hosts=LIST      host counts to measure, comma separated (default 1,2,4,8)
+-rHZ --rate=HZ           motion updates per second (default 500)
+-tSEC --time=SEC         measure each host count for SEC seconds (default 3)""")
+            sys.exit(0)
+        elif opt in ('-n', '--hosts'):
+            counts = [int(n) for n in arg.split(',')]
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt in ('-t', '--time'):
+            duration = float(arg)
+    print("%-6s %10s %8s %8s %8s %8s %8s" % ("hosts", "reports/s", "mean", "p50", "p99", "p999", "max"))
+    print("%-6s %10s %8s %8s %8s %8s %8s" % ("", "per host", "ms", "ms", "ms", "ms", "ms"))
+    for n in counts:
+        r = run(n, rate=rate, duration=duration)
+        print("%-6d %10.0f %8.3f %8.3f %8.3f %8.3f %8.3f" % (n, r['per host'], 1000 * r['mean'], 1000 * r['p50'],
+              1000 * r['p99'], 1000 * r['p999'], 1000 * r['max']))
@@ -0,0 +1,141 @@
+from __future__ import print_function
+import errno
+import getopt
+import math
+import os
+import socket
+import stat
+import struct
+import sys
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+from time import sleep
+
+# Report injection: other programs drive the emulated device by sending fixed-size datagrams
+# to 3d.py -i ADDR, either over UDP (PORT or HOST:PORT) or a Unix datagram socket (a path,
+# where the platform has them).
+# A message carries raw axis values (before the -m limit is applied; beyond the 16 bits of a
+# SpaceBall axis they are clamped) and/or the button bits, of which the report carries the
+# low 16; the flags say which of the two it updates. The receiver keeps only the newest state, so a
+# sender may push updates as fast as it likes.
+#     python injection.py -a /tmp/3d.sock -r 5000     push a test motion pattern
+
+VERSION = 1
+MOTION = 1
+BUTTONS = 2
+# version, flags, sequence, send time (sender's perf_counter), x, y, z, rx, ry, rz, buttons
+MESSAGE = struct.Struct('<BBHd6iI')
+AXIS_MIN = -0x8000
+AXIS_MAX = 0x7FFF
+BUTTON_MASK = 0xFFFF
+
+def parseAddress(address):
+    if '/' in address or os.sep in address:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("Unix sockets are not available here, use PORT or HOST:PORT instead of " + address)
+        return socket.AF_UNIX, address
+    host, sep, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+def removeSocket(path):
+    # Only ever a socket: a stale one before binding, ours after closing. A file of the same
+    # name belongs to somebody else.
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, "Not a socket, leaving it alone", path)
+    os.unlink(path)
+
+def openReceiver(address):
+    family, addr = parseAddress(address)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if family == socket.AF_UNIX:
+        removeSocket(addr)
+    else:
+        # enough room to absorb a burst while the receiver is descheduled
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.bind(addr)
+    return sock
+
+def closeReceiver(sock, address):
+    family = sock.family
+    sock.close()
+    if family == getattr(socket, 'AF_UNIX', None):
+        removeSocket(address)
+
+class Injector(object):
+    def __init__(self, address):
+        family, self.address = parseAddress(address)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.message = bytearray(MESSAGE.size)
+        self.sequence = 0
+
+    def send(self, xyz=None, rxyz=None, buttons=None, stamp=None):
+        flags = 0
+        if xyz is not None or rxyz is not None:
+            flags |= MOTION
+            xyz = xyz or (0, 0, 0)
+            rxyz = rxyz or (0, 0, 0)
+        else:
+            xyz = rxyz = (0, 0, 0)
+        if buttons is not None:
+            flags |= BUTTONS
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        MESSAGE.pack_into(self.message, 0, VERSION, flags, self.sequence, perf_counter() if stamp is None else stamp,
+                          xyz[0], xyz[1], xyz[2], rxyz[0], rxyz[1], rxyz[2], buttons or 0)
+        self.sock.sendto(self.message, self.address)
+
+    def close(self):
+        self.sock.close()
+
+if __name__ == '__main__':
+    address = None
+    rate = 1000.0
+    duration = None
+    amplitude = 300
+    opts, args = getopt.getopt(sys.argv[1:], "ha:r:t:A:", ["help", "address=", "rate=", "time=", "amplitude="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python injection.py [options]\n
+-h --help                this information
+-aADDR --address=ADDR    where 3d.py -i listens: PORT, HOST:PORT or a Unix socket path
+-rHZ --rate=HZ           messages per second (default 1000)
+-tSEC --time=SEC         stop after SEC seconds
+-AN --amplitude=N        size of the test motion (default 300)""")
+            sys.exit(0)
+        elif opt in ('-a', '--address'):
+            address = arg
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt in ('-t', '--time'):
+            duration = float(arg)
+        elif opt in ('-A', '--amplitude'):
+            amplitude = int(arg)
+    if address is None:
+        print("Need an address (-a)")
+        sys.exit(1)
+
+    injector = Injector(address)
+    t0 = perf_counter()
+    next = t0
+    sent = 0
+    try:
+        while duration is None or next < t0 + duration:
+            t = next - t0
+            axes = [int(amplitude * math.sin(t * (0.5 + 0.25 * i) + i)) for i in range(6)]
+            try:
+                injector.send(axes[:3], axes[3:], 1 << (int(t) % 12))
+                sent += 1
+            except socket.error:
+                pass # nobody listening yet
+            next += 1.0 / rate
+            delay = next - perf_counter()
+            if delay > 0:
+                sleep(delay)
+    except KeyboardInterrupt:
+        pass
+    print("Sent %d messages" % sent)
@@ -0,0 +1,311 @@
+from __future__ import print_function
+import gc
+import getopt
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+from time import perf_counter, sleep
+
+# End-to-end latency/jitter of URB completions: spaceball_sim.py streams frames over a pty,
+# the real serial pipeline decodes them and a stand-in host thread keeps one interrupt URB
+# pending on the USBHID device, resubmitting it one poll interval after it completed.
+# The latency of a report is measured from the moment its motion frame was published by the
+# serial side to the moment the report is written to the channel.
+# The verbose scenarios log every frame and report (3d.py -v serial,hid) to a console that
+# blocks on every write like a Windows terminal, either from the logging thread itself or
+# through the queue of logs.py.
+# The injection scenarios drive 3d.py's -i socket from injection.py instead.
+# The real-time scenarios run the serial and host threads as 3d.py -R (and -A) would.
+# In the allocating scenarios another thread of the process keeps objects alive for a while, so
+# that garbage collections happen; with gc freeze or off the heap is settled after the warm-up
+# as 3d.py -g does after enumeration. The gc columns count the collections in the USB/IP process
+# while measuring and give the longest pause.
+#     python jitter_bench.py                  compare scenarios side by side
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from bench_harness import load3d, Quiet, startBurners, startSerial, stopBurners
+import gctune
+import logs
+import realtime
+
+CONSOLE_DELAY = 0.0005 # seconds per write
+ALLOCATE_RATE = 20000 # objects per second in the allocating-thread scenarios
+ALLOCATE_KEEP = 50000 # objects kept before they are dropped together
+
+def allocate(sb, rate=ALLOCATE_RATE, keep=ALLOCATE_KEEP):
+    # Another thread of the emulator process that holds on to what it allocates for a while,
+    # as a backed-up log queue or a plugin cache would. Objects that die at once leave the
+    # collector alone; these accumulate, so collections start and land on the report path.
+    kept = []
+    while sb.running:
+        for i in range(int(rate * 0.001)):
+            kept.append({ 'seq': i, 'time': perf_counter() })
+        if len(kept) >= keep:
+            del kept[:]
+        sleep(0.001)
+
+class TimedChannel(object):
+    endianForWriting = '>'
+
+    def __init__(self):
+        self.origin = None
+        self.latencies = []
+        self.recording = False
+        self.done = threading.Event()
+
+    def write(self, data):
+        if self.origin is not None and data[48] == 1:
+            if self.recording:
+                self.latencies.append(perf_counter() - self.origin)
+            self.origin = None
+        self.done.set()
+
+def hostLoop(dev, req, channel, duration, poll):
+    # A URB the device parks completes from its report_loop; only then is the next one sent.
+    t0 = perf_counter()
+    while perf_counter() < t0 + duration:
+        channel.done.clear()
+        dev.handle_data(req)
+        while not channel.done.wait(0.1) and perf_counter() < t0 + duration:
+            pass
+        sleep(poll)
+    dev.cancel_urbs()
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def summarize(latencies):
+    v = sorted(latencies)
+    n = len(v)
+    mean = sum(v) / n
+    stdev = (sum((x - mean) ** 2 for x in v) / n) ** 0.5
+    return { 'count': n, 'mean': mean, 'stdev': stdev, 'p50': percentile(v, 0.5), 'p99': percentile(v, 0.99),
+             'p999': percentile(v, 0.999), 'max': v[-1] }
+
+class SlowConsole(object):
+    def __init__(self, delay=CONSOLE_DELAY):
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        sleep(self.delay)
+
+    def flush(self):
+        pass
+
+def verboseLogging(mode):
+    # mode 'sync' writes in the thread that logs, 'async' through the listener thread
+    console = SlowConsole()
+    logs.setup(verbosity={ 'serial': logging.DEBUG, 'hid': logging.DEBUG }, stream=console,
+               asynchronous=mode == 'async')
+    return console
+
+def runScenario(ingest=False, verbose=None, load=0, duration=5.0, rate=200, poll=0.001, warmup=1.0, tune=None,
+                gcMode=None, allocating=False):
+    # tune: (affinity, policy, priority) as 3d.py -A and -R set them; gcMode as 3d.py -g
+    sb = load3d()
+    sb.gcMode = gcMode
+    threshold = gc.get_threshold()
+    ctx = multiprocessing.get_context('fork')
+    link = '/tmp/jitter_bench_%d' % os.getpid()
+    sim = subprocess.Popen([sys.executable, os.path.join(HERE, 'spaceball_sim.py'), '-l', link, '-r', str(rate),
+                            '-t', str(duration + warmup + 30)], stdout=subprocess.DEVNULL)
+    burners = []
+    with Quiet(setupLogs=not verbose):
+        try:
+            while not os.path.exists(link):
+                sleep(0.01)
+            sb.port = link
+            sb.currentMouse = sb.FLX()
+            if tune is not None:
+                sb.cpuAffinity, sb.realtimePolicy, sb.realtimePriority = tune
+            if verbose:
+                verboseLogging(verbose)
+            channel = TimedChannel()
+            publish = sb.publishMotion
+            if ingest:
+                state = sb.SharedState()
+                def publishMotion():
+                    channel.origin = state.read()[1][0]
+                    publish()
+            else:
+                def publishMotion():
+                    channel.origin = perf_counter()
+                    publish()
+            sb.publishMotion = publishMotion
+            if ingest:
+                config = (link, None, b'S', 'FLX', False, None, None, sb.verbosity, sb.dataPeriod, False, sb.cpuAffinity,
+                          sb.realtimePolicy, sb.realtimePriority, False, sb.gcMode)
+                producer = ctx.Process(target=sb.ingestMain, args=(state.name, config, state.changed))
+                producer.start()
+                t = threading.Thread(target=sb.sharedStateLoop, args=(state,))
+                t.daemon = True
+                t.start()
+            else:
+                producer = None
+                startSerial(sb, link, wait=False)
+            burners = startBurners(load)
+            if allocating:
+                t = threading.Thread(target=allocate, args=(sb,))
+                t.daemon = True
+                t.start()
+
+            dev = sb.USBHID()
+            dev.channel = channel
+            req = sb.USBRequest(seqnum=1)
+            def host():
+                # in a thread of its own, so that only it and the report thread it starts are tuned
+                sb.tuneThread('usbip')
+                hostLoop(dev, req, channel, warmup, poll)
+                gctune.settle(gcMode)
+                gctune.instrument(sb.metrics)
+                channel.recording = True
+                hostLoop(dev, req, channel, duration, poll)
+            t = threading.Thread(target=host)
+            t.start()
+            t.join()
+            sb.running = False
+            if producer is not None:
+                producer.terminate()
+                producer.join()
+            if ingest:
+                state.close()
+            r = summarize(channel.latencies)
+            r.update({ 'gcs': sb.metrics['gcCollections'], 'gcMax': sb.metrics['gcMaxPause'] })
+            return r
+        finally:
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+            gc.set_threshold(*threshold)
+            gc.enable()
+            stopBurners(burners)
+            sim.terminate()
+            sim.wait()
+            sleep(0.1)
+
+def runInjection(address, rate=5000, load=0, duration=5.0, poll=0.001, warmup=1.0):
+    # Another process pushes injection messages at `rate`; the latency of a report is measured
+    # from the send time of the newest message it contains.
+    sb = load3d()
+    sender = None
+    burners = []
+    with Quiet():
+        try:
+            channel = TimedChannel()
+            publish = sb.publishMotion
+            def publishMotion():
+                channel.origin = sb.injectStamp
+                publish()
+            sb.publishMotion = publishMotion
+            t = threading.Thread(target=sb.injectLoop, args=(address,))
+            t.daemon = True
+            t.start()
+            sleep(0.2)
+            sender = subprocess.Popen([sys.executable, os.path.join(HERE, 'injection.py'), '-a', address, '-r',
+                                       str(rate), '-t', str(duration + warmup + 30)], stdout=subprocess.DEVNULL)
+            burners = startBurners(load)
+
+            dev = sb.USBHID()
+            dev.channel = channel
+            req = sb.USBRequest(seqnum=1)
+            hostLoop(dev, req, channel, warmup, poll)
+            injected = sb.metrics['injected']
+            channel.recording = True
+            t1 = perf_counter()
+            hostLoop(dev, req, channel, duration, poll)
+            r = summarize(channel.latencies)
+            r['rate'] = (sb.metrics['injected'] - injected) / (perf_counter() - t1)
+            sb.running = False
+            t.join()
+            return r
+        finally:
+            stopBurners(burners)
+            if sender is not None:
+                sender.terminate()
+                sender.wait()
+
+def show(name, r):
+    gcs = ("%6d %8.3f" % (r['gcs'], 1000 * r['gcMax'])) if 'gcs' in r else ""
+    print("%-38s %6d %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f %s" % (name, r['count'], 1000 * r['mean'], 1000 * r['stdev'],
+          1000 * r['p50'], 1000 * r['p99'], 1000 * r['p999'], 1000 * r['max'], gcs))
+
+def header():
+    print("%-38s %6s %8s %8s %8s %8s %8s %8s %6s %8s" % ("scenario (latency in ms)", "n", "mean", "stdev", "p50", "p99",
+          "p999", "max", "gcs", "gc max"))
+
+if __name__ == '__main__':
+    duration = 5.0
+    rate = 200
+    load = 1
+    injectRate = 5000
+    affinity = {}
+    policy, priority = 'fifo', 50
+    busy = False
+    gcOnly = False
+    opts, args = getopt.getopt(sys.argv[1:], "ht:r:L:i:A:R:bg", ["help", "time=", "rate=", "load=", "inject-rate=",
+                                                                "affinity=", "realtime=", "busy", "gc"])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python jitter_bench.py [options]\n
+-h --help                this information
+-tSEC --time=SEC         measure each scenario for SEC seconds (default 5)
+-rHZ --rate=HZ           simulated SpaceBall frame rate (default 200)
+-LN --load=N             CPU-burning processes in the busy-host scenarios (default 1)
+-iHZ --inject-rate=HZ    messages per second in the injection scenarios (default 5000)
+-ACPUS --affinity=CPUS   CPUs for the real-time scenarios, as 3d.py -A (default none)
+-RPRIO --realtime=PRIO   scheduling of the real-time scenarios, as 3d.py -R (default fifo:50)
+-b --busy                only the busy-host scenarios, with and without real-time scheduling
+-g --gc                  only the allocating-thread scenarios, with and without 3d.py -g""")
+            sys.exit(0)
+        elif opt in ('-t', '--time'):
+            duration = float(arg)
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt in ('-L', '--load'):
+            load = int(arg)
+        elif opt in ('-i', '--inject-rate'):
+            injectRate = float(arg)
+        elif opt in ('-A', '--affinity'):
+            affinity = realtime.parseAffinity(arg)
+        elif opt in ('-R', '--realtime'):
+            policy, priority = realtime.parsePriority(arg)
+        elif opt in ('-b', '--busy'):
+            busy = True
+        elif opt in ('-g', '--gc'):
+            gcOnly = True
+    tune = (affinity, policy, priority)
+    header()
+    for name, kwargs in (("serial thread", {}),
+                         ("serial thread, verbose console", { 'verbose': 'sync' }),
+                         ("serial thread, verbose async log", { 'verbose': 'async' }),
+                         ("serial thread, busy host", { 'verbose': 'async', 'load': load }),
+                         ("serial thread, busy host, real-time", { 'verbose': 'async', 'load': load, 'tune': tune }),
+                         ("serial thread, allocating", { 'allocating': True }),
+                         ("serial thread, allocating, gc freeze", { 'allocating': True, 'gcMode': 'freeze' }),
+                         ("serial thread, allocating, gc off", { 'allocating': True, 'gcMode': 'off' }),
+                         ("ingest process", { 'ingest': True }),
+                         ("ingest process, verbose console", { 'ingest': True, 'verbose': 'sync' }),
+                         ("ingest process, verbose async log", { 'ingest': True, 'verbose': 'async' }),
+                         ("ingest process, busy host", { 'ingest': True, 'verbose': 'async', 'load': load }),
+                         ("ingest process, busy host, real-time", { 'ingest': True, 'verbose': 'async', 'load': load,
+                                                                    'tune': tune }),
+                         ("ingest process, allocating", { 'ingest': True, 'allocating': True }),
+                         ("ingest process, allocating, gc freeze", { 'ingest': True, 'allocating': True, 'gcMode': 'freeze' }),
+                         ("ingest process, allocating, gc off", { 'ingest': True, 'allocating': True, 'gcMode': 'off' })):
+        if busy and 'load' not in kwargs or gcOnly and 'allocating' not in kwargs:
+            continue
+        show(name, runScenario(duration=duration, rate=rate, **kwargs))
+    if busy or gcOnly:
+        sys.exit(0)
+    for name, address, kwargs in (("injection, unix socket", '/tmp/jitter_bench_%d.sock' % os.getpid(), {}),
+                                  ("injection, udp", '127.0.0.1:%d' % (20000 + os.getpid() % 20000), {}),
+                                  ("injection, unix socket, busy host", '/tmp/jitter_bench_%d.sock' % os.getpid(),
+                                   { 'load': load })):
+        r = runInjection(address, rate=injectRate, duration=duration, **kwargs)
+        show(name, r)
+        print("%-38s %6.0f messages/s received" % ("", r['rate']))
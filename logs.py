@@ -0,0 +1,139 @@
+from __future__ import print_function
+import atexit
+import logging
+import sys
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    QueueHandler = None
+
+# Leveled logging for the emulator. Threads on the hot path (the USB/IP reader, the serial
+# reader, report completion) only put records on a queue; a listener thread formats them and
+# does the console I/O, which can block for milliseconds on Windows terminals.
+# Each subsystem has its own logger whose level can be set separately:
+#     logs.setup(verbosity=logs.parseVerbosity('usbip,serial=info'))
+#     log = logs.get('usbip')
+# The same message logged at INFO or above is shown at most once per REPEAT_INTERVAL; the
+# next one that gets through says how many repeats were dropped.
+
+ROOT = 'usbemu'
+SUBSYSTEMS = ('usbip', 'hid', 'serial', 'ingest', 'inject', 'emulate', 'stats', 'profile', 'main')
+LEVELS = { 'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR }
+FORMAT = '%(asctime)s.%(msecs)03d %(levelname)-7s %(subsystem)-7s %(message)s'
+DATE_FORMAT = '%H:%M:%S'
+QUEUE_SIZE = 10000
+REPEAT_INTERVAL = 5.0
+SEEN_LIMIT = 1000 # distinct messages remembered before those shown over an interval ago are forgotten
+
+listener = None
+handler = None
+sink = None
+
+def get(subsystem):
+    return logging.getLogger(ROOT + '.' + subsystem)
+
+def parseVerbosity(spec):
+    # "usbip,serial=info,all=warning" -> { 'usbip': DEBUG, 'serial': INFO, 'all': WARNING }
+    verbosity = {}
+    for item in spec.split(','):
+        name, sep, level = item.strip().partition('=')
+        if name not in SUBSYSTEMS and name != 'all':
+            raise ValueError("unknown subsystem " + name + ", expected one of all, " + ", ".join(SUBSYSTEMS))
+        if level and level.lower() not in LEVELS:
+            raise ValueError("unknown level " + level + ", expected one of " + ", ".join(sorted(LEVELS)))
+        verbosity[name] = LEVELS[level.lower()] if level else logging.DEBUG
+    return verbosity
+
+class RateLimit(logging.Filter):
+    # Keyed by logger and formatted message: "Error %s" repeats only with the same error, and
+    # one-off events such as a second host disconnecting are all shown.
+    def __init__(self, interval=REPEAT_INTERVAL):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.seen = {} # (name, message) -> [time shown, repeats dropped since]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        record.subsystem = record.name[len(ROOT) + 1:]
+        if record.levelno < logging.INFO or not self.interval:
+            return True
+        key = (record.name, record.getMessage())
+        now = record.created
+        self.lock.acquire()
+        try:
+            seen = self.seen.get(key)
+            if seen is None:
+                if len(self.seen) >= SEEN_LIMIT:
+                    self.seen = dict((k, v) for k, v in self.seen.items() if now - v[0] < self.interval)
+                self.seen[key] = [now, 0]
+                return True
+            if now - seen[0] < self.interval:
+                seen[1] += 1
+                return False
+            if seen[1]:
+                record.msg = str(record.msg) + (" (repeated %d times)" % seen[1]).replace('%', '%%')
+            seen[0] = now
+            seen[1] = 0
+            return True
+        finally:
+            self.lock.release()
+
+if QueueHandler is not None:
+    class AsyncHandler(QueueHandler):
+        # Records are formatted by the listener, not by the thread that logs them, so
+        # callers pass values that do not change afterwards. A full queue drops the record
+        # rather than blocking the caller.
+        def __init__(self, q):
+            QueueHandler.__init__(self, q)
+            self.dropped = 0
+
+        def prepare(self, record):
+            return record
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+def console(stream=None):
+    h = logging.StreamHandler(stream or sys.stdout)
+    h.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    return h
+
+def setup(level=logging.INFO, verbosity=None, stream=None, interval=REPEAT_INTERVAL, asynchronous=True):
+    # Also called in a forked or spawned ingest process, which needs its own listener.
+    global listener, handler, sink
+    stop()
+    root = logging.getLogger(ROOT)
+    root.propagate = False
+    root.setLevel((verbosity or {}).get('all', level))
+    for name in SUBSYSTEMS:
+        get(name).setLevel((verbosity or {}).get(name, logging.NOTSET))
+    sink = console(stream)
+    if asynchronous and QueueHandler is not None:
+        handler = AsyncHandler(queue.Queue(QUEUE_SIZE))
+        listener = QueueListener(handler.queue, sink)
+        listener.start()
+    else:
+        handler = sink
+    handler.addFilter(RateLimit(interval))
+    root.handlers[:] = [handler]
+    return handler
+
+def stop():
+    # Writes out what is still queued; later records are written by the calling thread.
+    global listener, handler
+    if listener is not None:
+        listener.stop()
+        listener = None
+        sink.filters = handler.filters
+        handler = sink
+        logging.getLogger(ROOT).handlers[:] = [sink]
+
+atexit.register(stop)
@@ -0,0 +1,166 @@
+from __future__ import print_function
+import bisect
+import getopt
+import os
+import sys
+from time import perf_counter, sleep
+
+# Accuracy and responsiveness of the motion predictor (3d.py -e), replayed offline from recorded
+# sessions: every motion frame with the time the serial pipeline published it. A host polling
+# every millisecond would get either the newest frame (no -e) or the predictor's estimate; both
+# are compared with the motion the frames describe, interpolated between frames. The lag is the
+# delay at which the reports follow that motion best, so a smaller lag means a more responsive
+# device and the error says what it costs.
+#     python predict_bench.py                            record spaceball_sim.py gestures at 9600 baud
+#     python predict_bench.py -p /dev/ttyUSB0 -M flx -o session.csv -t 60     record a real SpaceBall
+#     python predict_bench.py -e 0,20,40 -n 3,4,6 session.csv
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from bench_harness import load3d, Quiet, startSerial
+import spaceball_sim
+
+POLL = 0.001
+MAX_LAG = 0.04
+
+def record(port=None, model='flx', duration=20.0, rate=50, baud=9600, seed=1):
+    # [(time, (x, y, z, rx, ry, rz)), ...] as published; spaceball_sim.py when port is None.
+    sb = load3d()
+    sim = None
+    if port is None:
+        port = '/tmp/predict_bench_%d' % os.getpid()
+        sim = spaceball_sim.SpaceBallSimulator(model=model, rate=rate, link=port, baud=baud, seed=seed,
+                                               buttonInterval=0, profile='gestures')
+        sim.start()
+    session = []
+    publish = sb.publishMotion
+    def publishMotion():
+        session.append((perf_counter(), tuple(sb.xyz) + tuple(sb.rxyz)))
+        publish()
+    sb.publishMotion = publishMotion
+    with Quiet():
+        try:
+            startSerial(sb, port, model)
+            del session[:]
+            sleep(duration)
+            sb.running = False
+            return session[:]
+        finally:
+            if sim is not None:
+                sim.stop()
+
+def save(session, path):
+    with open(path, 'w') as f:
+        f.write("time,x,y,z,rx,ry,rz\n")
+        t0 = session[0][0]
+        for t, axes in session:
+            f.write("%.6f,%s\n" % (t - t0, ",".join(str(a) for a in axes)))
+
+def load(path):
+    session = []
+    with open(path) as f:
+        for line in f:
+            if line[:1].isdigit():
+                values = line.split(',')
+                session.append((float(values[0]), tuple(int(v) for v in values[1:7])))
+    return session
+
+def interpolate(session, times, t):
+    # The motion the frames describe at t, linear between frames.
+    k = bisect.bisect_right(times, t)
+    if k == 0:
+        return session[0][1]
+    if k == len(session):
+        return session[-1][1]
+    t0, a = session[k - 1]
+    t1, b = session[k]
+    f = (t - t0) / (t1 - t0)
+    return tuple(a[i] + f * (b[i] - a[i]) for i in range(6))
+
+def replay(sb, session, horizon, history):
+    # What a host polling every POLL seconds is sent: [(time, axes), ...]
+    predictor = sb.MotionPredictor(horizon, history) if horizon else None
+    reports = []
+    k = 0
+    t = session[0][0]
+    while t < session[-1][0]:
+        while k < len(session) and session[k][0] <= t:
+            if predictor is not None:
+                predictor.add(session[k][0], session[k][1][:3], session[k][1][3:])
+            k += 1
+        reports.append((t, tuple(predictor.predict(t)) if predictor is not None else session[k - 1][1]))
+        t += POLL
+    return reports
+
+def meanSquare(reports, session, times, lag):
+    # Of the difference between the reports and the motion lag seconds before them.
+    total = 0.0
+    for t, axes in reports:
+        truth = interpolate(session, times, t - lag)
+        for i in range(6):
+            total += (axes[i] - truth[i]) ** 2
+    return total / (6 * len(reports))
+
+def evaluate(sb, session, horizon, history):
+    times = [t for t, axes in session]
+    reports = replay(sb, session, horizon, history)
+    errors = []
+    for t, axes in reports:
+        truth = interpolate(session, times, t)
+        errors.append(max(abs(axes[i] - truth[i]) for i in range(6)))
+    errors.sort()
+    lags = [0.001 * ms for ms in range(int(1000 * MAX_LAG) + 1)]
+    lag = min(lags, key=lambda lag: meanSquare(reports, session, times, lag))
+    return { 'rms': meanSquare(reports, session, times, 0) ** 0.5, 'p99': errors[int(0.99 * len(errors))],
+             'max': errors[-1], 'lag': lag }
+
+if __name__ == '__main__':
+    port = None
+    model = 'flx'
+    output = None
+    duration = 20.0
+    horizons = [0, 10, 20, 30, 40]
+    histories = [3]
+    opts, args = getopt.getopt(sys.argv[1:], "hp:M:o:t:e:n:", ["help", "port=", "model=", "output=", "time=", "predict=",
+                                                              "history="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python predict_bench.py [options] [session.csv ...]\n
+-h --help                this information
+-pPORT --port=PORT       record from a SpaceBall on PORT instead of spaceball_sim.py
+-Mmodel --model=model    model to record: flx, x003, 2003, magellan (default flx)
+-oFILE --output=FILE     save the recorded session to FILE
+-tSEC --time=SEC         record for SEC seconds (default 20)
+-eLIST --predict=LIST    predictor horizons to compare in ms, 0 for none (default 0,10,20,30,40)
+-nLIST --history=LIST    predictor history lengths in frames (default 3)""")
+            sys.exit(0)
+        elif opt in ('-p', '--port'):
+            port = arg
+        elif opt in ('-M', '--model'):
+            model = spaceball_sim.modelName(arg)
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt in ('-t', '--time'):
+            duration = float(arg)
+        elif opt in ('-e', '--predict'):
+            horizons = [float(ms) for ms in arg.split(',')]
+        elif opt in ('-n', '--history'):
+            histories = [int(n) for n in arg.split(',')]
+    if args:
+        sessions = [(path, load(path)) for path in args]
+    else:
+        session = record(port, model, duration)
+        if output:
+            save(session, output)
+        sessions = [(output or port or 'spaceball_sim.py gestures', session)]
+    sb = load3d()
+    sb.trimValue = 0 # compare the untrimmed axes
+    print("%-8s %8s %10s %10s %10s %8s" % ("-e", "history", "rms error", "p99 error", "max error", "lag"))
+    print("%-8s %8s %10s %10s %10s %8s" % ("ms", "frames", "counts", "counts", "counts", "ms"))
+    for name, session in sessions:
+        print("%s: %d frames, %.1f frames/s" % (name, len(session), len(session) / (session[-1][0] - session[0][0])))
+        for horizon in horizons:
+            for history in (histories if horizon else histories[:1]):
+                r = evaluate(sb, session, horizon / 1000.0, history)
+                print("%-8s %8s %10.1f %10.0f %10.0f %8.0f" % ("off" if not horizon else "%g" % horizon,
+                      history if horizon else "", r['rms'], r['p99'], r['max'], 1000 * r['lag']))
@@ -0,0 +1,180 @@
+from __future__ import print_function
+import collections
+import getopt
+import os
+import signal
+import socket
+import sys
+import threading
+from time import sleep, strftime, time
+import injection
+import logs
+
+# On-demand sampling profiler for a running emulator. A thread of its own looks at the stacks
+# of all other threads every SAMPLE_INTERVAL, so nothing is hooked into the profiled code:
+# while stopped it costs nothing, and it can stay in the packaged builds.
+# 3d.py toggles it on SIGUSR1 (not on Windows) or on a datagram to its -r control address:
+#     python profiler.py -a 127.0.0.1:3250 start
+#     python profiler.py -a 127.0.0.1:3250 stop      writes profile-PID-TIME.txt
+# The file lists, per thread, the lines it was sampled in and the functions on its stack.
+
+SAMPLE_INTERVAL = 0.001
+TOP = 30
+COMMANDS = (b'start', b'stop', b'toggle')
+SIGNALS = (('SIGUSR1', b'toggle'),)
+FORWARDED = (('SIGUSR1', b'start'), ('SIGUSR2', b'stop')) # how forward() passes the state on to another process
+
+log = logs.get('profile')
+
+class SamplingProfiler(object):
+    def __init__(self, interval=SAMPLE_INTERVAL, output=None):
+        self.interval = interval
+        self.output = output # file name pattern, strftime and %(pid)d, see outputName
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            if self.running:
+                return False
+            self.samples = collections.Counter() # thread name -> samples
+            self.lines = {}  # thread name -> Counter of (file, line, function) at the top of the stack
+            self.calls = {}  # thread name -> Counter of (file, first line, function) anywhere on the stack
+            self.started = time()
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name='profiler')
+            self.thread.daemon = True
+            self.thread.start()
+            log.info("Profiling every %.1f ms", 1000 * self.interval)
+            return True
+        finally:
+            self.lock.release()
+
+    def run(self):
+        me = threading.current_thread().ident
+        while self.running:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                name = names.get(ident, str(ident))
+                self.samples[name] += 1
+                lines = self.lines.get(name)
+                if lines is None:
+                    lines = self.lines[name] = collections.Counter()
+                    self.calls[name] = collections.Counter()
+                code = frame.f_code
+                lines[(code.co_filename, frame.f_lineno, code.co_name)] += 1
+                seen = set() # a recursive function counts once per sample
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_firstlineno, code.co_name)
+                    if key not in seen:
+                        seen.add(key)
+                        self.calls[name][key] += 1
+                    frame = frame.f_back
+            sleep(self.interval)
+
+    def stop(self):
+        # Returns the name of the file written, or None when the profiler was not running.
+        self.lock.acquire()
+        try:
+            if not self.running:
+                return None
+            self.running = False
+            self.thread.join()
+            self.duration = time() - self.started
+            path = self.outputName()
+            self.write(path)
+            log.info("Profile written to %s", path)
+            return path
+        finally:
+            self.lock.release()
+
+    def toggle(self):
+        if not self.start():
+            self.stop()
+
+    def outputName(self):
+        pattern = self.output or 'profile-%(pid)d-%Y%m%d-%H%M%S.txt'
+        return strftime(pattern.replace('%(pid)d', str(os.getpid())))
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write("Sampled every %.1f ms for %.1f s\n" % (1000 * self.interval, self.duration))
+            for name in sorted(self.samples):
+                n = self.samples[name]
+                f.write("\nThread %s: %d samples\n" % (name, n))
+                f.write("  %7s  %s\n" % ("own %", "line"))
+                for (filename, line, function), count in self.lines[name].most_common(TOP):
+                    f.write("  %7.1f  %s:%d %s\n" % (100.0 * count / n, os.path.basename(filename), line, function))
+                f.write("  %7s  %s\n" % ("total %", "function"))
+                for (filename, line, function), count in self.calls[name].most_common(TOP):
+                    f.write("  %7.1f  %s:%d %s\n" % (100.0 * count / n, os.path.basename(filename), line, function))
+
+def onSignal(callback, signals=SIGNALS):
+    # Each (signal name, command) of signals calls callback with the command from a new thread
+    # rather than from whatever the main thread was doing; signals this platform does not have
+    # (all of them on Windows) are left out.
+    handled = False
+    for name, command in signals:
+        if hasattr(signal, name):
+            def handler(signum, frame, command=command):
+                t = threading.Thread(target=callback, args=(command,), name='profiler control')
+                t.daemon = True
+                t.start()
+            signal.signal(getattr(signal, name), handler)
+            handled = True
+    return handled
+
+def forward(pid, profiler):
+    # Tells the process pid, listening with onSignal(callback, FORWARDED), to start or stop
+    # as profiler just did, so that a toggle cannot leave the two out of step.
+    names = dict((command, name) for name, command in FORWARDED)
+    name = names[b'start' if profiler.running else b'stop']
+    if hasattr(signal, name):
+        os.kill(pid, getattr(signal, name))
+
+def listen(address, callback):
+    # Calls callback with each command datagram received on address (see injection.parseAddress).
+    sock = injection.openReceiver(address)
+    def loop():
+        while True:
+            command = sock.recv(64).strip().lower()
+            if command in COMMANDS:
+                callback(command)
+            else:
+                log.warning("Unknown profiler command %r", command)
+    t = threading.Thread(target=loop, name='profiler control')
+    t.daemon = True
+    t.start()
+    return sock
+
+def control(profiler, command):
+    if command == b'start':
+        profiler.start()
+    elif command == b'stop':
+        profiler.stop()
+    else:
+        profiler.toggle()
+
+if __name__ == '__main__':
+    address = None
+    opts, args = getopt.getopt(sys.argv[1:], "ha:", ["help", "address="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python profiler.py [options] start|stop|toggle\n
+-h --help                this information
+-aADDR --address=ADDR    where 3d.py -r listens: PORT, HOST:PORT or a Unix socket path""")
+            sys.exit(0)
+        elif opt in ('-a', '--address'):
+            address = arg
+    if address is None or len(args) != 1 or args[0].encode() not in COMMANDS:
+        print("Need an address (-a) and one of start, stop, toggle")
+        sys.exit(1)
+    family, addr = injection.parseAddress(address)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.sendto(args[0].encode(), addr)
+    sock.close()
@@ -0,0 +1,95 @@
+from __future__ import print_function
+import bisect
+import getopt
+import os
+import sys
+from time import clock_gettime, pthread_getcpuclockid, sleep, time
+
+# Serial load against responsiveness of the SpaceBall data period (3d.py -f): spaceball_sim.py
+# plays a 4000FLX doing gestures with rests in between over a pty at 9600 baud and follows the
+# P commands the emulator sends. For every setting the frame rate, the bytes on the line and
+# the CPU time of the serial thread are measured, and the delay from the start of each gesture
+# to the first frame that shows it. Linux only.
+#     python rate_bench.py                    -f 20, -f 40 and -f auto
+#     python rate_bench.py -t 30 -f 20,auto:16
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from bench_harness import load3d, Quiet, startSerial
+from jitter_bench import summarize
+import spaceball_sim
+
+def cpuTime(thread):
+    return clock_gettime(pthread_getcpuclockid(thread.ident))
+
+def run(period, adaptive, duration=20.0, seed=1):
+    sb = load3d()
+    link = '/tmp/rate_bench_%d' % os.getpid()
+    sim = spaceball_sim.SpaceBallSimulator(model='flx', link=link, baud=9600, seed=seed, buttonInterval=0,
+                                           profile='gestures', followPeriod=True)
+    moving = [] # time() of every frame with motion
+    publish = sb.publishMotion
+    def publishMotion():
+        if any(sb.xyz) or any(sb.rxyz):
+            moving.append(time())
+        publish()
+    sb.publishMotion = publishMotion
+    sb.dataPeriod = period
+    sb.adaptivePeriod = adaptive
+    sb.serialCommands = sb.Queue(sb.SERIAL_QUEUE_SIZE) # the P commands of -f auto
+    with Quiet():
+        try:
+            sim.start()
+            serial = startSerial(sb, link)
+            frames = sb.motionCount
+            sent = sim.stats['bytesSent']
+            cpu = cpuTime(serial)
+            t0 = time()
+            sleep(duration)
+            frames = sb.motionCount - frames
+            sent = sim.stats['bytesSent'] - sent
+            cpu = cpuTime(serial) - cpu
+            t1 = time()
+            sb.running = False
+            serial.join()
+            delays = []
+            for start in sim.gestureLog:
+                k = bisect.bisect_left(moving, start)
+                if t0 <= start < t1 and k < len(moving):
+                    delays.append(moving[k] - start)
+            r = summarize(delays)
+            r.update({ 'frames': frames / duration, 'bytes': sent / duration, 'cpu': cpu / duration,
+                       'changes': sb.metrics['periodChanges'], 'frameRate': sb.metrics['frameRate'] })
+            return r
+        finally:
+            sim.stop()
+
+def parsePeriod(arg):
+    # as 3d.py -f: MS, auto or auto:MS
+    mode, sep, ms = arg.partition(':')
+    if mode == 'auto':
+        return int(ms or 20), True
+    return int(mode), False
+
+if __name__ == '__main__':
+    settings = ['20', '40', 'auto']
+    duration = 20.0
+    opts, args = getopt.getopt(sys.argv[1:], "hf:t:", ["help", "period=", "time="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python rate_bench.py [options]\n
+-h --help                this information
+-fLIST --period=LIST     3d.py -f settings to compare, comma separated (default 20,40,auto)
+-tSEC --time=SEC         measure each setting for SEC seconds (default 20)""")
+            sys.exit(0)
+        elif opt in ('-f', '--period'):
+            settings = arg.split(',')
+        elif opt in ('-t', '--time'):
+            duration = float(arg)
+    print("%-9s %8s %8s %8s %8s %8s %8s" % ("-f", "frames/s", "bytes/s", "cpu", "changes", "first", "motion"))
+    print("%-9s %8s %8s %8s %8s %8s %8s" % ("", "", "serial", "%", "", "mean ms", "max ms"))
+    for setting in settings:
+        period, adaptive = parsePeriod(setting)
+        r = run(period, adaptive, duration)
+        print("%-9s %8.1f %8.0f %8.2f %8d %8.1f %8.1f" % (setting, r['frames'], r['bytes'], 100 * r['cpu'], r['changes'],
+              1000 * r['mean'], 1000 * r['max']))
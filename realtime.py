@@ -0,0 +1,85 @@
+from __future__ import print_function
+import os
+import logs
+
+# Optional real-time tuning of the emulator threads on Linux: CPU affinity, a real-time
+# scheduling policy and the low-latency flag of a serial port. Each call works on the calling
+# thread, and threads it starts afterwards inherit the settings. Where the platform or the
+# permissions do not allow something, a warning is logged and the thread goes on as before.
+#     affinity = realtime.parseAffinity('serial=1,usbip=2-3')
+#     policy, priority = realtime.parsePriority('rr:40')
+#     realtime.tune('serial', affinity, policy, priority)
+
+ROLES = ('serial', 'usbip')
+POLICIES = { 'fifo': 'SCHED_FIFO', 'rr': 'SCHED_RR' }
+
+log = logs.get('main')
+
+def parseCPUs(spec):
+    # "2" or "0-3" -> set of CPU numbers
+    first, sep, last = spec.partition('-')
+    return set(range(int(first), int(last or first) + 1))
+
+def parseAffinity(spec):
+    # "0-3" pins every role, "serial=1,usbip=2-3" each role on its own; CPUs of the same
+    # role add up, so "1,3" is CPUs 1 and 3 for all of them.
+    affinity = {}
+    for item in spec.split(','):
+        role, sep, cpus = item.strip().rpartition('=')
+        for r in (role,) if role else ROLES:
+            if r not in ROLES:
+                raise ValueError("unknown thread role " + r + ", expected one of " + ", ".join(ROLES))
+            affinity.setdefault(r, set()).update(parseCPUs(cpus))
+    return affinity
+
+def parsePriority(spec):
+    # "50" or "fifo:50" -> SCHED_FIFO priority 50, "rr:50" -> SCHED_RR
+    name, sep, priority = spec.rpartition(':')
+    name = name.lower() or 'fifo'
+    if name not in POLICIES:
+        raise ValueError("unknown scheduling policy " + name + ", expected fifo or rr")
+    return name, int(priority)
+
+def setAffinity(cpus):
+    try:
+        os.sched_setaffinity(0, cpus) # 0: the calling thread on Linux
+        return True
+    except AttributeError:
+        log.warning("CPU affinity is not supported here")
+    except (OSError, ValueError) as e:
+        log.warning("Cannot pin thread to CPUs %s: %s", ",".join(str(c) for c in sorted(cpus)), e)
+    return False
+
+def setPriority(policy, priority):
+    try:
+        os.sched_setscheduler(0, getattr(os, POLICIES[policy]), os.sched_param(priority))
+        return True
+    except AttributeError:
+        log.warning("Real-time scheduling is not supported here")
+    except (OSError, ValueError) as e:
+        # EPERM without CAP_SYS_NICE or an RLIMIT_RTPRIO of at least the priority
+        log.warning("Cannot switch thread to %s priority %d: %s", POLICIES[policy], priority, e)
+    return False
+
+def setLowLatency(conn):
+    # Makes the kernel hand received bytes to the reader at once instead of after a timer tick
+    # (ASYNC_LOW_LATENCY; for FTDI adapters this also sets their latency timer to 1 ms).
+    try:
+        conn.set_low_latency_mode(True)
+        return True
+    except AttributeError:
+        log.warning("The serial port has no low-latency mode here")
+    except (IOError, OSError, ValueError) as e:
+        log.warning("Cannot set the low-latency flag of the serial port: %s", e)
+    return False
+
+def tune(role, affinity=None, policy=None, priority=None):
+    # Applies what is configured for role to the calling thread.
+    done = []
+    if affinity and role in affinity and setAffinity(affinity[role]):
+        done.append("CPUs " + ",".join(str(c) for c in sorted(affinity[role])))
+    if policy is not None and setPriority(policy, priority):
+        done.append("%s priority %d" % (POLICIES[policy], priority))
+    if done:
+        log.info(role + " threads: %s", ", ".join(done)) # one message per role for the repeat filter
+    return done
@@ -0,0 +1,98 @@
+from __future__ import print_function
+import multiprocessing
+import struct
+import sys
+from time import sleep
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Latest axis/button state published by the serial ingest process, readable from another
+# process without locks or pickling. A seqlock guards the payload: the writer makes the
+# sequence odd, writes the payload and makes it even again; a reader retries until it sees
+# the same even sequence before and after copying the payload out.
+# The last EDGES button states are also kept, by button frame count, so that a reader that
+# polled too late for a short press can still replay it (see buttonHistory).
+# Every write also sets a multiprocessing Event, which the reader blocks on in wait() rather
+# than polling the sequence; the creator makes it and hands it to the other process.
+
+SEQUENCE = struct.Struct('<Q')
+# publish time (perf_counter), motion frame count, button frame count, xyz, rxyz, buttons
+PAYLOAD = struct.Struct('<dII3i3iI')
+EDGES = 16
+EDGE = struct.Struct('<I')
+HISTORY = struct.Struct('<%dI' % EDGES) # buttons by button frame count % EDGES
+HISTORY_OFFSET = SEQUENCE.size + PAYLOAD.size
+SIZE = HISTORY_OFFSET + HISTORY.size
+POLL_INTERVAL = 0.0005 # seconds between looks at the sequence when there is no event
+
+class SharedState(object):
+    def __init__(self, name=None, create=True, changed=None):
+        if shared_memory is None:
+            raise Exception("shared memory needs Python 3.8 or newer")
+        if create or sys.version_info < (3, 13):
+            # Before 3.13 attaching registers the segment with the resource tracker too, but
+            # that is the tracker of the creating process, so the entry is the creator's own
+            # and must not be unregistered here: its unlink() would then fail in the tracker.
+            self.memory = shared_memory.SharedMemory(name=name, create=create, size=SIZE)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name, size=SIZE, track=False)
+        self.name = self.memory.name
+        self.buf = self.memory.buf
+        self.creator = create
+        self.changed = multiprocessing.Event() if create else changed
+        self.sequence = 0
+        if create:
+            SEQUENCE.pack_into(self.buf, 0, 0)
+            PAYLOAD.pack_into(self.buf, SEQUENCE.size, 0.0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+            HISTORY.pack_into(self.buf, HISTORY_OFFSET, *([0] * EDGES))
+
+    def write(self, stamp, motionCount, buttonsCount, xyz, rxyz, buttons):
+        self.sequence += 1
+        SEQUENCE.pack_into(self.buf, 0, self.sequence)
+        PAYLOAD.pack_into(self.buf, SEQUENCE.size, stamp, motionCount, buttonsCount,
+                          xyz[0], xyz[1], xyz[2], rxyz[0], rxyz[1], rxyz[2], buttons)
+        EDGE.pack_into(self.buf, HISTORY_OFFSET + EDGE.size * (buttonsCount % EDGES), buttons)
+        self.sequence += 1
+        SEQUENCE.pack_into(self.buf, 0, self.sequence)
+        if self.changed is not None:
+            self.changed.set()
+
+    def version(self):
+        return SEQUENCE.unpack_from(self.buf, 0)[0]
+
+    def wait(self, timeout):
+        # Returns once the writer may have published something new, at the latest after
+        # timeout. Cleared before the caller compares version(), so no write is missed.
+        if self.changed is None:
+            sleep(POLL_INTERVAL)
+        elif self.changed.wait(timeout):
+            self.changed.clear()
+
+    def read(self):
+        # Returns (sequence, payload tuple) from a consistent snapshot.
+        tries = 0
+        while True:
+            before = SEQUENCE.unpack_from(self.buf, 0)[0]
+            if not before & 1:
+                values = PAYLOAD.unpack_from(self.buf, SEQUENCE.size)
+                if SEQUENCE.unpack_from(self.buf, 0)[0] == before:
+                    return before, values
+            tries += 1
+            if tries > 100:
+                # the writer was preempted mid-update; let it run
+                sleep(0)
+
+    def buttonHistory(self):
+        # The button states of the last EDGES button frames, indexed by frame count % EDGES.
+        # Read after read() saw the newest count; an entry is only overwritten EDGES frames later.
+        return HISTORY.unpack_from(self.buf, HISTORY_OFFSET)
+
+    def close(self):
+        if self.buf is None:
+            return
+        self.buf = None
+        self.memory.close()
+        if self.creator:
+            self.memory.unlink()
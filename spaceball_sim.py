@@ -0,0 +1,367 @@
+from __future__ import print_function
+import getopt
+import math
+import os
+import random
+import select
+import struct
+import sys
+import threading
+import tty
+from time import perf_counter, sleep, time
+
+# Stand-in for a serial SpaceBall on the device side of a pseudo-terminal pair, so that
+# 3d.py -p <pty> exercises serialLoop, the escape handling and processData without hardware.
+
+ESCAPED = { 0x0D: b'^M', 0x11: b'^Q', 0x13: b'^S', 0x5E: b'^^' }
+
+def escape(data):
+    out = bytearray()
+    for c in bytearray(data):
+        if c in ESCAPED:
+            out += ESCAPED[c]
+        else:
+            out.append(c)
+    return bytes(out)
+
+def motionFrame(timer, axes):
+    return b'D' + struct.pack(">H6h", timer & 0xFFFF, *axes)
+
+def flxButtonFrame(buttons):
+    # inverse of the '.' packet decoding in FLXOrX003.processData
+    b = ((buttons >> 3) | (buttons << 9)) & 0b111111111111
+    raw = (b & 0b111111) | ((b & ~0b111111) << 1)
+    return b'.' + struct.pack(">H", raw & 0xFFFF)
+
+def x003ButtonFrame(buttons):
+    return b'K' + struct.pack("BB", buttons & 0xFF, 0)
+
+def sb2003ButtonFrame(buttons):
+    # inverse of Spaceball2003.decodeButtons: 1-4 in the second byte, 5-7, pick (0x10) and
+    # rezero (0x08) in the first
+    first = 0x40 | ((buttons >> 4) & 0x07) | ((buttons >> 3) & 0x10) | (0x08 if buttons & 0x100 else 0)
+    return b'K' + struct.pack("BB", first, 0x40 | (buttons & 0x0F))
+
+NIBBLES = b'0AB3D56GH9:K<MN?' # Magellan characters for the nibbles 0-15
+
+def nibbles(value, count):
+    return bytes(bytearray(NIBBLES[(value >> (4 * i)) & 0xF] for i in range(count - 1, -1, -1)))
+
+def magellanMotionFrame(axes):
+    return b'd' + b''.join(nibbles(a + 0x8000, 4) for a in axes)
+
+def magellanButtonFrame(buttons):
+    return b'k' + bytes(bytearray(NIBBLES[(buttons >> (4 * i)) & 0xF] for i in range(3)))
+
+MODELS = ('flx', 'x003', '2003', 'magellan')
+BUTTONS = { 'flx': 12, 'x003': 8, '2003': 9, 'magellan': 9 }
+CHARACTER_BITS = { 'flx': 10, 'x003': 10, '2003': 10, 'magellan': 11 } # start, 8 data and the stop bits
+
+def modelName(arg):
+    arg = arg.lower()
+    if 'flx' in arg or '4000' in arg:
+        return 'flx'
+    if '2003' in arg:
+        return '2003'
+    if 'magellan' in arg or 'spacemouse' in arg:
+        return 'magellan'
+    return 'x003'
+
+class SpaceBallSimulator(object):
+    def __init__(self, model='flx', rate=50.0, link=None, garbage=0.0, escapes=0.0, drops=0.0,
+                 disconnectInterval=None, seed=None, amplitude=300, buttonInterval=1.0, burst=0, baud=None,
+                 profile='sine', followPeriod=False):
+        self.model = model
+        self.rate = rate
+        self.link = link
+        self.garbage = garbage
+        self.escapes = escapes
+        self.drops = drops
+        self.disconnectInterval = disconnectInterval
+        self.amplitude = amplitude
+        self.buttonInterval = buttonInterval
+        self.burst = burst # button frames after every motion frame, each toggling a button
+        self.baud = baud # pace writes like a serial line of this speed; None writes at once
+        self.lineFree = 0.0
+        self.buttonLog = [] # (perf_counter when written, buttons) of every burst button frame
+        self.profile = profile # 'sine', or 'gestures': pushes and twists with rests in between
+        self.followPeriod = followPeriod # a 4000FLX P command sets the rate, as on the real ball
+        self.gestures = random.Random(seed)
+        self.gesture = (0.0, 0.0, (0,) * 6) # start, end, peak axes
+        self.gestureLog = [] # time() at which each gesture starts
+        self.started = 0.0
+        self.random = random.Random(seed)
+        self.running = False
+        self.streaming = False
+        self.master = None
+        self.slave = None
+        self.writeLock = threading.Lock()
+        self.stats = { 'framesSent': 0, 'buttonFramesSent': 0, 'commandsReceived': 0,
+                       'faultsInjected': 0, 'disconnects': 0, 'beeps': 0, 'bytesSent': 0 }
+        self.openPty()
+
+    @property
+    def port(self):
+        return self.link if self.link else os.ttyname(self.slave)
+
+    def openPty(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        if self.link:
+            if os.path.lexists(self.link):
+                os.unlink(self.link)
+            os.symlink(os.ttyname(self.slave), self.link)
+
+    def closePty(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def disconnect(self):
+        # The reopened device comes back unconfigured, like a power-cycled ball.
+        with self.writeLock:
+            old = (self.master, self.slave)
+            self.streaming = False
+            self.openPty()
+            for fd in old:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self.stats['disconnects'] += 1
+
+    def send(self, packet):
+        data = escape(packet)
+        if self.drops and self.random.random() < self.drops:
+            i = self.random.randrange(len(data))
+            data = data[:i] + data[i+1:]
+            self.stats['faultsInjected'] += 1
+        if self.escapes and self.random.random() < self.escapes:
+            i = self.random.randrange(len(data) + 1)
+            data = data[:i] + b'^' + data[i:]
+            self.stats['faultsInjected'] += 1
+        if self.garbage and self.random.random() < self.garbage:
+            data = bytes(bytearray(self.random.randrange(256) for i in range(self.random.randrange(1, 20)))) + data
+            self.stats['faultsInjected'] += 1
+        self.write(data + b'\r')
+
+    def write(self, data):
+        with self.writeLock:
+            if self.baud:
+                # the line takes new data once the previous data has gone out
+                start = max(self.lineFree, perf_counter())
+                delay = start - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                self.lineFree = start + len(data) * CHARACTER_BITS[self.model] / float(self.baud)
+            try:
+                os.write(self.master, data)
+                self.stats['bytesSent'] += len(data)
+            except OSError:
+                pass
+
+    def respond(self, command):
+        self.stats['commandsReceived'] += 1
+        if command[:1] == b'B':
+            self.stats['beeps'] += 1
+        elif self.model == 'flx':
+            if command == b'A271006':
+                self.write(b'a271006E\r')
+            elif command[:1] in (b'P', b'Y', b'M'):
+                self.write(command + b'\r')
+                if self.followPeriod and command[:1] == b'P' and command[1:].isdigit() and int(command[1:]):
+                    self.rate = 1000.0 / int(command[1:]) # data period in ms
+                if command == b'M':
+                    self.streaming = True
+        elif self.model == 'magellan':
+            if command[:1] == b'b':
+                self.stats['beeps'] += 1
+            elif command == b'vQ':
+                self.write(b'v  MAGELLAN  Version 6.60  simulator\r')
+            elif command == b'm3':
+                self.write(command + b'\r')
+                self.streaming = True
+        else:
+            if command == b'hv':
+                self.write(b'Hv SpaceBall %s simulator\r' % (b'2003' if self.model == '2003' else b'3003'))
+            elif command in (b'MSS', b'MSSV'):
+                self.streaming = True
+
+    def readLoop(self):
+        pending = b''
+        while self.running:
+            master = self.master
+            try:
+                r, w, x = select.select([master], [], [], 0.05)
+                if not r:
+                    continue
+                pending += os.read(master, 256)
+            except (OSError, ValueError) as e:
+                # the host has not opened the slave side yet, or we are mid-disconnect
+                sleep(0.01)
+                continue
+            commands = pending.split(b'\r')
+            pending = commands.pop()
+            for command in commands:
+                if command:
+                    self.respond(command)
+
+    def motion(self, t):
+        a = self.amplitude
+        if self.profile == 'gestures':
+            return self.gestureMotion(t)
+        return tuple(int(a * math.sin(t * (0.5 + 0.25 * i) + i)) for i in range(6))
+
+    def gestureMotion(self, t):
+        # A raised-cosine pulse on one to three axes, like a hand pushing and letting go, and
+        # a rest before the next one.
+        start, end, peak = self.gesture
+        while t >= end:
+            r = self.gestures
+            start = end + (r.uniform(0.1, 0.5) if r.random() < 0.7 else r.uniform(2.0, 5.0)) # now and then a longer rest
+            end = start + r.uniform(0.2, 0.8)
+            axes = r.sample(range(6), r.randint(1, 3))
+            peak = tuple(int(self.amplitude * r.uniform(-1, 1)) if i in axes else 0 for i in range(6))
+            self.gesture = (start, end, peak)
+            self.gestureLog.append(self.started + start)
+        if t < start:
+            return (0,) * 6
+        s = 0.5 - 0.5 * math.cos(2 * math.pi * (t - start) / (end - start))
+        return tuple(int(p * s) for p in peak)
+
+    def motionFrame(self, timer, axes):
+        return magellanMotionFrame(axes) if self.model == 'magellan' else motionFrame(timer, axes)
+
+    def buttonFrame(self, buttons):
+        if self.model == 'flx':
+            return flxButtonFrame(buttons)
+        if self.model == '2003':
+            return sb2003ButtonFrame(buttons)
+        if self.model == 'magellan':
+            return magellanButtonFrame(buttons)
+        return x003ButtonFrame(buttons)
+
+    def streamLoop(self):
+        t0 = self.started = time()
+        next = t0
+        nextButtons = t0 + self.buttonInterval
+        nextDisconnect = t0 + self.disconnectInterval if self.disconnectInterval else None
+        buttons = 0
+        timer = 0
+        while self.running:
+            now = time()
+            if nextDisconnect is not None and now >= nextDisconnect:
+                self.disconnect()
+                nextDisconnect = now + self.disconnectInterval
+            if self.streaming:
+                timer += 1
+                self.send(self.motionFrame(timer, self.motion(now - t0)))
+                self.stats['framesSent'] += 1
+                for i in range(self.burst):
+                    buttons ^= 1 << self.random.randrange(BUTTONS[self.model])
+                    self.send(self.buttonFrame(buttons))
+                    self.buttonLog.append((perf_counter(), buttons))
+                    self.stats['buttonFramesSent'] += 1
+                if self.buttonInterval and not self.burst and now >= nextButtons:
+                    buttons = 0 if buttons else 1 << self.random.randrange(BUTTONS[self.model])
+                    self.send(self.buttonFrame(buttons))
+                    self.stats['buttonFramesSent'] += 1
+                    nextButtons = now + self.buttonInterval
+            next += 1.0 / self.rate
+            delay = next - time()
+            if delay > 0:
+                sleep(delay)
+            else:
+                next = time()
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.readLoop), threading.Thread(target=self.streamLoop)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        self.running = False
+        for t in self.threads:
+            t.join()
+        self.closePty()
+        if self.link and os.path.lexists(self.link):
+            os.unlink(self.link)
+
+if __name__ == '__main__':
+    model = 'flx'
+    rate = 50.0
+    link = None
+    garbage = escapes = drops = 0.0
+    disconnectInterval = None
+    seed = None
+    duration = None
+    burst = 0
+    baud = None
+    profile = 'sine'
+    followPeriod = False
+    opts, args = getopt.getopt(sys.argv[1:], "hM:r:l:g:e:x:D:S:t:b:B:m:P", ["help", "model=", "rate=", "link=", "garbage=",
+                               "escapes=", "drops=", "disconnect=", "seed=", "time=", "burst=", "baud=", "motion=",
+                               "follow-period"])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python spaceball_sim.py [options]\n
+-h --help                this information
+-Mmodel --model=model    simulate model: flx (4000flx or 5000flx), x003 (3003), 2003, magellan
+-rHZ --rate=HZ           data frames per second (default 50)
+-lPATH --link=PATH       keep a symlink to the device pty at PATH across disconnects
+-gP --garbage=P          probability of garbage bytes before a frame
+-eP --escapes=P          probability of a stray escape inside a frame
+-xP --drops=P            probability of a dropped byte inside a frame
+-DSEC --disconnect=SEC   drop and recreate the pty every SEC seconds
+-SSEED --seed=SEED       random seed for the fault injection
+-tSEC --time=SEC         stop after SEC seconds
+-bN --burst=N            send N button frames after every data frame, each toggling a button
+-BBAUD --baud=BAUD       write no faster than a serial line of BAUD bits per second
+-mKIND --motion=KIND     sine (default), or gestures: pushes and twists with rests in between
+-P --follow-period       the 4000FLX P command (3d.py -f) sets the rate instead of -r""")
+            sys.exit(0)
+        elif opt in ('-M', '--model'):
+            model = modelName(arg)
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt in ('-l', '--link'):
+            link = arg
+        elif opt in ('-g', '--garbage'):
+            garbage = float(arg)
+        elif opt in ('-e', '--escapes'):
+            escapes = float(arg)
+        elif opt in ('-x', '--drops'):
+            drops = float(arg)
+        elif opt in ('-D', '--disconnect'):
+            disconnectInterval = float(arg)
+        elif opt in ('-S', '--seed'):
+            seed = int(arg)
+        elif opt in ('-t', '--time'):
+            duration = float(arg)
+        elif opt in ('-b', '--burst'):
+            burst = int(arg)
+        elif opt in ('-B', '--baud'):
+            baud = int(arg)
+        elif opt in ('-m', '--motion'):
+            profile = arg
+        elif opt in ('-P', '--follow-period'):
+            followPeriod = True
+
+    sim = SpaceBallSimulator(model=model, rate=rate, link=link, garbage=garbage, escapes=escapes, drops=drops,
+                             disconnectInterval=disconnectInterval, seed=seed, burst=burst, baud=baud,
+                             profile=profile, followPeriod=followPeriod)
+    sim.start()
+    print("Simulating "+model+" on "+sim.port)
+    print("Run: python 3d.py -M "+model+" -p "+sim.port)
+    try:
+        t1 = time() + duration if duration else None
+        while t1 is None or time() < t1:
+            sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+    print("Stats: " + ", ".join(k + "=" + str(v) for k,v in sorted(sim.stats.items())))
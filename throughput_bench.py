@@ -0,0 +1,152 @@
+from __future__ import print_function
+try:
+    import builtins
+except:
+    import __builtin__
+    builtins = __builtin__
+import getopt
+import os
+import socket
+import sys
+import threading
+from time import perf_counter, sleep
+
+# Bulk and isochronous throughput of USBContainer, driven by the stand-in host in
+# usbip_client.py with several URBs in flight per endpoint, over TCP, a Unix-domain socket
+# and an in-process socketpair (USBContainer.connect):
+#     python throughput_bench.py              MB/s per transport, transfer type and URB size
+#     python throughput_bench.py -x pair -w 1 round trips, without the socket stack
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+builtins.USBIP_VERSION = 273
+from USBIP import USBDevice, USBContainer, DeviceConfigurations, InterfaceDescriptor, EndPoint, rev
+from usbip_client import USBIPClient
+import logs
+
+ISO_PACKET = 1023 # full-speed isochronous maximum
+
+class StreamDevice(USBDevice):
+    # Vendor-specific device with a bulk IN/OUT pair on interface 0 and an isochronous
+    # IN/OUT pair on interface 1; IN data comes from a fixed pattern, OUT data is counted.
+    vendorID = 0x1209
+    productID = 0x0001
+    bcdDevice = 0x100
+    bDeviceClass = 0xFF
+    bDeviceSubClass = 0x0
+    bDeviceProtocol = 0x0
+    bNumConfigurations = 1
+    bConfigurationValue = 1
+
+    def __init__(self):
+        configuration = DeviceConfigurations(bConfigurationValue=1)
+        bulk = InterfaceDescriptor(bInterfaceNumber=0, bInterfaceClass=0xFF, bInterfaceSubClass=0, bInterfaceProtocol=0)
+        bulk.endpoints = [EndPoint(bEndpointAddress=0x81, bmAttributes=0x2, wMaxPacketSize=rev(64), bInterval=0),
+                          EndPoint(bEndpointAddress=0x02, bmAttributes=0x2, wMaxPacketSize=rev(64), bInterval=0)]
+        iso = InterfaceDescriptor(bInterfaceNumber=1, bInterfaceClass=0xFF, bInterfaceSubClass=0, bInterfaceProtocol=0)
+        iso.endpoints = [EndPoint(bEndpointAddress=0x83, bmAttributes=0x1, wMaxPacketSize=rev(ISO_PACKET), bInterval=1),
+                         EndPoint(bEndpointAddress=0x04, bmAttributes=0x1, wMaxPacketSize=rev(ISO_PACKET), bInterval=1)]
+        configuration.interfaces = [bulk, iso]
+        self.configurations = [configuration]
+        USBDevice.__init__(self)
+        self.pattern = memoryview(bytes(bytearray(i & 0xFF for i in range(1 << 20))))
+        self.packet = bytes(self.pattern[:ISO_PACKET])
+        self.received = 0
+        self.register_endpoint(0x81, self.bulk_in)
+        self.register_endpoint(0x02, self.bulk_out)
+        self.register_endpoint(0x83, self.iso_in)
+        self.register_endpoint(0x04, self.iso_out)
+
+    def bulk_in(self, usb_req):
+        self.send_usb_req(usb_req, self.pattern[:usb_req.transfer_buffer_length])
+
+    def bulk_out(self, usb_req):
+        self.received += len(usb_req.data)
+        self.send_usb_out_reply(usb_req)
+
+    def iso_in(self, usb_req):
+        self.send_iso_reply(usb_req, [self.packet] * len(usb_req.iso_packets))
+
+    def iso_out(self, usb_req):
+        self.received += len(usb_req.data)
+        self.send_iso_reply(usb_req)
+
+TRANSPORTS = ('tcp', 'unix', 'pair')
+
+def startServer(transport='tcp'):
+    # Returns the container, its device and a client connected over `transport`.
+    device = StreamDevice()
+    container = USBContainer()
+    container.usb_devices = [device]
+    if transport == 'pair':
+        return container, device, USBIPClient(sock=container.connect())
+    path = '/tmp/throughput_bench_%d.sock' % os.getpid()
+    kwargs = { 'path': path } if transport == 'unix' else { 'ip': '127.0.0.1', 'port': 0, 'forceIP': True }
+    t = threading.Thread(target=container.run, kwargs=kwargs)
+    t.daemon = True
+    t.start()
+    while not hasattr(container, 'channel'):
+        sleep(0.01)
+    if transport == 'unix':
+        return container, device, USBIPClient(path=path)
+    return container, device, USBIPClient(port=container.channel.socket.getsockname()[1])
+
+def runTransfer(client, ep, direction, size, iso=None, window=8, duration=2.0):
+    # Keeps `window` URBs in flight; returns (URBs per second, payload MB per second).
+    payload = bytes(bytearray(size)) if direction == 0 else b''
+    packets = [ISO_PACKET] * (size // ISO_PACKET) if iso else None
+    for i in range(window):
+        client.submit(ep, direction, size, payload, iso=packets)
+    count = 0
+    moved = 0
+    t0 = perf_counter()
+    while True:
+        seqnum, status, data, descriptors = client.receive()
+        if status:
+            raise Exception("URB failed with status %d" % status)
+        count += 1
+        moved += len(data) if direction else size
+        elapsed = perf_counter() - t0
+        if elapsed >= duration:
+            break
+        client.submit(ep, direction, size, payload, iso=packets)
+    for i in range(window - 1):
+        client.receive()
+    return count / elapsed, moved / elapsed / 1e6
+
+SCENARIOS = (("bulk IN", 1, 1, 8, False), ("bulk IN", 1, 1, 512, False), ("bulk IN", 1, 1, 16384, False), ("bulk IN", 1, 1, 65536, False),
+             ("bulk OUT", 2, 0, 512, False), ("bulk OUT", 2, 0, 16384, False), ("bulk OUT", 2, 0, 65536, False),
+             ("iso IN", 3, 1, 8 * ISO_PACKET, True), ("iso IN", 3, 1, 32 * ISO_PACKET, True),
+             ("iso OUT", 4, 0, 8 * ISO_PACKET, True), ("iso OUT", 4, 0, 32 * ISO_PACKET, True))
+
+if __name__ == '__main__':
+    duration = 2.0
+    window = 8
+    transports = TRANSPORTS
+    opts, args = getopt.getopt(sys.argv[1:], "ht:w:x:", ["help", "time=", "window=", "transports="])
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("""python throughput_bench.py [options]\n
+-h --help                this information
+-tSEC --time=SEC         measure each transfer for SEC seconds (default 2)
+-wN --window=N           URBs in flight (default 8)
+-xLIST --transports=LIST comma separated from tcp, unix, pair (default all)""")
+            sys.exit(0)
+        elif opt in ('-t', '--time'):
+            duration = float(arg)
+        elif opt in ('-w', '--window'):
+            window = int(arg)
+        elif opt in ('-x', '--transports'):
+            transports = arg.split(',')
+
+    logs.setup(stream=open(os.devnull, 'w'))
+    print("%-10s %-10s %10s %10s %10s %10s" % ("transport", "transfer", "URB bytes", "URBs/s", "us/URB", "MB/s"))
+    for transport in transports:
+        container, device, client = startServer(transport)
+        client.devlist()
+        client.attach()
+        for name, ep, direction, size, iso in SCENARIOS:
+            rate, mb = runTransfer(client, ep, direction, size, iso=iso, window=window, duration=duration)
+            print("%-10s %-10s %10d %10.0f %10.1f %10.1f" % (transport, name, size, rate, 1e6 / rate, mb))
+        container.running = False
+        client.close()
@@ -0,0 +1,140 @@
+from __future__ import print_function
+import socket
+import struct
+
+# Minimal host side of the USB/IP protocol, standing in for the kernel's vhci driver in
+# benchmarks: lists and imports the exported device and submits URBs over the socket.
+#     client = USBIPClient(port=3240)      or path='/tmp/usbip.sock', or sock=container.connect()
+#     client.attach()
+#     status, data, packets = client.transfer(1, 1, 64)     # 64 bytes from EP1 IN
+
+OP_REQ_DEVLIST = 0x8005
+OP_REQ_IMPORT = 0x8003
+OP_HEADER = struct.Struct('>HHI')
+COUNT = struct.Struct('>I')
+# path, bus id, busnum, devnum, speed, idVendor, idProduct, bcdDevice, class, subclass,
+# protocol, configuration value, configuration count, interface count
+DEVICE = struct.Struct('>256s32sIIIHHHBBBBBB')
+INTERFACE = struct.Struct('>BBBB')
+CMD_SUBMIT = struct.Struct('>IIIIIIIIIIQ')
+RET_SUBMIT = struct.Struct('>IIIIIIIIIIQ')
+ISO_PACKET = struct.Struct('>IIIi')
+SETUP = struct.Struct('<BBHHH')
+
+def signed(status):
+    return status - (1 << 32) if status & 0x80000000 else status
+
+def device(fields):
+    keys = ('path', 'busid', 'busnum', 'devnum', 'speed', 'idVendor', 'idProduct', 'bcdDevice', 'bDeviceClass',
+            'bDeviceSubClass', 'bDeviceProtocol', 'bConfigurationValue', 'bNumConfigurations', 'bNumInterfaces')
+    d = dict(zip(keys, fields))
+    d['path'] = d['path'].rstrip(b'\0')
+    d['busid'] = d['busid'].rstrip(b'\0')
+    return d
+
+class USBIPClient(object):
+    # TCP to host:port by default; path connects to a Unix-domain socket (3d.py -a PATH) and
+    # sock uses a connected socket, such as the one from USBContainer.connect.
+    def __init__(self, host='127.0.0.1', port=3240, version=273, timeout=10, path=None, sock=None):
+        if sock is None and path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+        if sock is None:
+            sock = socket.create_connection((host, port), timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(timeout)
+        self.sock = sock
+        self.version = version
+        self.seqnum = 0
+        self.devid = (1 << 16) | 2
+        self.pending = {}
+
+    def recv(self, n):
+        data = bytearray(n)
+        view = memoryview(data)
+        got = 0
+        while got < n:
+            k = self.sock.recv_into(view[got:])
+            if not k:
+                raise EOFError("USB/IP server closed the connection")
+            got += k
+        return bytes(data)
+
+    def devlist(self):
+        self.sock.sendall(OP_HEADER.pack(self.version, OP_REQ_DEVLIST, 0))
+        self.recv(OP_HEADER.size)
+        devices = []
+        for i in range(COUNT.unpack(self.recv(COUNT.size))[0]):
+            d = device(DEVICE.unpack(self.recv(DEVICE.size)))
+            d['interfaces'] = [INTERFACE.unpack(self.recv(INTERFACE.size))[:3] for j in range(d['bNumInterfaces'])]
+            devices.append(d)
+        return devices
+
+    def attach(self, busid=b'1-1'):
+        self.sock.sendall(OP_HEADER.pack(self.version, OP_REQ_IMPORT, 0) + busid.ljust(32, b'\0'))
+        version, command, status = OP_HEADER.unpack(self.recv(OP_HEADER.size))
+        if status:
+            raise Exception("import failed with status %d" % status)
+        return device(DEVICE.unpack(self.recv(DEVICE.size)))
+
+    def submit(self, ep, direction, length=0, data=b'', setup=0, iso=None, interval=0, start_frame=0):
+        # Sends a CMD_SUBMIT without waiting for the reply and returns its sequence number.
+        # For OUT transfers data is the payload; iso lists the length of each packet.
+        self.seqnum += 1
+        if direction == 0:
+            length = len(data)
+        descriptors = b''
+        if iso is not None:
+            offset = 0
+            for n in iso:
+                descriptors += ISO_PACKET.pack(offset, n, 0, 0)
+                offset += n
+            if direction:
+                length = offset
+        header = CMD_SUBMIT.pack(1, self.seqnum, self.devid, direction, ep, 0, length, start_frame,
+                                 len(iso) if iso is not None else 0, interval, setup)
+        self.pending[self.seqnum] = direction
+        self.sock.sendall(header + (data if direction == 0 else b'') + descriptors)
+        return self.seqnum
+
+    def unlink(self, seqnum):
+        # Asks the device to drop a pending URB; the RET_UNLINK arrives through receive() with
+        # status -104 (ECONNRESET) when it was dropped, 0 when it had already completed.
+        self.seqnum += 1
+        self.pending[self.seqnum] = None
+        self.sock.sendall(CMD_SUBMIT.pack(2, self.seqnum, self.devid, 0, 0, seqnum, 0, 0, 0, 0, 0))
+        return self.seqnum
+
+    def receive(self):
+        # Reads the next RET_SUBMIT or RET_UNLINK: (seqnum, status, data, packets); packets
+        # holds an (offset, length, actual_length, status) tuple per isochronous packet.
+        values = RET_SUBMIT.unpack(self.recv(RET_SUBMIT.size))
+        seqnum, status, actual, packets = values[1], signed(values[5]), values[6], values[8]
+        direction = self.pending.pop(seqnum, 1)
+        if values[0] == 4: # RET_UNLINK
+            return seqnum, status, b'', []
+        data = self.recv(actual) if direction and actual else b''
+        iso = []
+        if packets and packets != 0xFFFFFFFF:
+            raw = self.recv(packets * ISO_PACKET.size)
+            iso = [ISO_PACKET.unpack_from(raw, i) for i in range(0, len(raw), ISO_PACKET.size)]
+        return seqnum, status, data, iso
+
+    def transfer(self, ep, direction, length=0, data=b'', iso=None):
+        seqnum = self.submit(ep, direction, length, data, iso=iso)
+        while True:
+            got, status, data, packets = self.receive()
+            if got == seqnum:
+                return status, data, packets
+
+    def control(self, bmRequestType, bRequest, wValue=0, wIndex=0, wLength=0, data=b''):
+        setup = struct.unpack('>Q', SETUP.pack(bmRequestType, bRequest, wValue, wIndex, wLength))[0]
+        direction = 1 if bmRequestType & 0x80 else 0
+        seqnum = self.submit(0, direction, wLength, data, setup=setup)
+        while True:
+            got, status, reply, packets = self.receive()
+            if got == seqnum:
+                return status, reply
+
+    def close(self):
+        self.sock.close()